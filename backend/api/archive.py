@@ -0,0 +1,88 @@
+"""
+Hot/cold split of appointments.
+
+archive_appointments moves completed appointments that ended long ago from Appointment to
+ArchivedAppointment, keeping their ids, so the hot table and its indexes only cover current
+operations. AppointmentHistory is a view over both tables. List, occupancy and change feed reads
+that reach back past the archive horizon (APPOINTMENT_ARCHIVE_DAYS ago) are served from it, see
+ArchiveReadMixin, and so are detail reads. Archived appointments can't be updated or deleted.
+"""
+from datetime import timedelta
+
+from django import forms
+from django.conf import settings
+from django.db import connections, router, transaction
+from django.utils import timezone
+from django_filters.fields import DateRangeField
+from rest_framework.permissions import SAFE_METHODS
+
+from .chart import invalidate_chart
+from .events import publish_resync
+from .models import Appointment, AppointmentHistory, ArchivedAppointment
+
+COLUMNS = ['id', 'start', 'end', 'status', 'patient_id', 'created_at', 'updated_at', 'notes']
+
+
+def archive_horizon():
+    """Appointments done before this are archived, so reads reaching back past it need the archive"""
+    return timezone.now() - timedelta(days=settings.APPOINTMENT_ARCHIVE_DAYS)
+
+
+def archivable(before):
+    return Appointment.objects.filter(status=Appointment.StatusEnum.DONE, end__lt=before)
+
+
+def archive_batch(before, batch_size):
+    """
+    Move up to batch_size appointments that were done before `before`, oldest first. Returns how many moved.
+    The hot rows are deleted in plain SQL, without post_delete: archived rows are still readable, so they
+    aren't removals for change feeds or stats. Charts are invalidated and event streams told to resync
+    instead, since both read the hot table.
+    """
+    with transaction.atomic():
+        rows = list(archivable(before).select_for_update().order_by('start', 'id').values(*COLUMNS)[:batch_size])
+        if not rows:
+            return 0
+        ArchivedAppointment.objects.bulk_create([ArchivedAppointment(**row) for row in rows])
+        connection = connections[router.db_for_write(Appointment)]
+        with connection.cursor() as cursor:
+            cursor.execute('DELETE FROM %s WHERE %s IN (%s)' % (
+                connection.ops.quote_name(Appointment._meta.db_table),
+                connection.ops.quote_name(Appointment._meta.pk.column),
+                ', '.join(['%s'] * len(rows))), [row['id'] for row in rows])
+        for patient_id in {row['patient_id'] for row in rows}:
+            invalidate_chart(patient_id)
+        publish_resync()
+    return len(rows)
+
+
+class ArchiveReadMixin:
+    """
+    Safe-method reads whose start filter reaches back before the archive horizon, or that list one
+    patient's appointments without a start_after, come from AppointmentHistory (hot and archived).
+    """
+    history_queryset = AppointmentHistory.objects.select_related('patient__insurance_provider')
+    history_filterset_class = None
+
+    def reads_archive(self):
+        if self.request.method not in SAFE_METHODS:
+            return False
+        params = self.request.query_params
+        if 'start_after' not in params and 'start_before' not in params and 'patient' not in params:
+            return False
+        try:
+            start = DateRangeField(required=False).clean([params.get('start_after'), params.get('start_before')])
+        except forms.ValidationError:
+            # Left to the filterset to report
+            return False
+        if start is None or start.start is None:
+            return True
+        return start.start < archive_horizon()
+
+    def get_queryset(self):
+        if not hasattr(self, '_reads_archive'):
+            self._reads_archive = self.reads_archive()
+            if self._reads_archive:
+                self.queryset = self.history_queryset
+                self.filterset_class = self.history_filterset_class
+        return super().get_queryset()
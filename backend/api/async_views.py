@@ -0,0 +1,117 @@
+"""
+Async versions of the hot read endpoints, for deployments on backend.asgi.
+
+They reuse the sync views' querysets, filters, pagination and serializers, and
+return the same response bodies; only query execution goes through Django's
+async ORM so a slow query doesn't hold a worker thread while it waits.
+"""
+from functools import wraps
+
+from asgiref.sync import sync_to_async
+from django import forms
+from django.http import HttpResponse, StreamingHttpResponse
+from django_filters.fields import DateRangeField
+from rest_framework import exceptions
+from rest_framework.pagination import LimitOffsetPagination
+from rest_framework.request import Request
+
+from .authentication import CachedTokenAuthentication
+from .events import appointment_stream
+from .renderers import FastJSONRenderer
+from .views import AppointmentList, PatientDetail, PatientList
+
+
+def render(data, status=200):
+    return HttpResponse(FastJSONRenderer().render(data), status=status, content_type='application/json')
+
+
+def async_api_view(view):
+    """GET-only, token authenticated, with API exceptions rendered like DRF does"""
+    @wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        try:
+            if request.method not in ('GET', 'HEAD'):
+                raise exceptions.MethodNotAllowed(request.method)
+            authentication = CachedTokenAuthentication()
+            user_auth = await authentication.authenticate_async(request)
+            if user_auth is None:
+                raise exceptions.NotAuthenticated()
+            request.user, request.auth = user_auth
+            return await view(request, *args, **kwargs)
+        except exceptions.APIException as exc:
+            detail = exc.detail if isinstance(exc.detail, (list, dict)) else {'detail': exc.detail}
+            response = render(detail, exc.status_code)
+            if isinstance(exc, (exceptions.NotAuthenticated, exceptions.AuthenticationFailed)):
+                response['WWW-Authenticate'] = CachedTokenAuthentication.keyword
+            return response
+    return wrapper
+
+
+def sync_view(view_class, request, **kwargs):
+    view = view_class(args=(), kwargs=kwargs, format_kwarg=None)
+    view.request = Request(request)
+    return view
+
+
+async def list_response(view, queryset):
+    request, paginator = view.request, view.paginator
+    if not isinstance(paginator, LimitOffsetPagination):
+        # Cursor pagination has no async path, run it in a thread
+        rows = await sync_to_async(paginator.paginate_queryset)(queryset, request, view)
+        return render(paginator.get_paginated_response(view.get_serializer(rows, many=True).data).data)
+
+    paginator.limit = paginator.get_limit(request)
+    if paginator.limit is None:
+        rows = [obj async for obj in queryset]
+        return render(view.get_serializer(rows, many=True).data)
+
+    paginator.offset = paginator.get_offset(request)
+    paginator.count = await queryset.acount()
+    paginator.request = request
+    rows = [obj async for obj in queryset[paginator.offset:paginator.offset + paginator.limit]]
+    return render(paginator.get_paginated_response(view.get_serializer(rows, many=True).data).data)
+
+
+@async_api_view
+async def appointment_list(request):
+    view = sync_view(AppointmentList, request)
+    # FilterSet validation may look up the patient, and picking the hot or archive table may read
+    # the archive horizon, neither of which the async context can do inline
+    queryset = await sync_to_async(lambda: view.filter_queryset(view.get_queryset()))()
+    return await list_response(view, queryset)
+
+
+@async_api_view
+async def patient_list(request):
+    view = sync_view(PatientList, request)
+    return await list_response(view, view.filter_queryset(view.get_queryset()))
+
+
+@async_api_view
+async def patient_detail(request, pk):
+    view = sync_view(PatientDetail, request, pk=pk)
+    try:
+        patient = await view.get_queryset().aget(pk=pk)
+    except view.queryset.model.DoesNotExist:
+        raise exceptions.NotFound()
+    return render(view.get_serializer(patient).data)
+
+
+@async_api_view
+async def appointment_events(request):
+    """
+    Pushes appointment changes as Server-Sent Events instead of clients polling, see api.events.
+    Filtered on start_after/start_before (dates, like AppointmentList) and patient.
+    Serve it from backend.asgi, under WSGI each open stream holds a worker thread.
+    """
+    try:
+        start_range = DateRangeField(required=False).clean(
+            [request.GET.get('start_after'), request.GET.get('start_before')])
+        patient = forms.IntegerField(required=False).clean(request.GET.get('patient'))
+    except forms.ValidationError as exc:
+        raise exceptions.ValidationError({'detail': exc.messages})
+    response = StreamingHttpResponse(appointment_stream(start_range, patient), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # Stops nginx from buffering the stream
+    response['X-Accel-Buffering'] = 'no'
+    return response
@@ -0,0 +1,138 @@
+import hashlib
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core import checks
+from django.db import DEFAULT_DB_ALIAS
+from django.utils import timezone
+from django.utils.translation import gettext_lazy as _
+from rest_framework import exceptions
+from rest_framework.authentication import TokenAuthentication, get_authorization_header
+
+from .cache import get_cache
+
+
+def token_cache_key(key):
+    # Raw tokens never go into the cache
+    return 'api:token:%s' % hashlib.sha256(key.encode()).hexdigest()
+
+
+def invalidate_token(key):
+    get_cache().delete(token_cache_key(key))
+
+
+# What authentication and permission checks read, the rest of the user loads on first access
+USER_FIELDS = ('is_active', 'is_staff', 'is_superuser')
+
+
+def token_cache_entry(token):
+    entry = {name: getattr(token.user, name) for name in USER_FIELDS}
+    return dict(entry, user_id=token.user_id, created=token.created)
+
+
+def token_from_cache_entry(model, key, entry):
+    """The Token and its user, with the user's other fields deferred, as if loaded with .only()"""
+    user_model = get_user_model()
+    user = load_partial(user_model, dict({user_model._meta.pk.attname: entry['user_id']},
+                                         **{name: entry[name] for name in USER_FIELDS}))
+    token = load_partial(model, {'key': key, 'user_id': entry['user_id'], 'created': entry['created']})
+    token.user = user
+    return token
+
+
+def load_partial(model, values):
+    # from_db() takes the loaded values in the model's field order
+    names = [field.attname for field in model._meta.concrete_fields if field.attname in values]
+    return model.from_db(DEFAULT_DB_ALIAS, names, [values[name] for name in names])
+
+
+@checks.register(checks.Tags.security)
+def check_token_settings(app_configs, **kwargs):
+    if settings.TOKEN_IDLE_TIMEOUT and settings.TOKEN_IDLE_TIMEOUT < settings.TOKEN_REFRESH_INTERVAL:
+        return [checks.Error(
+            'TOKEN_IDLE_TIMEOUT (%d) is shorter than TOKEN_REFRESH_INTERVAL (%d).' % (
+                settings.TOKEN_IDLE_TIMEOUT, settings.TOKEN_REFRESH_INTERVAL),
+            hint='Tokens in active use would expire before they are refreshed.',
+            id='api.E001',
+        )]
+    return []
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """
+    TokenAuthentication with the token -> user lookup cached for TOKEN_CACHE_TIMEOUT seconds.
+
+    With TOKEN_IDLE_TIMEOUT set, tokens expire after that long without use. Token.created is
+    used as the last-refresh time and is moved forward at most once per TOKEN_REFRESH_INTERVAL.
+    Deleting a token (djoser logout) clears its cache entry, see api.signals. The cache holds
+    token_cache_entry() fields only, never the user's password hash or profile.
+    """
+
+    def authenticate_credentials(self, key):
+        cache = get_cache()
+        cache_key = token_cache_key(key)
+        entry = cache.get(cache_key)
+        model = self.get_model()
+        if entry is None:
+            try:
+                token = model.objects.select_related('user').get(key=key)
+            except model.DoesNotExist:
+                raise exceptions.AuthenticationFailed(_('Invalid token.'))
+            cache.set(cache_key, token_cache_entry(token), timeout=settings.TOKEN_CACHE_TIMEOUT)
+        else:
+            token = token_from_cache_entry(model, key, entry)
+
+        if not token.user.is_active:
+            raise exceptions.AuthenticationFailed(_('User inactive or deleted.'))
+
+        if settings.TOKEN_IDLE_TIMEOUT:
+            self.check_expiry(token, cache_key)
+
+        return (token.user, token)
+
+    def needs_refresh(self, token):
+        return bool(settings.TOKEN_IDLE_TIMEOUT) and \
+            timezone.now() - token.created > timedelta(seconds=settings.TOKEN_REFRESH_INTERVAL)
+
+    def is_expired(self, token):
+        return bool(settings.TOKEN_IDLE_TIMEOUT) and \
+            timezone.now() - token.created > timedelta(seconds=settings.TOKEN_IDLE_TIMEOUT)
+
+    def check_expiry(self, token, cache_key):
+        now = timezone.now()
+        if self.is_expired(token):
+            token.delete()
+            raise exceptions.AuthenticationFailed(_('Token has expired.'))
+        if self.needs_refresh(token):
+            # Sliding refresh
+            self.get_model().objects.filter(key=token.key).update(created=now)
+            token.created = now
+            get_cache().set(cache_key, token_cache_entry(token), timeout=settings.TOKEN_CACHE_TIMEOUT)
+
+    async def authenticate_async(self, request):
+        """
+        authenticate() for plain async Django views. Cache hits stay on the event loop,
+        misses and refreshes fall back to the sync path in a thread.
+        """
+        auth = get_authorization_header(request).split()
+        if not auth or auth[0].lower() != self.keyword.lower().encode():
+            return None
+        if len(auth) != 2:
+            raise exceptions.AuthenticationFailed(_('Invalid token header.'))
+        try:
+            key = auth[1].decode()
+        except UnicodeError:
+            raise exceptions.AuthenticationFailed(_('Invalid token header.'))
+
+        entry = await get_cache().aget(token_cache_key(key))
+        if entry is None:
+            return await sync_to_async(self.authenticate_credentials)(key)
+        token = token_from_cache_entry(self.get_model(), key, entry)
+        if self.is_expired(token) or self.needs_refresh(token):
+            # The sync path deletes expired tokens and refreshes the others
+            return await sync_to_async(self.authenticate_credentials)(key)
+        if not token.user.is_active:
+            raise exceptions.AuthenticationFailed(_('User inactive or deleted.'))
+        return (token.user, token)
@@ -0,0 +1,168 @@
+from contextlib import nullcontext
+
+from django.db import transaction
+from rest_framework import serializers
+from rest_framework.exceptions import ValidationError
+
+from .chart import invalidate_chart
+from .events import publish_resync
+from .models import Allergy, Appointment, Diagnosis, Medication, Patient, ProgressNote
+from .serializers import AppointmentSerializer, ProgressNoteSerializer
+from .stats import update_patient_stats
+
+
+# Relations are taken as raw ids and checked per batch, instead of one lookup per row and per M2M item
+class AppointmentImportSerializer(AppointmentSerializer):
+    patient = serializers.IntegerField(source='patient_id')
+    # Historical schedules are taken as-is, an overlap query per row would dominate the import
+    check_overlaps = False
+
+
+class ProgressNoteImportSerializer(ProgressNoteSerializer):
+    patient = serializers.IntegerField(source='patient_id')
+    created_at = serializers.DateTimeField(required=False)
+    allergies = serializers.ListField(child=serializers.IntegerField(), required=False)
+    medication = serializers.ListField(child=serializers.IntegerField(), required=False)
+    diagnoses = serializers.ListField(child=serializers.IntegerField(), required=False)
+
+
+class BulkImporter:
+    model = None
+    serializer_class = None
+    related_fields = {}
+    many_related_fields = {}
+
+    def __init__(self, batch_size=1000):
+        self.batch_size = batch_size
+
+    def batches(self, rows):
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= self.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def existing_ids(self, model, ids):
+        return set(model.objects.filter(pk__in=ids).values_list('pk', flat=True))
+
+    def validate_batch(self, rows):
+        """Return (validated_data or None, errors) for every row"""
+        # One child serializer validates the whole batch, like ListSerializer but keeping per-row results
+        child = self.serializer_class(many=True).child
+        results = []
+        for row in rows:
+            try:
+                results.append((child.run_validation(row), {}))
+            except ValidationError as exc:
+                results.append((None, serializers.as_serializer_error(exc)))
+
+        fields = list(self.related_fields) + list(self.many_related_fields)
+        known = {}
+        for field in fields:
+            model = self.related_fields.get(field) or self.many_related_fields[field]
+            ids = set()
+            for data, errors in results:
+                if data is not None:
+                    ids.update(self.related_ids(data, field))
+            known[field] = self.existing_ids(model, ids)
+
+        checked = []
+        for data, errors in results:
+            if data is not None:
+                for field in fields:
+                    missing = [pk for pk in self.related_ids(data, field) if pk not in known[field]]
+                    if missing:
+                        errors[field] = ['Invalid pk "%s" - object does not exist.' % pk for pk in missing]
+                if errors:
+                    data = None
+            checked.append((data, errors))
+        return checked
+
+    def related_ids(self, data, field):
+        if field in self.related_fields:
+            value = data.get(field + '_id')
+            return [] if value is None else [value]
+        return data.get(field) or []
+
+    def build(self, data):
+        return self.model(**{k: v for k, v in data.items() if k not in self.many_related_fields})
+
+    def create_batch(self, validated):
+        instances = self.model.objects.bulk_create(
+            [self.build(data) for data in validated], batch_size=self.batch_size)
+        for field in self.many_related_fields:
+            through = getattr(self.model, field).through
+            remote = getattr(self.model, field).field
+            source, target = remote.m2m_column_name(), remote.m2m_reverse_name()
+            through.objects.bulk_create([
+                through(**{source: instance.pk, target: pk})
+                for instance, data in zip(instances, validated)
+                for pk in dict.fromkeys(data.get(field) or [])
+            ], batch_size=self.batch_size)
+        return instances
+
+    def run(self, rows, atomic=False, dry_run=False):
+        """
+        Validate and insert rows in batches and return {'created': n, 'errors': [...]}.
+        Each batch commits on its own unless atomic is set, in which case nothing is kept if any row fails.
+        """
+        created, report = 0, []
+        with transaction.atomic() if atomic else nullcontext():
+            for index, batch in enumerate(self.batches(rows)):
+                checked = self.validate_batch(batch)
+                report += [{'row': index * self.batch_size + i, 'errors': errors}
+                           for i, (data, errors) in enumerate(checked) if errors]
+                validated = [data for data, errors in checked if data is not None]
+                if validated and not dry_run:
+                    with transaction.atomic():
+                        created += len(self.create_batch(validated))
+            if atomic and report:
+                transaction.set_rollback(True)
+                created = 0
+        return {'created': created, 'errors': report}
+
+
+class AppointmentImporter(BulkImporter):
+    model = Appointment
+    serializer_class = AppointmentImportSerializer
+    related_fields = {'patient': Patient}
+
+    def create_batch(self, validated):
+        instances = super().create_batch(validated)
+        # bulk_create sends no post_save, open event streams resync instead
+        publish_resync()
+        patient_ids = {instance.patient_id for instance in instances}
+        update_patient_stats(patient_ids)
+        for patient_id in patient_ids:
+            invalidate_chart(patient_id)
+        return instances
+
+
+class ProgressNoteImporter(BulkImporter):
+    model = ProgressNote
+    serializer_class = ProgressNoteImportSerializer
+    related_fields = {'patient': Patient}
+    many_related_fields = {'allergies': Allergy, 'medication': Medication, 'diagnoses': Diagnosis}
+
+    def create_batch(self, validated):
+        instances = super().create_batch(validated)
+        # auto_now_add overwrites created_at on insert, restore the historical timestamps afterwards
+        dated = []
+        for instance, data in zip(instances, validated):
+            if data.get('created_at'):
+                instance.created_at = data['created_at']
+                dated.append(instance)
+        ProgressNote.objects.bulk_update(dated, ['created_at'], batch_size=self.batch_size)
+        # bulk_create sends no post_save
+        for patient_id in {instance.patient_id for instance in instances}:
+            invalidate_chart(patient_id)
+        return instances
+
+
+IMPORTERS = {
+    'appointments': AppointmentImporter,
+    'progress_notes': ProgressNoteImporter,
+}
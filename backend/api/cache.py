@@ -0,0 +1,82 @@
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS
+from django.utils.cache import patch_cache_control
+from django.utils.http import parse_etags
+from rest_framework import status
+from rest_framework.response import Response
+
+
+def get_cache():
+    return caches[settings.API_CACHE_ALIAS]
+
+
+def version_key(model):
+    return 'api:version:%s' % model._meta.db_table
+
+
+def get_version(model):
+    return get_key_version(version_key(model))
+
+
+def bump_version(model):
+    return bump_key_version(version_key(model))
+
+
+def get_key_version(key):
+    cache = get_cache()
+    version = cache.get(key)
+    if version is None:
+        # Seed from the clock so a cleared cache never reissues a version clients already hold
+        version = time.time_ns()
+        if not cache.add(key, version, timeout=None):
+            version = cache.get(key, version)
+    return version
+
+
+def bump_key_version(key):
+    cache = get_cache()
+    try:
+        return cache.incr(key)
+    except ValueError:
+        version = time.time_ns()
+        cache.set(key, version, timeout=None)
+        return version
+
+
+class VersionedListCacheMixin:
+    """
+    Serve list responses from a cache keyed on the table's version, and answer
+    If-None-Match with a 304. Writes to the table bump the version (see api.signals).
+    """
+
+    def get_queryset(self):
+        # Rebuilds follow version bumps closely, a lagging replica would cache stale rows under the new version
+        return super().get_queryset().using(DEFAULT_DB_ALIAS)
+
+    def get_cache_etag(self, request, version):
+        path = hashlib.md5(request.get_full_path().encode()).hexdigest()
+        return '"%s-%s-%s"' % (self.queryset.model._meta.model_name, version, path)
+
+    def finalize_cached_response(self, response, etag):
+        response['ETag'] = etag
+        patch_cache_control(response, private=True, no_cache=True)
+        return response
+
+    def list(self, request, *args, **kwargs):
+        version = get_version(self.queryset.model)
+        etag = self.get_cache_etag(request, version)
+        if_none_match = parse_etags(request.headers.get('If-None-Match', ''))
+        if etag in if_none_match or '*' in if_none_match:
+            return self.finalize_cached_response(Response(status=status.HTTP_304_NOT_MODIFIED), etag)
+
+        cache = get_cache()
+        key = 'api:list:%s' % etag
+        data = cache.get(key)
+        if data is None:
+            data = super().list(request, *args, **kwargs).data
+            cache.set(key, data, timeout=settings.API_CACHE_TIMEOUT)
+        return self.finalize_cached_response(Response(data), etag)
@@ -0,0 +1,50 @@
+"""
+Delta sync for appointments.
+
+A cursor is the server time a sync started, in microseconds. Changes since a cursor are appointments
+(or their patients) with updated_at after it, and tombstones for appointments deleted or moved away
+from where they were. Each poll re-reads the last OVERLAP so rows from transactions that were still
+open when the previous poll ran aren't missed; clients upsert by id, so repeats are harmless.
+"""
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import AppointmentTombstone
+
+OVERLAP = timedelta(seconds=5)
+# Tombstones are pruned after this, older cursors have to start over with a full sync
+RETENTION = timedelta(days=7)
+
+
+def encode_cursor(moment):
+    delta = moment - datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+    return str(delta // timedelta(microseconds=1))
+
+
+def decode_cursor(value):
+    """Raises ValueError for anything encode_cursor couldn't have produced"""
+    if not value.isdigit():
+        raise ValueError(value)
+    return datetime(1970, 1, 1, tzinfo=dt_timezone.utc) + timedelta(microseconds=int(value))
+
+
+def is_expired(since, now=None):
+    return since < (now or timezone.now()) - RETENTION
+
+
+def changed_since(queryset, since):
+    """Appointments in queryset whose representation may have changed after since"""
+    since = since - OVERLAP
+    return queryset.filter(Q(updated_at__gt=since) | Q(patient__updated_at__gt=since))
+
+
+def removed_since(tombstones, since):
+    """Ids of appointments deleted or moved away after since, from the AppointmentTombstone queryset"""
+    tombstones = tombstones.filter(removed_at__gt=since - OVERLAP)
+    return sorted(set(tombstones.values_list('appointment_id', flat=True)))
+
+
+def prune_tombstones(now=None):
+    return AppointmentTombstone.objects.filter(removed_at__lt=(now or timezone.now()) - RETENTION).delete()[0]
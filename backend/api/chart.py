@@ -0,0 +1,87 @@
+"""
+Patient chart summary (PatientChart): the patient, latest vitals, allergies/medication/diagnoses
+across all their progress notes and appointment counts, in one response.
+
+Built with a fixed number of queries whatever the patient's history, and cached per patient
+under a version that api.signals bumps when the patient, their appointments or their notes
+change. Vocabulary renames are picked up through the vocabulary tables' versions. Charts are
+built from the default database, a lagging replica would cache stale rows under the new version.
+"""
+import hashlib
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.db.models import Count, Max
+from django.utils import timezone
+
+from .cache import bump_key_version, get_cache, get_key_version, get_version
+from .models import Allergy, Appointment, AppointmentHistory, Diagnosis, InsuranceProvider, Medication, Patient, ProgressNote
+from .serializers import PatientSerializer
+from .vitals import VITALS, bmi_expression, rounded
+
+VOCABULARIES = {'allergies': Allergy, 'medication': Medication, 'diagnoses': Diagnosis}
+VERSION_MODELS = [InsuranceProvider, Allergy, Medication, Diagnosis]
+
+
+def chart_version_key(patient_id):
+    return 'api:chart-version:%s' % patient_id
+
+
+def invalidate_chart(patient_id):
+    # Bumped again on commit, like bump_cache_version, so a chart rebuilt from pre-commit rows isn't kept
+    bump_key_version(chart_version_key(patient_id))
+    transaction.on_commit(lambda: bump_key_version(chart_version_key(patient_id)))
+
+
+def build_chart(patient):
+    notes = ProgressNote.objects.using(DEFAULT_DB_ALIAS).filter(patient=patient)
+    latest = (notes.annotate(bmi=bmi_expression()).order_by('-created_at', '-id')
+              .values('id', 'created_at', *VITALS).first())
+    if latest is not None:
+        latest = {'note': latest['id'], 'created_at': latest['created_at'],
+                  **dict(zip(VITALS, rounded(latest[name] for name in VITALS)))}
+
+    chart = {'patient': dict(PatientSerializer(patient).data), 'latest_vitals': latest}
+    for field, model in VOCABULARIES.items():
+        # One row per item however many notes list it, most recently noted first
+        chart[field] = list(model.objects.using(DEFAULT_DB_ALIAS).filter(progressnote__patient=patient)
+                            .values('id', 'name')
+                            .annotate(last_noted=Max('progressnote__created_at'), notes=Count('progressnote'))
+                            .order_by('-last_noted', 'name'))
+
+    chart['appointments'] = {
+        # Archived appointments included
+        'total': AppointmentHistory.objects.using(DEFAULT_DB_ALIAS).filter(patient=patient).count(),
+        # Kept as times, counts are taken at read time so they stay right while cached
+        'upcoming': list(Appointment.objects.using(DEFAULT_DB_ALIAS)
+                         .filter(patient=patient, start__gt=timezone.now()).order_by('start')
+                         .values_list('start', flat=True)),
+    }
+    return chart
+
+
+def chart_summary(patient_id):
+    """(chart, etag) for the patient, or (None, None) if there's no such patient"""
+    versions = [get_key_version(chart_version_key(patient_id))] + [get_version(model) for model in VERSION_MODELS]
+    key = 'api:chart:%s:%s' % (patient_id, '-'.join(str(version) for version in versions))
+    cache = get_cache()
+    chart = cache.get(key)
+    if chart is None:
+        patient = (Patient.objects.using(DEFAULT_DB_ALIAS).select_related('insurance_provider')
+                   .filter(pk=patient_id).first())
+        if patient is None:
+            return None, None
+        chart = build_chart(patient)
+        cache.set(key, chart, timeout=settings.API_CACHE_TIMEOUT)
+
+    now = timezone.now()
+    upcoming = [start for start in chart['appointments']['upcoming'] if start > now]
+    total = chart['appointments']['total']
+    response = dict(chart, appointments={
+        'total': total,
+        'upcoming': len(upcoming),
+        'past': total - len(upcoming),
+        'next': upcoming[0] if upcoming else None,
+    })
+    etag = '"%s"' % hashlib.md5(('%s|%d' % (key, len(upcoming))).encode()).hexdigest()
+    return response, etag
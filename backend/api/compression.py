@@ -0,0 +1,125 @@
+import gzip
+import re
+
+import brotli
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.utils.cache import patch_vary_headers
+
+
+def compress_gzip(content):
+    return gzip.compress(content, compresslevel=6, mtime=0)
+
+
+def compress_brotli(content):
+    # Quality 5 is close to gzip's speed with noticeably smaller output, 11 is for static files
+    return brotli.compress(content, quality=5)
+
+
+CODINGS = {'gzip': compress_gzip, 'br': compress_brotli}
+ETAG_CODING = re.compile(r'-(%s)"' % '|'.join(CODINGS))
+
+
+def encoded_etag(etag, coding):
+    """'"abc"' -> '"abc-br"': each encoding is a different byte stream, so it gets its own strong ETag"""
+    if coding is None or not etag.startswith('"'):
+        return etag
+    return '%s-%s"' % (etag[:-1], coding)
+
+
+def strip_etag_codings(header):
+    """(header without encoded_etag suffixes, set of the codings they named)"""
+    codings = set(ETAG_CODING.findall(header))
+    return ETAG_CODING.sub('"', header), codings
+
+
+def choose_coding(accept_encoding, codings):
+    """Highest q-value coding the client accepts, brotli winning ties"""
+    weights, default = {}, 0.0
+    for part in accept_encoding.split(','):
+        coding, _, params = part.strip().partition(';')
+        coding, q = coding.strip().lower(), 1.0
+        param, _, value = params.strip().partition('=')
+        if param.strip() == 'q':
+            try:
+                q = float(value)
+            except ValueError:
+                continue
+        if coding == '*':
+            default = q
+        elif coding:
+            weights[coding] = q
+    ranked = sorted(((weights.get(coding, default), coding == 'br', coding) for coding in codings), reverse=True)
+    if ranked and ranked[0][0] > 0:
+        return ranked[0][2]
+    return None
+
+
+class CompressionMiddleware:
+    """
+    gzip/brotli for /api/ responses of at least API_COMPRESS_MIN_SIZE bytes, negotiated on Accept-Encoding.
+    Streaming responses (exports have their own ?gzip=1) and auth endpoints, where responses hold tokens, are skipped.
+    Compressed responses get a per-encoding ETag suffix, which is stripped from If-None-Match/If-Match
+    before the view compares them, like Apache's mod_deflate does.
+    """
+    skip_prefixes = ('/api/auth/',)
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not settings.API_COMPRESSION:
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def applies(self, request):
+        return request.path.startswith('/api/') and not request.path.startswith(self.skip_prefixes)
+
+    def strip_conditions(self, request):
+        """Drop encoded_etag suffixes from the request's conditional headers, returns the codings they named"""
+        codings = set()
+        for header in ('HTTP_IF_NONE_MATCH', 'HTTP_IF_MATCH'):
+            if header in request.META:
+                request.META[header], found = strip_etag_codings(request.META[header])
+                codings |= found
+        return codings
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        if not self.applies(request):
+            return self.get_response(request)
+        codings = self.strip_conditions(request)
+        return self.compress(request, self.get_response(request), codings)
+
+    async def __acall__(self, request):
+        if not self.applies(request):
+            return await self.get_response(request)
+        codings = self.strip_conditions(request)
+        return self.compress(request, await self.get_response(request), codings)
+
+    def compress(self, request, response, codings):
+        if response.status_code == 304 and len(codings) == 1 and response.has_header('ETag'):
+            # The client revalidated the encoded copy it holds
+            response['ETag'] = encoded_etag(response['ETag'], codings.pop())
+            return response
+        if response.streaming or response.has_header('Content-Encoding') or \
+                len(response.content) < settings.API_COMPRESS_MIN_SIZE:
+            return response
+
+        patch_vary_headers(response, ('Accept-Encoding',))
+        coding = choose_coding(request.headers.get('Accept-Encoding', ''), CODINGS)
+        if coding is None:
+            return response
+        compressed = CODINGS[coding](response.content)
+        if len(compressed) >= len(response.content):
+            return response
+        response.content = compressed
+        response['Content-Length'] = str(len(compressed))
+        response['Content-Encoding'] = coding
+        if response.has_header('ETag'):
+            response['ETag'] = encoded_etag(response['ETag'], coding)
+        return response
@@ -0,0 +1,85 @@
+import hashlib
+
+from django.db import transaction
+from django.utils.http import http_date, parse_etags, parse_http_date_safe
+from rest_framework import status
+from rest_framework.response import Response
+
+from .cache import get_version
+
+
+class ConditionalDetailMixin:
+    """
+    ETag/Last-Modified for detail views, computed from updated_at columns without loading the object.
+    GET answers If-None-Match/If-Modified-Since with 304, writes with a stale If-Match get 412.
+    ETags differ per ?fields=/?expand=, an If-Match has to come from a GET of the URL being written.
+    """
+    # updated_at columns of the row and any rows nested in its representation
+    modified_fields = ('updated_at',)
+    # Vocabulary tables nested in the representation, tracked by their cache version
+    version_models = ()
+    precondition_failed_message = 'This record was changed by someone else, reload and try again.'
+
+    def get_representation(self):
+        params = self.request.query_params
+        return '&'.join('%s=%s' % (name, params[name]) for name in ('fields', 'expand') if name in params)
+
+    def get_validators(self, representation='', lock=False):
+        lookup = {self.lookup_field: self.kwargs[self.lookup_url_kwarg or self.lookup_field]}
+        rows = self.get_queryset().model.objects.filter(**lookup)
+        if lock:
+            # Held until the write commits, so a second writer with the same ETag sees the new one
+            rows = rows.select_for_update(of=('self',))
+        row = rows.values_list(*self.modified_fields).first()
+        if row is None:
+            return None, None
+        last_modified = max(value for value in row if value is not None)
+        parts = [value.isoformat() for value in row if value is not None]
+        parts += [str(get_version(model)) for model in self.version_models]
+        parts.append(representation)
+        etag = '"%s"' % hashlib.md5('|'.join(parts).encode()).hexdigest()
+        return etag, last_modified
+
+    def set_validators(self, response, etag, last_modified):
+        if etag is not None:
+            response['ETag'] = etag
+            response['Last-Modified'] = http_date(last_modified.timestamp())
+        return response
+
+    def not_modified(self, request, etag, last_modified):
+        if_none_match = request.headers.get('If-None-Match')
+        if if_none_match is not None:
+            etags = parse_etags(if_none_match)
+            return etag in etags or '*' in etags
+        if_modified_since = parse_http_date_safe(request.headers.get('If-Modified-Since', ''))
+        return if_modified_since is not None and int(last_modified.timestamp()) <= if_modified_since
+
+    def precondition_failed(self, request, etag):
+        if_match = request.headers.get('If-Match')
+        if if_match is None:
+            return False
+        etags = parse_etags(if_match)
+        return etag is None or not (etag in etags or '*' in etags)
+
+    def retrieve(self, request, *args, **kwargs):
+        etag, last_modified = self.get_validators(self.get_representation())
+        if etag is not None and self.not_modified(request, etag, last_modified):
+            return self.set_validators(Response(status=status.HTTP_304_NOT_MODIFIED), etag, last_modified)
+        response = super().retrieve(request, *args, **kwargs)
+        return self.set_validators(response, etag, last_modified)
+
+    def update(self, request, *args, **kwargs):
+        with transaction.atomic():
+            if self.precondition_failed(request, self.get_validators(self.get_representation(), lock=True)[0]):
+                return Response({'detail': self.precondition_failed_message},
+                                status=status.HTTP_412_PRECONDITION_FAILED)
+            response = super().update(request, *args, **kwargs)
+        # Writes respond with the full representation
+        return self.set_validators(response, *self.get_validators())
+
+    def destroy(self, request, *args, **kwargs):
+        with transaction.atomic():
+            if self.precondition_failed(request, self.get_validators(self.get_representation(), lock=True)[0]):
+                return Response({'detail': self.precondition_failed_message},
+                                status=status.HTTP_412_PRECONDITION_FAILED)
+            return super().destroy(request, *args, **kwargs)
@@ -0,0 +1,245 @@
+"""
+Appointment events pushed to open /api/appointments/events streams.
+
+api.signals publishes an event after each committed appointment create, update or delete. Events go
+through a broker picked by EVENTS_URL: local:// fans them out to streams in this process only,
+redis://... shares them between workers over Redis pub/sub (needs the redis package).
+"""
+import asyncio
+import json
+import threading
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from rest_framework import serializers
+
+from .changes import encode_cursor
+from .renderers import FastJSONRenderer
+from .serializers import AppointmentSerializer
+
+try:
+    import redis
+    import redis.asyncio
+except ImportError:  # optional, local:// only without it
+    redis = None
+
+APPOINTMENTS = 'api:events:appointments'
+
+
+class Subscription:
+    """Messages for one stream, read on the event loop that subscribed"""
+
+    def __init__(self, broker, channel, max_pending):
+        self.broker = broker
+        self.channel = channel
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue()
+        self.max_pending = max_pending
+        self.overflowed = False
+
+    def deliver(self, message):
+        if self.overflowed:
+            return
+        if self.queue.qsize() >= self.max_pending:
+            # Too far behind, the stream tells its client to resync instead of buffering without bound
+            self.overflowed = True
+            message = None
+        self.queue.put_nowait(message)
+
+    async def get(self):
+        """The next message, or None once messages were lost and the client has to resync"""
+        return await self.queue.get()
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+
+class LocalBroker:
+    """Delivers to subscriptions in this process. publish() can be called from any thread."""
+    max_pending = 1000
+
+    def __init__(self, url='local://'):
+        self.url = url
+        self.lock = threading.Lock()
+        self.subscriptions = {}
+
+    def publish(self, channel, message):
+        with self.lock:
+            subscriptions = list(self.subscriptions.get(channel, ()))
+        for subscription in subscriptions:
+            try:
+                subscription.loop.call_soon_threadsafe(subscription.deliver, message)
+            except RuntimeError:
+                # Its event loop is gone
+                self.unsubscribe(subscription)
+
+    def has_subscribers(self, channel):
+        return bool(self.subscriptions.get(channel))
+
+    def subscribe(self, channel):
+        subscription = Subscription(self, channel, self.max_pending)
+        with self.lock:
+            self.subscriptions.setdefault(channel, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            self.subscriptions.get(subscription.channel, set()).discard(subscription)
+
+    def reset(self, channel):
+        """Make every subscriber of channel resync, for when messages may have been lost"""
+        with self.lock:
+            subscriptions = list(self.subscriptions.get(channel, ()))
+        for subscription in subscriptions:
+            subscription.loop.call_soon_threadsafe(subscription.deliver, None)
+
+
+class RedisBroker(LocalBroker):
+    """
+    Publishes to Redis. Each process runs one listener task per channel, on the event loop that
+    subscribed first, and hands what it receives to its local subscriptions.
+    """
+
+    def __init__(self, url):
+        if redis is None:
+            raise ImproperlyConfigured('EVENTS_URL %s needs the redis package' % url)
+        super().__init__(url)
+        self.client = redis.Redis.from_url(url)
+        self.listeners = {}
+
+    def publish(self, channel, message):
+        self.client.publish(channel, message)
+
+    def has_subscribers(self, channel):
+        # Streams in other processes can't be seen from here
+        return True
+
+    def subscribe(self, channel):
+        subscription = super().subscribe(channel)
+        listener = self.listeners.get(channel)
+        if listener is None or listener.done() or listener.get_loop() is not subscription.loop:
+            self.listeners[channel] = subscription.loop.create_task(self.listen(channel))
+        return subscription
+
+    async def listen(self, channel):
+        pubsub = redis.asyncio.Redis.from_url(self.url).pubsub()
+        try:
+            await pubsub.subscribe(channel)
+            async for message in pubsub.listen():
+                if message['type'] == 'message':
+                    super().publish(channel, message['data'])
+        finally:
+            # Whatever was published while the connection was down is lost
+            self.reset(channel)
+            await pubsub.aclose()
+
+
+_broker = None
+
+
+def get_broker():
+    global _broker
+    if _broker is None or _broker.url != settings.EVENTS_URL:
+        url = settings.EVENTS_URL
+        if url.startswith('local://'):
+            _broker = LocalBroker(url)
+        elif url.startswith(('redis://', 'rediss://', 'unix://')):
+            _broker = RedisBroker(url)
+        else:
+            raise ImproperlyConfigured('Unknown EVENTS_URL scheme: %s' % url)
+    return _broker
+
+
+def encode_event(event):
+    return FastJSONRenderer().render(event)
+
+
+def decode_event(message):
+    return json.loads(message)
+
+
+def publish_resync():
+    """For writes that skip the per-row signals (bulk_create), every stream's client resyncs once this commits"""
+    transaction.on_commit(lambda: get_broker().publish(
+        APPOINTMENTS, encode_event({'action': 'resync', 'cursor': encode_cursor(timezone.now())})), robust=True)
+
+
+def publish_appointment(action, instance, previous=None):
+    """
+    Publish action ('created', 'updated' or 'deleted') once the current transaction commits.
+    previous is the (start, patient_id) the appointment had before a move, so streams filtered
+    on where it was can drop it.
+    Nothing is serialized without a stream to send it to, and a broker that fails to publish is logged
+    rather than failing the request that already committed.
+    """
+    field = serializers.DateTimeField()
+    event = {'action': action, 'id': instance.pk, 'start': field.to_representation(instance.start),
+             'patient': instance.patient_id}
+    if previous is not None and previous != (instance.start, instance.patient_id):
+        event['previous'] = {'start': field.to_representation(previous[0]), 'patient': previous[1]}
+
+    def send():
+        broker = get_broker()
+        if not broker.has_subscribers(APPOINTMENTS):
+            return
+        event['cursor'] = encode_cursor(timezone.now())
+        if action != 'deleted':
+            event['appointment'] = AppointmentSerializer(instance).data
+        broker.publish(APPOINTMENTS, encode_event(event))
+    transaction.on_commit(send, robust=True)
+
+
+def format_sse(event, data, id=None):
+    lines = [b'event: ' + event.encode()]
+    if id is not None:
+        lines.append(b'id: ' + id.encode())
+    lines.append(b'data: ' + data)
+    return b'\n'.join(lines) + b'\n\n'
+
+
+def appointment_matches(event, start_range, patient):
+    """Whether the appointment is, or was before this event, in the stream's start range/patient"""
+    positions = [event] + ([event['previous']] if 'previous' in event else [])
+    for position in positions:
+        start = parse_datetime(position['start'])
+        if start_range is not None and (start_range.start is not None and start < start_range.start or
+                                        start_range.stop is not None and start > start_range.stop):
+            continue
+        if patient is not None and position['patient'] != patient:
+            continue
+        return True
+    return False
+
+
+async def appointment_stream(start_range=None, patient=None, heartbeat=15):
+    """
+    Server-Sent Events for one client, for EVENTS_STREAM_SECONDS. Starts with a 'ready' event holding
+    a change feed cursor, then 'appointment' events with their cursor as id. 'resync' means events were
+    missed, the client catches up with /api/appointments/changes?since=<last cursor>.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + settings.EVENTS_STREAM_SECONDS
+    subscription = get_broker().subscribe(APPOINTMENTS)
+    try:
+        # retry: how long EventSource waits before reconnecting once the stream ends
+        yield b'retry: 1000\n' + format_sse('ready', encode_event({'cursor': encode_cursor(timezone.now())}))
+        while loop.time() < deadline:
+            try:
+                message = await asyncio.wait_for(subscription.get(), min(heartbeat, deadline - loop.time()))
+            except asyncio.TimeoutError:
+                # Keeps proxies from timing out idle connections
+                yield b': keepalive\n\n'
+                continue
+            if message is None:
+                yield format_sse('resync', encode_event({}))
+                return
+            event = decode_event(message)
+            if event['action'] == 'resync':
+                yield format_sse('resync', message, event['cursor'])
+            elif appointment_matches(event, start_range, patient):
+                yield format_sse('appointment', message, event['cursor'])
+    finally:
+        subscription.close()
@@ -0,0 +1,156 @@
+import csv
+import json
+import zlib
+from collections import defaultdict
+from datetime import date, datetime
+from decimal import Decimal
+from itertools import islice
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from .models import AppointmentHistory, Patient, ProgressNote
+
+PATIENT_COLUMNS = ['first_name', 'last_name', 'email', 'phone', 'dob', 'sex', 'is_new',
+                   'insurance_provider__name', 'insurance_member_id']
+
+
+class Exporter:
+    """
+    Flat rows for one model, read with QuerySet.iterator(chunk_size=...) so memory stays flat.
+    M2M names are fetched with one query per relation per chunk.
+    """
+    model = None
+    columns = []
+    many_related_fields = []
+
+    def __init__(self, chunk_size=2000):
+        self.chunk_size = chunk_size
+
+    def get_queryset(self):
+        return self.model.objects.order_by('pk').values('id', *self.columns)
+
+    def header(self):
+        return ['id'] + [c.replace('__', '_') for c in self.columns] + self.many_related_fields
+
+    def many_related_names(self, field, ids):
+        remote = getattr(self.model, field).field
+        source, target = remote.m2m_field_name(), remote.m2m_reverse_field_name()
+        names = defaultdict(list)
+        rows = (getattr(self.model, field).through.objects
+                .filter(**{source + '_id__in': ids})
+                .order_by(target + '__name')
+                .values_list(source + '_id', target + '__name'))
+        for pk, name in rows:
+            names[pk].append(name)
+        return names
+
+    def rows(self):
+        iterator = self.get_queryset().iterator(chunk_size=self.chunk_size)
+        while True:
+            chunk = list(islice(iterator, self.chunk_size))
+            if not chunk:
+                return
+            ids = [row['id'] for row in chunk]
+            related = {field: self.many_related_names(field, ids) for field in self.many_related_fields}
+            for row in chunk:
+                values = [row['id']] + [row[c] for c in self.columns]
+                values += [related[field].get(row['id'], []) for field in self.many_related_fields]
+                yield values
+
+
+class PatientExporter(Exporter):
+    model = Patient
+    columns = PATIENT_COLUMNS + ['updated_at']
+
+
+class AppointmentExporter(Exporter):
+    # Archived appointments included
+    model = AppointmentHistory
+    columns = ['start', 'end', 'status', 'notes', 'created_at', 'updated_at', 'patient_id'] + \
+        ['patient__' + c for c in PATIENT_COLUMNS]
+
+
+class ProgressNoteExporter(Exporter):
+    model = ProgressNote
+    columns = ['created_at', 'updated_at', 'weight', 'height', 'blood_pressure_sys', 'blood_pressure_dia',
+               'chief_complaint', 'medical_history', 'treatment', 'doctors_orders', 'patient_id'] + \
+        ['patient__' + c for c in PATIENT_COLUMNS]
+    many_related_fields = ['allergies', 'medication', 'diagnoses']
+
+
+EXPORTERS = {
+    'patients': PatientExporter,
+    'appointments': AppointmentExporter,
+    'progress_notes': ProgressNoteExporter,
+}
+
+
+def format_value(value):
+    # Same representations the API uses
+    if isinstance(value, datetime):
+        value = value.isoformat()
+        return value[:-6] + 'Z' if value.endswith('+00:00') else value
+    if isinstance(value, date):
+        return value.strftime(settings.REST_FRAMEWORK['DATE_FORMAT'])
+    if isinstance(value, Decimal):
+        return str(value)
+    return value
+
+
+class Echo:
+    def write(self, value):
+        return value
+
+
+def csv_lines(exporter):
+    writer = csv.writer(Echo())
+    yield writer.writerow(exporter.header())
+    for values in exporter.rows():
+        yield writer.writerow([
+            ';'.join(v) if isinstance(v, list) else ('' if v is None else format_value(v))
+            for v in values])
+
+
+def ndjson_lines(exporter):
+    header = exporter.header()
+    for values in exporter.rows():
+        yield json.dumps(dict(zip(header, map(format_value, values)))) + '\n'
+
+
+FORMATS = {
+    'csv': (csv_lines, 'text/csv'),
+    'ndjson': (ndjson_lines, 'application/x-ndjson'),
+}
+
+
+def gzip_stream(lines, buffer_size=64 * 1024):
+    compressor = zlib.compressobj(wbits=zlib.MAX_WBITS | 16)
+    pending, size = [], 0
+    for line in lines:
+        pending.append(line.encode())
+        size += len(pending[-1])
+        if size >= buffer_size:
+            yield compressor.compress(b''.join(pending))
+            pending, size = [], 0
+    yield compressor.compress(b''.join(pending)) + compressor.flush()
+
+
+async def aiterate(iterator, batch_size=100):
+    """
+    Async iterator over a sync one for StreamingHttpResponse under ASGI, which would otherwise
+    collect a sync iterator with sync_to_async(list) before sending anything. Items are pulled
+    batch_size at a time in the sync thread, where the exporter's database cursor lives.
+    """
+    next_batch = sync_to_async(lambda: list(islice(iterator, batch_size)), thread_sensitive=True)
+    try:
+        while True:
+            batch = await next_batch()
+            if not batch:
+                return
+            for item in batch:
+                yield item
+    finally:
+        # Client gone mid-export: release the cursor
+        if hasattr(iterator, 'close'):
+            await sync_to_async(iterator.close, thread_sensitive=True)()
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+
+from api.archive import archivable, archive_batch, archive_horizon
+
+
+class Command(BaseCommand):
+    help = 'Move completed appointments that ended more than APPOINTMENT_ARCHIVE_DAYS ago to the archive table, in batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Appointments moved per transaction')
+        parser.add_argument('--dry-run', action='store_true', help='Only count what would be archived')
+
+    def handle(self, *args, **options):
+        before = archive_horizon()
+        if options['dry_run']:
+            self.stdout.write('%d appointments would be archived' % archivable(before).count())
+            return
+        total = 0
+        while True:
+            moved = archive_batch(before, options['batch_size'])
+            if not moved:
+                break
+            total += moved
+            self.stdout.write('Archived %d appointments' % total)
+        self.stdout.write(self.style.SUCCESS('Archived %d appointments done before %s' % (total, before.date())))
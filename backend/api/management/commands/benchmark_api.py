@@ -0,0 +1,246 @@
+import json
+import math
+import time
+from collections import defaultdict, namedtuple
+from datetime import timedelta
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Count
+from django.test import Client
+from django.urls import URLPattern, resolve
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+
+from api import urls as api_urls
+from api.changes import encode_cursor
+from api.models import Allergy, Appointment, Diagnosis, InsuranceProvider, Medication, Patient, ProgressNote
+
+# body is a dict/list or a callable taking the context, max_iterations caps slow endpoints like exports
+Scenario = namedtuple('Scenario', ['name', 'method', 'url', 'body', 'max_iterations'], defaults=[None, None])
+
+
+def future_slot(ctx, offset):
+    # Far enough ahead to never overlap seeded appointments, one hour apart per request
+    start = ctx['far_future'] + timedelta(hours=offset)
+    return {'patient': ctx['patient'], 'start': start.isoformat(), 'end': (start + timedelta(minutes=30)).isoformat()}
+
+
+def progress_note(ctx):
+    return {'patient': ctx['patient'], 'weight': '150.00', 'height': '170.00', 'blood_pressure_sys': 120,
+            'blood_pressure_dia': 80, 'chief_complaint': 'Benchmark',
+            'allergies': ctx['allergies'], 'medication': ctx['medication'], 'diagnoses': ctx['diagnoses']}
+
+
+SCENARIOS = [
+    Scenario('ping', 'get', '/api/ping'),
+    Scenario('auth_token_login', 'post', '/api/auth/token/login/',
+             lambda ctx: {'username': ctx['username'], 'password': ctx['password']}, max_iterations=5),
+    Scenario('auth_users_me', 'get', '/api/auth/users/me/'),
+    Scenario('appointments', 'get', '/api/appointments?limit=100&ordering=start'),
+    Scenario('appointments_cursor', 'get', '/api/appointments?pagination=cursor&ordering=start'),
+    Scenario('appointments_sparse', 'get', '/api/appointments?limit=100&ordering=start&fields=id,start,status'),
+    Scenario('appointments_by_patient', 'get', '/api/appointments?patient={heavy_patient}'),
+    Scenario('appointment_create', 'post', '/api/appointments', lambda ctx: future_slot(ctx, ctx['n'])),
+    Scenario('appointments_bulk_dry_run', 'post', '/api/appointments/bulk?dry_run=1',
+             lambda ctx: [future_slot(ctx, 100000 + i) for i in range(100)]),
+    Scenario('appointments_changes_full', 'get', '/api/appointments/changes?start_after={month_ago}&start_before={today}'),
+    Scenario('appointments_changes_quiet', 'get',
+             '/api/appointments/changes?start_after={today}&start_before={today}&since={cursor}'),
+    Scenario('appointments_occupancy', 'get',
+             '/api/appointments/occupancy?start_after={month_ago}&start_before={today}&interval=day'),
+    Scenario('appointments_free_slots', 'get',
+             '/api/appointments/free_slots?start={now}&end={week_ahead}&duration=30'),
+    Scenario('appointment_detail', 'get', '/api/appointments/{appointment}'),
+    Scenario('appointment_update', 'patch', '/api/appointments/{appointment}',
+             lambda ctx: {'notes': 'Benchmark %d' % ctx['n']}),
+    Scenario('patients', 'get', '/api/patients?limit=100'),
+    Scenario('patients_search', 'get', '/api/patients?search=smi&limit=20'),
+    Scenario('patients_not_seen', 'get', '/api/patients?last_visit_before={quarter_ago}&ordering=last_visit&limit=100'),
+    Scenario('patients_by_no_show_rate', 'get', '/api/patients?visit_count_min=5&ordering=-no_show_rate&limit=100'),
+    Scenario('patient_create', 'post', '/api/patients',
+             lambda ctx: {'first_name': 'Bench', 'last_name': 'Mark', 'email': 'bench-%d@example.com' % ctx['n']}),
+    Scenario('patient_detail', 'get', '/api/patients/{patient}'),
+    Scenario('patient_update', 'patch', '/api/patients/{patient}', lambda ctx: {'is_new': ctx['n'] % 2 == 0}),
+    Scenario('patient_vitals', 'get', '/api/patients/{heavy_patient}/vitals'),
+    Scenario('patient_chart', 'get', '/api/patients/{heavy_patient}/chart'),
+    Scenario('patient_vitals_monthly', 'get', '/api/patients/{heavy_patient}/vitals?bucket=month'),
+    Scenario('insurance_providers', 'get', '/api/insurance_providers'),
+    Scenario('progress_notes', 'get', '/api/progress_notes?limit=100'),
+    Scenario('progress_notes_by_patient', 'get', '/api/progress_notes?patient={heavy_patient}&pagination=cursor'),
+    Scenario('progress_note_create', 'post', '/api/progress_notes', progress_note),
+    Scenario('progress_notes_bulk_dry_run', 'post', '/api/progress_notes/bulk?dry_run=1',
+             lambda ctx: [progress_note(ctx) for _ in range(100)]),
+    Scenario('progress_note_detail', 'get', '/api/progress_notes/{note}'),
+    Scenario('allergies', 'get', '/api/allergies'),
+    Scenario('allergies_prefix', 'get', '/api/allergies?prefix=all'),
+    Scenario('medication', 'get', '/api/medication'),
+    Scenario('diagnoses', 'get', '/api/diagnoses'),
+    Scenario('async_appointments', 'get', '/api/async/appointments?limit=100&ordering=start'),
+    Scenario('async_patients', 'get', '/api/async/patients?search=smi&limit=20'),
+    Scenario('async_patient_detail', 'get', '/api/async/patients/{patient}'),
+    Scenario('export_patients_csv', 'get', '/api/export/patients.csv', max_iterations=3),
+    Scenario('export_appointments_ndjson', 'get', '/api/export/appointments.ndjson', max_iterations=3),
+    Scenario('export_progress_notes_csv_gzip', 'get', '/api/export/progress_notes.csv?gzip=1', max_iterations=3),
+]
+
+# Streams stay open until the client leaves, there's no request time to measure
+UNTIMED_ROUTES = ['appointments/events']
+
+
+def uncovered_routes(scenarios):
+    """api/urls.py routes no scenario hits (djoser's included routes and UNTIMED_ROUTES aren't tracked)"""
+    placeholders = defaultdict(lambda: 1)
+    covered = {resolve(urlsplit(s.url.format_map(placeholders)).path).func for s in scenarios}
+    return [str(p.pattern) for p in api_urls.urlpatterns if isinstance(p, URLPattern) and p.callback not in covered
+            and str(p.pattern) not in UNTIMED_ROUTES]
+
+
+def percentile(values, pct):
+    # Nearest-rank on sorted values
+    return values[max(0, math.ceil(pct / 100.0 * len(values)) - 1)]
+
+
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+def build_context():
+    patient = (Patient.objects.annotate(n=Count('appointment')).filter(n__gt=0)
+               .order_by('n', 'pk').values_list('pk', flat=True))
+    heavy = ProgressNote.objects.values('patient').annotate(n=Count('id')).order_by('-n').first()
+    appointment = Appointment.objects.order_by('-start').first()
+    note = ProgressNote.objects.order_by('-pk').first()
+    if not (patient and heavy and appointment and note):
+        raise CommandError('Not enough data to benchmark, run seed_data first')
+    now = timezone.now().replace(microsecond=0)
+    iso = '%Y-%m-%dT%H:%M:%SZ'
+    return {
+        # A typical patient, the one at the median appointment count
+        'patient': patient[patient.count() // 2],
+        'heavy_patient': heavy['patient'],
+        'appointment': appointment.pk,
+        'note': note.pk,
+        'allergies': list(Allergy.objects.values_list('pk', flat=True)[:2]),
+        'medication': list(Medication.objects.values_list('pk', flat=True)[:2]),
+        'diagnoses': list(Diagnosis.objects.values_list('pk', flat=True)[:1]),
+        'now': now.strftime(iso),
+        'today': now.date().isoformat(),
+        'cursor': encode_cursor(now),
+        'month_ago': (now - timedelta(days=30)).date().isoformat(),
+        'quarter_ago': (now - timedelta(days=90)).date().isoformat(),
+        'week_ahead': (now + timedelta(days=7)).strftime(iso),
+        'far_future': now.replace(minute=0, second=0) + timedelta(days=365 * 20),
+    }
+
+
+def run_scenario(client, scenario, ctx, iterations, warmup):
+    url = scenario.url.format(**{k: v for k, v in ctx.items() if not isinstance(v, list)})
+    latencies, queries, sizes, statuses = [], [], [], set()
+    for i in range(warmup + iterations):
+        ctx['n'] += 1
+        body = scenario.body(ctx) if callable(scenario.body) else scenario.body
+        kwargs = {'data': json.dumps(body), 'content_type': 'application/json'} if body is not None else {}
+        counter = QueryCounter()
+        with connection.execute_wrapper(counter):
+            started = time.perf_counter()
+            response = getattr(client, scenario.method)(url, **kwargs)
+            content = b''.join(response.streaming_content) if response.streaming else response.content
+            elapsed = time.perf_counter() - started
+        if response.status_code >= 400:
+            raise CommandError('%s %s returned %d: %s' % (
+                scenario.method.upper(), url, response.status_code, content[:500].decode(errors='replace')))
+        if i >= warmup:
+            latencies.append(elapsed * 1000)
+            queries.append(counter.count)
+            sizes.append(len(content))
+            statuses.add(response.status_code)
+
+    latencies.sort()
+    return {
+        'method': scenario.method.upper(),
+        'url': url,
+        'status': sorted(statuses),
+        'iterations': iterations,
+        'p50_ms': round(percentile(latencies, 50), 3),
+        'p90_ms': round(percentile(latencies, 90), 3),
+        'p99_ms': round(percentile(latencies, 99), 3),
+        'mean_ms': round(sum(latencies) / len(latencies), 3),
+        'max_ms': round(latencies[-1], 3),
+        'queries': max(queries),
+        'bytes': max(sizes),
+    }
+
+
+class Command(BaseCommand):
+    help = ('Benchmark every endpoint in api/urls.py in-process against the current data (see seed_data), '
+            'reporting latency percentiles, query counts and payload sizes. Writes are rolled back.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=30)
+        parser.add_argument('--warmup', type=int, default=3)
+        parser.add_argument('--only', help='Comma separated scenario names')
+        parser.add_argument('--output', help='JSON results file, defaults to benchmark-api-<timestamp>.json')
+        parser.add_argument('--compare', help='Earlier results file to print p50 changes against')
+
+    def handle(self, *args, **options):
+        scenarios = SCENARIOS
+        if options['only']:
+            names = set(options['only'].split(','))
+            unknown = names - {s.name for s in SCENARIOS}
+            if unknown:
+                raise CommandError('Unknown scenario(s): %s' % ', '.join(sorted(unknown)))
+            scenarios = [s for s in SCENARIOS if s.name in names]
+        else:
+            for route in uncovered_routes(scenarios):
+                self.stderr.write('No benchmark scenario for api/%s' % route)
+        previous = {}
+        if options['compare']:
+            with open(options['compare']) as f:
+                previous = json.load(f)['results']
+
+        started_at = timezone.now()
+        hosts = [h for h in settings.ALLOWED_HOSTS if h not in ('*', '')] or ['localhost']
+        results = {}
+        # Everything the benchmark writes, including its user, is rolled back at the end
+        with transaction.atomic():
+            rows = {model._meta.model_name: model.objects.count() for model in
+                    (Patient, InsuranceProvider, Appointment, ProgressNote, Allergy, Medication, Diagnosis)}
+            ctx = build_context()
+            user = get_user_model().objects.create_superuser(
+                'benchmark-api-%d' % time.time_ns(), password='benchmark-api')
+            ctx.update(n=0, username=user.username, password='benchmark-api')
+            client = Client(HTTP_AUTHORIZATION='Token ' + Token.objects.create(user=user).key, HTTP_HOST=hosts[0])
+
+            for scenario in scenarios:
+                iterations = min(options['iterations'], scenario.max_iterations or options['iterations'])
+                result = results[scenario.name] = run_scenario(client, scenario, ctx, iterations, options['warmup'])
+                line = '%-32s p50 %8.2f ms  p90 %8.2f ms  p99 %8.2f ms  %3d queries  %9d bytes' % (
+                    scenario.name, result['p50_ms'], result['p90_ms'], result['p99_ms'],
+                    result['queries'], result['bytes'])
+                if scenario.name in previous:
+                    before = previous[scenario.name]['p50_ms']
+                    line += '  p50 %+.1f%%' % ((result['p50_ms'] - before) / before * 100 if before else 0)
+                self.stdout.write(line)
+
+            transaction.set_rollback(True)
+
+        output = options['output'] or 'benchmark-api-%s.json' % started_at.strftime('%Y%m%d-%H%M%S')
+        with open(output, 'w') as f:
+            json.dump({
+                'started_at': started_at.isoformat(),
+                'database': connection.vendor,
+                'iterations': options['iterations'],
+                'warmup': options['warmup'],
+                'rows': rows,
+                'results': results,
+            }, f, indent=2)
+        self.stdout.write(self.style.SUCCESS('Results written to %s' % output))
@@ -0,0 +1,166 @@
+import asyncio
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.asgi import get_asgi_application
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.test import Client
+from rest_framework.authtoken.models import Token
+
+# (sync URL, async URL) pairs
+ENDPOINTS = [
+    ('/api/appointments?limit=50&ordering=start', '/api/async/appointments?limit=50&ordering=start'),
+    ('/api/patients?search=a', '/api/async/patients?search=a'),
+    ('/api/patients/{patient}', '/api/async/patients/{patient}'),
+]
+
+
+class SimulatedLatency:
+    """Sleep before every query, on every connection opened while active"""
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+    def __call__(self, execute, sql, params, many, context):
+        time.sleep(self.seconds)
+        return execute(sql, params, many, context)
+
+    def install(self, sender, connection, **kwargs):
+        connection.execute_wrappers.append(self)
+
+    def __enter__(self):
+        connections.close_all()
+        connection_created.connect(self.install)
+        return self
+
+    def __exit__(self, *exc):
+        connection_created.disconnect(self.install)
+        connections.close_all()
+
+
+def summarize(latencies, elapsed):
+    latencies = sorted(latencies)
+    return {
+        'rps': len(latencies) / elapsed,
+        'p50': statistics.median(latencies) * 1000,
+        'p99': latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000,
+    }
+
+
+def run_wsgi(url, headers, requests, concurrency, workers):
+    """`concurrency` clients sharing a pool of `workers` threads, like a threaded WSGI server"""
+    pool = threading.Semaphore(workers)
+    latencies, lock = [], threading.Lock()
+    per_client = [requests // concurrency + (i < requests % concurrency) for i in range(concurrency)]
+
+    def client(count):
+        http = Client()
+        try:
+            for _ in range(count):
+                started = time.perf_counter()
+                with pool:
+                    response = http.get(url, **headers)
+                assert response.status_code == 200, response.content
+                with lock:
+                    latencies.append(time.perf_counter() - started)
+        finally:
+            connections.close_all()
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(client, per_client))
+    return summarize(latencies, time.perf_counter() - started)
+
+
+async def asgi_get(application, url, headers):
+    parts = urlsplit(url)
+    scope = {
+        'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET',
+        'scheme': 'http', 'path': parts.path, 'raw_path': parts.path.encode(),
+        'query_string': parts.query.encode(), 'root_path': '',
+        'headers': [(k.encode(), v.encode()) for k, v in headers.items()],
+        'server': (headers['host'], 80), 'client': ('127.0.0.1', 0),
+    }
+    received = False
+    status = None
+
+    async def receive():
+        nonlocal received
+        if not received:
+            received = True
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+        # Nothing more to read, the handler cancels this once the response is sent
+        await asyncio.Event().wait()
+
+    async def send(message):
+        nonlocal status
+        if message['type'] == 'http.response.start':
+            status = message['status']
+
+    await application(scope, receive, send)
+    return status
+
+
+def run_asgi(url, headers, requests, concurrency):
+    """`concurrency` clients against the ASGI application on one event loop"""
+    application = get_asgi_application()
+
+    async def main():
+        latencies = []
+        per_client = [requests // concurrency + (i < requests % concurrency) for i in range(concurrency)]
+
+        async def client(count):
+            for _ in range(count):
+                started = time.perf_counter()
+                status = await asgi_get(application, url, headers)
+                assert status == 200, status
+                latencies.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(client(count) for count in per_client))
+        return summarize(latencies, time.perf_counter() - started)
+
+    return asyncio.run(main())
+
+
+class Command(BaseCommand):
+    help = ('Compare requests/sec and latency of the sync (WSGI thread pool) and async (ASGI) '
+            'read endpoints under simulated database latency')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=400)
+        parser.add_argument('--concurrency', type=int, default=50, help='Concurrent clients')
+        parser.add_argument('--workers', type=int, default=8, help='WSGI worker threads')
+        parser.add_argument('--latency', type=float, default=20, help='Added ms per query')
+
+    def handle(self, *args, **options):
+        from api.models import Patient
+        patient = Patient.objects.order_by('pk').first()
+        if patient is None:
+            self.stderr.write('No patients found, seed some data first')
+            return
+
+        user = get_user_model().objects.create_user('benchmark-async-%d' % time.time_ns())
+        token = Token.objects.create(user=user)
+        hosts = [h for h in settings.ALLOWED_HOSTS if h not in ('*', '')] or ['localhost']
+        try:
+            with SimulatedLatency(options['latency'] / 1000):
+                for sync_url, async_url in ENDPOINTS:
+                    sync_url, async_url = (u.format(patient=patient.pk) for u in (sync_url, async_url))
+                    wsgi = run_wsgi(sync_url, {'HTTP_AUTHORIZATION': 'Token ' + token.key, 'HTTP_HOST': hosts[0]},
+                                    options['requests'], options['concurrency'], options['workers'])
+                    asgi = run_asgi(async_url, {'authorization': 'Token ' + token.key, 'host': hosts[0]},
+                                    options['requests'], options['concurrency'])
+                    self.stdout.write(sync_url)
+                    for name, result in (('wsgi', wsgi), ('asgi', asgi)):
+                        self.stdout.write('  %s  %7.1f req/s  p50 %7.1f ms  p99 %7.1f ms' % (
+                            name, result['rps'], result['p50'], result['p99']))
+        finally:
+            user.delete()
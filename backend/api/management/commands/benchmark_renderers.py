@@ -0,0 +1,51 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from rest_framework.renderers import JSONRenderer
+
+from api.compression import CODINGS
+from api.management.commands.benchmark_serializers import BENCHMARKS, seed
+from api.renderers import FastJSONRenderer
+
+
+def best_time(func, repeat):
+    best, result = None, None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+class Command(BaseCommand):
+    help = 'Compare render time of JSONRenderer and FastJSONRenderer, and bytes on the wire per encoding, on large list pages'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--page-sizes', default='100,500,1000',
+                            help='Comma separated rows per page, the largest is seeded')
+        parser.add_argument('--repeat', type=int, default=5)
+
+    def handle(self, *args, **options):
+        page_sizes = sorted(int(size) for size in options['page_sizes'].split(','))
+        repeat = options['repeat']
+        # Seeded rows are rolled back when the benchmark finishes
+        with transaction.atomic():
+            seed(page_sizes[-1])
+            for name, _, serializer_class, queryset in BENCHMARKS:
+                instances = list(queryset().order_by('-id')[:page_sizes[-1]])
+                for size in page_sizes:
+                    # Shaped like a LimitOffsetPagination page
+                    page = {'count': len(instances), 'next': None, 'previous': None,
+                            'results': serializer_class(instances[:size], many=True).data}
+                    before, output = best_time(lambda: JSONRenderer().render(page), repeat)
+                    after, fast_output = best_time(lambda: FastJSONRenderer().render(page), repeat)
+                    line = '%-15s %5d rows  render %7.2f -> %7.2f ms (%.1fx) identical=%s  %9d bytes' % (
+                        name, size, before * 1000, after * 1000, before / after, output == fast_output, len(output))
+                    for coding, compress in sorted(CODINGS.items()):
+                        elapsed, compressed = best_time(lambda: compress(output), repeat)
+                        line += '  %s %8d (%4.1f%%, %.2f ms)' % (
+                            coding, len(compressed), len(compressed) * 100.0 / len(output), elapsed * 1000)
+                    self.stdout.write(line)
+            transaction.set_rollback(True)
@@ -0,0 +1,109 @@
+import random
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+from rest_framework import serializers
+from rest_framework.renderers import JSONRenderer
+
+from api.models import Allergy, Appointment, Diagnosis, InsuranceProvider, Medication, Patient, ProgressNote
+from api.serializers import (AllergySerializer, AppointmentSerializer, DiagnosisSerializer,
+                             InsuranceProviderSerializer, MedicationSerializer, PatientSerializer,
+                             ProgressNoteSerializer)
+
+
+# Previous behaviour: nested serializers rebuilt and rebound for every row
+class LegacyPatientSerializer(PatientSerializer):
+    def to_representation(self, instance):
+        self.fields['insurance_provider'] = InsuranceProviderSerializer(read_only=True)
+        return serializers.ModelSerializer.to_representation(self, instance)
+
+
+class LegacyAppointmentSerializer(AppointmentSerializer):
+    def to_representation(self, instance):
+        self.fields['patient'] = LegacyPatientSerializer(read_only=True)
+        return serializers.ModelSerializer.to_representation(self, instance)
+
+
+class LegacyProgressNoteSerializer(ProgressNoteSerializer):
+    def to_representation(self, instance):
+        self.fields['allergies'] = AllergySerializer(read_only=True, many=True)
+        self.fields['medication'] = MedicationSerializer(read_only=True, many=True)
+        self.fields['diagnoses'] = DiagnosisSerializer(read_only=True, many=True)
+        return serializers.ModelSerializer.to_representation(self, instance)
+
+
+BENCHMARKS = [
+    ('patients', LegacyPatientSerializer, PatientSerializer,
+     lambda: Patient.objects.select_related('insurance_provider')),
+    ('appointments', LegacyAppointmentSerializer, AppointmentSerializer,
+     lambda: Appointment.objects.select_related('patient__insurance_provider')),
+    ('progress_notes', LegacyProgressNoteSerializer, ProgressNoteSerializer,
+     lambda: ProgressNote.objects.prefetch_related('allergies', 'medication', 'diagnoses')),
+]
+
+
+def seed(rows):
+    providers = InsuranceProvider.objects.bulk_create(
+        [InsuranceProvider(name='Bench Provider %d' % i) for i in range(5)])
+    vocabularies = [
+        model.objects.bulk_create([model(name='Bench %s %d' % (model.__name__, i)) for i in range(10)])
+        for model in (Allergy, Medication, Diagnosis)
+    ]
+    patients = Patient.objects.bulk_create([
+        Patient(first_name='First%d' % i, last_name='Last%d' % i, email='bench%d@example.com' % i,
+                insurance_provider=random.choice(providers), dob=timezone.now().date())
+        for i in range(rows)
+    ])
+    now = timezone.now()
+    Appointment.objects.bulk_create([
+        Appointment(patient=p, start=now + timedelta(hours=i), end=now + timedelta(hours=i, minutes=30))
+        for i, p in enumerate(patients)
+    ])
+    notes = ProgressNote.objects.bulk_create([
+        ProgressNote(patient=p, weight='150.25', height='68.50', blood_pressure_sys=120,
+                     blood_pressure_dia=80, chief_complaint='Cough')
+        for p in patients
+    ])
+    for field, vocabulary in zip(('allergies', 'medication', 'diagnoses'), vocabularies):
+        through = getattr(ProgressNote, field).through
+        target = '%s_id' % vocabulary[0]._meta.model_name
+        through.objects.bulk_create([
+            through(**{'progressnote_id': note.id, target: item.id})
+            for note in notes for item in random.sample(vocabulary, 2)
+        ])
+
+
+def time_serializer(serializer_class, rows, repeat):
+    best, output = None, None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        data = serializer_class(rows, many=True).data
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+        output = JSONRenderer().render(data)
+    return best, output
+
+
+class Command(BaseCommand):
+    help = 'Compare list serialization time per 1,000 rows against the per-row nested serializer path'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=1000)
+        parser.add_argument('--repeat', type=int, default=5)
+
+    def handle(self, *args, **options):
+        rows, repeat = options['rows'], options['repeat']
+        # Seeded rows are rolled back when the benchmark finishes
+        with transaction.atomic():
+            seed(rows)
+            for name, legacy_class, serializer_class, queryset in BENCHMARKS:
+                instances = list(queryset().order_by('-id')[:rows])
+                before, legacy_output = time_serializer(legacy_class, instances, repeat)
+                after, output = time_serializer(serializer_class, instances, repeat)
+                per_k = 1000.0 / len(instances)
+                self.stdout.write('%-15s before %8.2f ms/1k rows  after %8.2f ms/1k rows  (%.1fx)  identical=%s' % (
+                    name, before * 1000 * per_k, after * 1000 * per_k, before / after, legacy_output == output))
+            transaction.set_rollback(True)
@@ -0,0 +1,31 @@
+import sys
+
+from django.core.management.base import BaseCommand
+
+from api.export import EXPORTERS, FORMATS, gzip_stream
+
+
+class Command(BaseCommand):
+    help = 'Stream patients, appointments or progress notes to a CSV or NDJSON file'
+
+    def add_arguments(self, parser):
+        parser.add_argument('kind', choices=sorted(EXPORTERS))
+        parser.add_argument('--format', choices=sorted(FORMATS), default='csv')
+        parser.add_argument('--output', '-o', help='Defaults to stdout')
+        parser.add_argument('--gzip', action='store_true')
+        parser.add_argument('--chunk-size', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        lines, content_type = FORMATS[options['format']]
+        stream = lines(EXPORTERS[options['kind']](chunk_size=options['chunk_size']))
+        if options['gzip']:
+            out = open(options['output'], 'wb') if options['output'] else sys.stdout.buffer
+            stream = gzip_stream(stream)
+        else:
+            out = open(options['output'], 'w', newline='') if options['output'] else self.stdout
+        try:
+            for chunk in stream:
+                out.write(chunk)
+        finally:
+            if options['output']:
+                out.close()
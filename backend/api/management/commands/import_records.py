@@ -0,0 +1,65 @@
+import csv
+import json
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api.bulk import IMPORTERS
+
+# CSV cells for M2M columns hold ids separated by this character, ex: "3;7;12"
+CSV_LIST_SEPARATOR = ';'
+
+
+def read_jsonl(f):
+    for line in f:
+        line = line.strip()
+        if line:
+            yield json.loads(line)
+
+
+def read_csv(f, list_fields):
+    for row in csv.DictReader(f):
+        # Empty cells mean "not provided" so optional fields fall back to their defaults
+        row = {k: v for k, v in row.items() if v not in ('', None)}
+        for field in list_fields:
+            if field in row:
+                row[field] = [pk for pk in row[field].split(CSV_LIST_SEPARATOR) if pk]
+        yield row
+
+
+class Command(BaseCommand):
+    help = 'Bulk import appointments or progress notes from a JSON Lines or CSV file'
+
+    def add_arguments(self, parser):
+        parser.add_argument('kind', choices=sorted(IMPORTERS))
+        parser.add_argument('path')
+        parser.add_argument('--format', choices=['jsonl', 'csv'],
+                            help='Defaults to the file extension')
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--atomic', action='store_true',
+                            help='Import nothing if any row is invalid')
+        parser.add_argument('--dry-run', action='store_true', help='Validate only')
+        parser.add_argument('--max-errors', type=int, default=50,
+                            help='Number of row errors to print')
+
+    def handle(self, *args, **options):
+        importer = IMPORTERS[options['kind']](batch_size=options['batch_size'])
+        fmt = options['format'] or options['path'].rsplit('.', 1)[-1].lower()
+        if fmt not in ('jsonl', 'csv'):
+            raise CommandError('Unknown format "%s", pass --format' % fmt)
+
+        started = time.monotonic()
+        with open(options['path'], newline='') as f:
+            rows = read_jsonl(f) if fmt == 'jsonl' else read_csv(f, importer.many_related_fields)
+            try:
+                report = importer.run(rows, atomic=options['atomic'], dry_run=options['dry_run'])
+            except json.JSONDecodeError as e:
+                raise CommandError('Invalid JSON line: %s' % e)
+
+        for error in report['errors'][:options['max_errors']]:
+            self.stderr.write('row %d: %s' % (error['row'], json.dumps(error['errors'])))
+        if len(report['errors']) > options['max_errors']:
+            self.stderr.write('... %d more' % (len(report['errors']) - options['max_errors']))
+
+        self.stdout.write(self.style.SUCCESS('Created %d %s, %d invalid rows in %.1fs' % (
+            report['created'], options['kind'], len(report['errors']), time.monotonic() - started)))
@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+
+from api.changes import RETENTION, prune_tombstones
+
+
+class Command(BaseCommand):
+    help = 'Delete appointment tombstones older than the change feed retention (%d days)' % RETENTION.days
+
+    def handle(self, *args, **options):
+        self.stdout.write(self.style.SUCCESS('Pruned %d tombstones' % prune_tombstones()))
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from api.models import PatientSearchIndex
+from api.search import rebuild_patient_search_index
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the patient search index from the Patient table'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        rebuild_patient_search_index(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(
+            'Indexed %d patients' % PatientSearchIndex.objects.count()))
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from api.models import PatientStats
+from api.stats import rebuild_patient_stats
+
+
+class Command(BaseCommand):
+    help = 'Recompute every patient\'s appointment stats, also refreshes no-show counts (run it nightly)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        rebuild_patient_stats(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(
+            'Rebuilt stats for %d patients' % PatientStats.objects.count()))
@@ -0,0 +1,192 @@
+import random
+import time
+from datetime import datetime, time as dt_time, timedelta
+from itertools import accumulate
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+
+from api.cache import bump_version
+from api.models import Allergy, Appointment, Diagnosis, InsuranceProvider, Medication, Patient, PatientStats, ProgressNote
+from api.search import index_patients
+from api.stats import update_patient_stats
+
+FIRST_NAMES = ['James', 'Mary', 'Robert', 'Patricia', 'John', 'Jennifer', 'Michael', 'Linda', 'David',
+               'Elizabeth', 'William', 'Barbara', 'Richard', 'Susan', 'Joseph', 'Jessica', 'Thomas', 'Sarah',
+               'Maria', 'Karen', 'Daniel', 'Nancy', 'Jose', 'Lisa', 'Wei', 'Mei', 'Ahmed', 'Fatima', 'Ana', 'Luis']
+LAST_NAMES = ['Smith', 'Johnson', 'Williams', 'Brown', 'Jones', 'Garcia', 'Miller', 'Davis', 'Rodriguez',
+              'Martinez', 'Hernandez', 'Lopez', 'Gonzalez', 'Wilson', 'Anderson', 'Thomas', 'Taylor', 'Moore',
+              'Jackson', 'Martin', 'Lee', 'Perez', 'Thompson', 'White', 'Harris', 'Nguyen', 'Chen', 'Khan']
+COMPLAINTS = ['Cough', 'Headache', 'Back pain', 'Fever', 'Fatigue', 'Sore throat', 'Rash', 'Follow-up',
+              'Annual physical', 'Chest pain', 'Dizziness', 'Joint pain', None]
+
+
+def parse_status_mix(value):
+    """'DO=80,SC=15,CI=5' -> ([statuses], [weights])"""
+    statuses, weights = [], []
+    for part in value.split(','):
+        status, _, weight = part.partition('=')
+        if status not in Appointment.StatusEnum.values:
+            raise CommandError('Unknown status "%s" in --status-mix' % status)
+        try:
+            weights.append(float(weight))
+        except ValueError:
+            raise CommandError('Invalid weight "%s" in --status-mix' % weight)
+        statuses.append(status)
+    return statuses, weights
+
+
+def skewed_weights(count, skew):
+    """Cumulative weights where the i-th row is picked ~1/(i+1)^skew as often, 0 is uniform"""
+    return list(accumulate(1.0 / (i + 1) ** skew for i in range(count)))
+
+
+class Seeder:
+    def __init__(self, rng, batch_size, tag):
+        self.rng = rng
+        self.batch_size = batch_size
+        # Keeps unique columns unique when seeding the same database more than once
+        self.tag = tag
+
+    def providers(self, count):
+        return InsuranceProvider.objects.bulk_create(
+            [InsuranceProvider(name='Provider %s-%d' % (self.tag, i)) for i in range(count)])
+
+    def vocabulary(self, model, count):
+        return model.objects.bulk_create(
+            [model(name='%s %s-%d' % (model.__name__, self.tag, i)) for i in range(count)],
+            batch_size=self.batch_size)
+
+    def patients(self, count, providers):
+        rng, today = self.rng, timezone.now().date()
+        patients = []
+        for i in range(count):
+            first, last = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+            patients.append(Patient(
+                first_name=first, last_name=last,
+                email='%s.%s.%s-%d@example.com' % (first.lower(), last.lower(), self.tag, i) if rng.random() < 0.8 else None,
+                phone='555-%s-%07d' % (self.tag, i) if rng.random() < 0.9 else None,
+                dob=today - timedelta(days=rng.randint(365, 365 * 95)),
+                sex=rng.choice(Patient.SexEnum.values),
+                insurance_provider=rng.choice(providers) if providers and rng.random() < 0.85 else None,
+                insurance_member_id='M%09d' % rng.randrange(10 ** 9),
+                is_new=rng.random() < 0.1,
+            ))
+        patients = Patient.objects.bulk_create(patients, batch_size=self.batch_size)
+        index_patients(patients, batch_size=self.batch_size)
+        # Empty stats rows, appointments() fills them in
+        PatientStats.objects.bulk_create([PatientStats(patient=p) for p in patients], batch_size=self.batch_size)
+        return patients
+
+    def appointments(self, count, patients, weights, status_mix, days_back, days_ahead, slot_minutes):
+        """One appointment per free slot between 08:00 and 18:00, past ones get a status from status_mix"""
+        rng = self.rng
+        if not count:
+            return []
+        slots_per_day = 10 * 60 // slot_minutes
+        total_slots = (days_back + days_ahead) * slots_per_day
+        if count > total_slots:
+            raise CommandError('%d appointments do not fit in %d slots, widen the date range or shorten --slot-minutes'
+                               % (count, total_slots))
+        tz, now = timezone.get_current_timezone(), timezone.now()
+        first_day = timezone.localdate() - timedelta(days=days_back)
+        statuses, status_weights = status_mix
+        owners = rng.choices(patients, cum_weights=weights, k=count)
+        appointments = []
+        for slot, patient in zip(sorted(rng.sample(range(total_slots), count)), owners):
+            day, index = divmod(slot, slots_per_day)
+            start = datetime.combine(first_day + timedelta(days=day), dt_time(8), tzinfo=tz) + \
+                timedelta(minutes=index * slot_minutes)
+            status = rng.choices(statuses, status_weights)[0] if start < now else Appointment.StatusEnum.SCHEDULED
+            appointments.append(Appointment(
+                patient=patient, start=start, end=start + timedelta(minutes=slot_minutes), status=status,
+                notes=rng.choice(COMPLAINTS)))
+        appointments = Appointment.objects.bulk_create(appointments, batch_size=self.batch_size)
+        update_patient_stats([patient.pk for patient in patients], batch_size=self.batch_size)
+        return appointments
+
+    def progress_notes(self, count, patients, weights, vocabularies, days_back):
+        rng, now = self.rng, timezone.now()
+        if not count:
+            return []
+        notes = ProgressNote.objects.bulk_create([
+            ProgressNote(
+                patient=patient,
+                weight='%.2f' % rng.uniform(90, 300), height='%.2f' % rng.uniform(150, 200),
+                blood_pressure_sys=rng.randint(95, 170), blood_pressure_dia=rng.randint(55, 110),
+                chief_complaint=rng.choice(COMPLAINTS), treatment='Rest and fluids',
+            )
+            for patient in rng.choices(patients, cum_weights=weights, k=count)
+        ], batch_size=self.batch_size)
+        # auto_now_add overwrites created_at on insert, spread the notes over the past afterwards
+        for note in notes:
+            note.created_at = now - timedelta(seconds=rng.randrange(max(1, days_back) * 86400))
+        ProgressNote.objects.bulk_update(notes, ['created_at'], batch_size=self.batch_size)
+
+        for field, vocabulary in vocabularies.items():
+            through = getattr(ProgressNote, field).through
+            remote = getattr(ProgressNote, field).field
+            source, target = remote.m2m_column_name(), remote.m2m_reverse_name()
+            # Popular terms show up far more often, like real charts
+            vocab_weights = skewed_weights(len(vocabulary), 1.0)
+            through.objects.bulk_create([
+                through(**{source: note.pk, target: item.pk})
+                for note in notes
+                for item in {item.pk: item for item in rng.choices(
+                    vocabulary, cum_weights=vocab_weights, k=rng.randint(0, 3))}.values()
+            ], batch_size=self.batch_size)
+        return notes
+
+
+class Command(BaseCommand):
+    help = ('Seed realistic volumes of patients, insurance providers, appointments and progress notes. '
+            'A few patients get most of the appointments and notes, see --skew')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--patients', type=int, default=5000)
+        parser.add_argument('--providers', type=int, default=25)
+        parser.add_argument('--appointments', type=int, default=15000)
+        parser.add_argument('--progress-notes', type=int, default=15000)
+        parser.add_argument('--vocabulary', type=int, default=200,
+                            help='Allergies, medications and diagnoses to create, each')
+        parser.add_argument('--skew', type=float, default=0.8,
+                            help='Zipf exponent for spreading appointments/notes over patients, 0 is uniform')
+        parser.add_argument('--status-mix', default='DO=85,SC=10,CI=5',
+                            help='Status weights for past appointments, future ones are always scheduled')
+        parser.add_argument('--days-back', type=int, default=365)
+        parser.add_argument('--days-ahead', type=int, default=60)
+        parser.add_argument('--slot-minutes', type=int, default=15, choices=[10, 15, 20, 30, 60])
+        parser.add_argument('--batch-size', type=int, default=2000)
+        parser.add_argument('--seed', type=int, help='Random seed, for repeatable data')
+
+    def handle(self, *args, **options):
+        if options['patients'] < 1 and (options['appointments'] or options['progress_notes']):
+            raise CommandError('Appointments and progress notes need --patients')
+        status_mix = parse_status_mix(options['status_mix'])
+        rng = random.Random(options['seed'])
+        seeder = Seeder(rng, options['batch_size'], tag='%x' % (time.time_ns() // 1000 % 16 ** 6))
+        started = time.monotonic()
+
+        with transaction.atomic():
+            providers = seeder.providers(options['providers'])
+            vocabularies = {field: seeder.vocabulary(model, options['vocabulary'])
+                            for field, model in (('allergies', Allergy), ('medication', Medication),
+                                                 ('diagnoses', Diagnosis))}
+            patients = seeder.patients(options['patients'], providers)
+            # Shuffle so the heavy patients aren't simply the first ids
+            weighted = rng.sample(patients, len(patients))
+            weights = skewed_weights(len(weighted), options['skew'])
+            appointments = seeder.appointments(
+                options['appointments'], weighted, weights, status_mix,
+                options['days_back'], options['days_ahead'], options['slot_minutes'])
+            notes = seeder.progress_notes(options['progress_notes'], weighted, weights,
+                                          {k: v for k, v in vocabularies.items() if v}, options['days_back'])
+            # bulk_create skips the signals that invalidate cached vocabulary lists
+            for model in (InsuranceProvider, Allergy, Medication, Diagnosis):
+                transaction.on_commit(lambda model=model: bump_version(model))
+
+        self.stdout.write(self.style.SUCCESS(
+            'Seeded %d patients, %d providers, %d appointments, %d progress notes and %d x 3 vocabulary terms in %.1fs'
+            % (len(patients), len(providers), len(appointments), len(notes), options['vocabulary'],
+               time.monotonic() - started)))
@@ -0,0 +1,21 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='appointment',
+            index=models.Index(fields=['start', 'id'], name='appointment_start_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='progressnote',
+            index=models.Index(fields=['patient', 'id'], name='progressnote_patient_id_idx'),
+        ),
+    ]
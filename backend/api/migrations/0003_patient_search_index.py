@@ -0,0 +1,87 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:04
+
+import re
+import unicodedata
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+TRIGRAM_COLUMNS = ['first_name', 'last_name', 'email']
+
+
+# Copies of api.search's normalizers as of this migration
+def normalize_text(value):
+    if not value:
+        return ''
+    decomposed = unicodedata.normalize('NFKD', value)
+    return ''.join(c for c in decomposed if not unicodedata.combining(c)).casefold().strip()
+
+
+def normalize_phone(value):
+    return re.sub(r'\D', '', value or '')
+
+
+def create_trigram_indexes(apps, schema_editor):
+    # Substring search is served by pg_trgm GIN indexes; other databases fall back to the btree indexes
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    for column in TRIGRAM_COLUMNS:
+        schema_editor.execute(
+            'CREATE INDEX IF NOT EXISTS patientsearch_%s_trgm_idx ON api_patientsearchindex '
+            'USING gin (%s gin_trgm_ops)' % (column, column))
+
+
+def drop_trigram_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for column in TRIGRAM_COLUMNS:
+        schema_editor.execute('DROP INDEX IF EXISTS patientsearch_%s_trgm_idx' % column)
+
+
+def backfill(apps, schema_editor):
+    Patient = apps.get_model('api', 'Patient')
+    PatientSearchIndex = apps.get_model('api', 'PatientSearchIndex')
+    db_alias = schema_editor.connection.alias
+    entries = [
+        PatientSearchIndex(
+            patient_id=p.pk,
+            first_name=normalize_text(p.first_name),
+            last_name=normalize_text(p.last_name),
+            email=normalize_text(p.email),
+            phone=normalize_phone(p.phone),
+            dob=p.dob,
+            dob_month=p.dob.month if p.dob else None,
+            dob_day=p.dob.day if p.dob else None,
+        )
+        for p in Patient.objects.using(db_alias).iterator()
+    ]
+    PatientSearchIndex.objects.using(db_alias).bulk_create(entries, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0002_keyset_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PatientSearchIndex',
+            fields=[
+                ('patient', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='search_index', serialize=False, to='api.patient')),
+                ('first_name', models.CharField(max_length=50)),
+                ('last_name', models.CharField(max_length=50)),
+                ('email', models.CharField(blank=True, max_length=254)),
+                ('phone', models.CharField(blank=True, max_length=25)),
+                ('dob', models.DateField(blank=True, null=True)),
+                ('dob_month', models.PositiveSmallIntegerField(blank=True, null=True)),
+                ('dob_day', models.PositiveSmallIntegerField(blank=True, null=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['first_name'], name='patientsearch_first_name_idx', opclasses=['varchar_pattern_ops']), models.Index(fields=['last_name'], name='patientsearch_last_name_idx', opclasses=['varchar_pattern_ops']), models.Index(fields=['email'], name='patientsearch_email_idx', opclasses=['varchar_pattern_ops']), models.Index(fields=['phone'], name='patientsearch_phone_idx', opclasses=['varchar_pattern_ops']), models.Index(fields=['dob'], name='patientsearch_dob_idx'), models.Index(fields=['dob_month', 'dob_day'], name='patientsearch_dob_md_idx')],
+            },
+        ),
+        migrations.RunPython(create_trigram_indexes, drop_trigram_indexes),
+        migrations.RunPython(backfill, migrations.RunPython.noop),
+    ]
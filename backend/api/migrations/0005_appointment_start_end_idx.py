@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0004_appointment_start_status_idx'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='appointment',
+            index=models.Index(fields=['start', 'end'], name='appointment_start_end_idx'),
+        ),
+    ]
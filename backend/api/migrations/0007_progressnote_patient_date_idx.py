@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0006_updated_at'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='progressnote',
+            index=models.Index(fields=['patient', 'created_at'], name='progressnote_patient_date_idx'),
+        ),
+    ]
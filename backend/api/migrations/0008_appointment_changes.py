@@ -0,0 +1,35 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0007_progressnote_patient_date_idx'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AppointmentTombstone',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('appointment_id', models.BigIntegerField()),
+                ('start', models.DateTimeField()),
+                ('patient_id', models.BigIntegerField(null=True)),
+                ('removed_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='appointment',
+            index=models.Index(fields=['updated_at'], name='appointment_updated_at_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='patient',
+            index=models.Index(fields=['updated_at'], name='patient_updated_at_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='appointmenttombstone',
+            index=models.Index(fields=['removed_at'], name='tombstone_removed_at_idx'),
+        ),
+    ]
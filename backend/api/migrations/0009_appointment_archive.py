@@ -0,0 +1,58 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:40
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+COLUMNS = 'id, start, "end", status, patient_id, created_at, updated_at, notes'
+
+CREATE_HISTORY_VIEW = """
+CREATE VIEW api_appointment_history AS
+SELECT %(columns)s FROM api_appointment
+UNION ALL
+SELECT %(columns)s FROM api_archivedappointment
+""" % {'columns': COLUMNS}
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0008_appointment_changes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AppointmentHistory',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('start', models.DateTimeField()),
+                ('end', models.DateTimeField()),
+                ('status', models.CharField(choices=[('SC', 'Scheduled'), ('CI', 'Checked In'), ('DO', 'Done')], max_length=2)),
+                ('created_at', models.DateTimeField()),
+                ('updated_at', models.DateTimeField()),
+                ('notes', models.TextField(blank=True, null=True)),
+            ],
+            options={
+                'db_table': 'api_appointment_history',
+                'managed': False,
+            },
+        ),
+        migrations.CreateModel(
+            name='ArchivedAppointment',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('start', models.DateTimeField()),
+                ('end', models.DateTimeField()),
+                ('status', models.CharField(choices=[('SC', 'Scheduled'), ('CI', 'Checked In'), ('DO', 'Done')], max_length=2)),
+                ('created_at', models.DateTimeField()),
+                ('updated_at', models.DateTimeField()),
+                ('notes', models.TextField(blank=True, null=True)),
+                ('archived_at', models.DateTimeField(auto_now_add=True)),
+                ('patient', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='api.patient')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['start'], name='archivedappt_start_idx'), models.Index(fields=['patient', 'start'], name='archivedappt_patient_start_idx')],
+            },
+        ),
+        migrations.RunSQL(CREATE_HISTORY_VIEW, 'DROP VIEW api_appointment_history'),
+    ]
@@ -0,0 +1,72 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:44
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Count, Max, Min, Q
+from django.utils import timezone
+
+DONE, SCHEDULED = 'DO', 'SC'
+
+
+def compute_stats(patient_ids, sources, now, using):
+    # A copy of api.stats.compute_stats as of this migration
+    stats = {pk: {'appointment_count': 0, 'visit_count': 0, 'no_show_count': 0,
+                  'first_visit': None, 'last_visit': None} for pk in patient_ids}
+    for source in sources:
+        rows = (source.objects.using(using).filter(patient_id__in=patient_ids).order_by().values('patient_id')
+                .annotate(appointment_count=Count('id'),
+                          visit_count=Count('id', filter=Q(status=DONE)),
+                          no_show_count=Count('id', filter=Q(status=SCHEDULED, end__lt=now)),
+                          first_visit=Min('start', filter=Q(status=DONE)),
+                          last_visit=Max('start', filter=Q(status=DONE))))
+        for row in rows:
+            entry = stats[row['patient_id']]
+            for field in ('appointment_count', 'visit_count', 'no_show_count'):
+                entry[field] += row[field]
+            if row['first_visit'] is not None:
+                entry['first_visit'] = min(filter(None, [entry['first_visit'], row['first_visit']]))
+                entry['last_visit'] = max(filter(None, [entry['last_visit'], row['last_visit']]))
+    for entry in stats.values():
+        past = entry['visit_count'] + entry['no_show_count']
+        entry['no_show_rate'] = entry['no_show_count'] / past if past else None
+    return stats
+
+
+def backfill(apps, schema_editor):
+    Patient = apps.get_model('api', 'Patient')
+    PatientStats = apps.get_model('api', 'PatientStats')
+    sources = [apps.get_model('api', 'Appointment'), apps.get_model('api', 'ArchivedAppointment')]
+    db_alias = schema_editor.connection.alias
+    now = timezone.now()
+    ids = list(Patient.objects.using(db_alias).order_by('pk').values_list('pk', flat=True))
+    for i in range(0, len(ids), 1000):
+        stats = compute_stats(ids[i:i + 1000], sources, now, db_alias)
+        PatientStats.objects.using(db_alias).bulk_create(
+            [PatientStats(patient_id=pk, **values) for pk, values in stats.items()])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0009_appointment_archive'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PatientStats',
+            fields=[
+                ('patient', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='stats', serialize=False, to='api.patient')),
+                ('appointment_count', models.PositiveIntegerField(default=0)),
+                ('visit_count', models.PositiveIntegerField(default=0)),
+                ('no_show_count', models.PositiveIntegerField(default=0)),
+                ('no_show_rate', models.FloatField(blank=True, null=True)),
+                ('first_visit', models.DateTimeField(blank=True, null=True)),
+                ('last_visit', models.DateTimeField(blank=True, null=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['last_visit'], name='patientstats_last_visit_idx'), models.Index(fields=['visit_count'], name='patientstats_visit_count_idx'), models.Index(fields=['no_show_rate'], name='patientstats_no_show_rate_idx')],
+            },
+        ),
+        migrations.RunPython(backfill, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:26
+
+import django.db.models.functions.text
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0010_patient_stats'),
+    ]
+
+    operations = [
+        migrations.AddConstraint(
+            model_name='allergy',
+            constraint=models.UniqueConstraint(django.db.models.functions.text.Lower('name'), name='allergy_name_ci_uniq'),
+        ),
+        migrations.AddConstraint(
+            model_name='diagnosis',
+            constraint=models.UniqueConstraint(django.db.models.functions.text.Lower('name'), name='diagnosis_name_ci_uniq'),
+        ),
+        migrations.AddConstraint(
+            model_name='insuranceprovider',
+            constraint=models.UniqueConstraint(django.db.models.functions.text.Lower('name'), name='insuranceprovider_name_ci_uniq'),
+        ),
+        migrations.AddConstraint(
+            model_name='medication',
+            constraint=models.UniqueConstraint(django.db.models.functions.text.Lower('name'), name='medication_name_ci_uniq'),
+        ),
+    ]
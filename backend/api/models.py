@@ -1,4 +1,5 @@
 from django.db import models
+from django.db.models.functions import Lower
 from django.utils.translation import gettext_lazy as _
 
 # Create your models here.
@@ -7,6 +8,12 @@ from django.utils.translation import gettext_lazy as _
 class InsuranceProvider(models.Model):
     name = models.CharField(max_length=50, unique=True)
 
+    class Meta:
+        constraints = [
+            # Backs up the serializers' case-insensitive check, see api.prefix_index
+            models.UniqueConstraint(Lower('name'), name='insuranceprovider_name_ci_uniq'),
+        ]
+
 
 class Patient(models.Model):
     class SexEnum(models.TextChoices):
@@ -26,6 +33,67 @@ class Patient(models.Model):
     is_new = models.BooleanField(default=True)
     sex = models.CharField(max_length=2, null=True, blank=True,
                            choices=SexEnum.choices)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            # Appointment change feed picks up patient edits since a cursor
+            models.Index(fields=['updated_at'], name='patient_updated_at_idx'),
+        ]
+
+
+class PatientSearchIndex(models.Model):
+    # Normalized copy of the searchable Patient columns, kept in sync by api.signals
+    patient = models.OneToOneField(
+        Patient, on_delete=models.CASCADE, primary_key=True, related_name='search_index')
+    first_name = models.CharField(max_length=50)
+    last_name = models.CharField(max_length=50)
+    email = models.CharField(max_length=254, blank=True)
+    phone = models.CharField(max_length=25, blank=True)
+    dob = models.DateField(null=True, blank=True)
+    dob_month = models.PositiveSmallIntegerField(null=True, blank=True)
+    dob_day = models.PositiveSmallIntegerField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # varchar_pattern_ops lets PostgreSQL serve LIKE 'term%' prefix lookups from a btree
+            models.Index(fields=['first_name'], name='patientsearch_first_name_idx',
+                         opclasses=['varchar_pattern_ops']),
+            models.Index(fields=['last_name'], name='patientsearch_last_name_idx',
+                         opclasses=['varchar_pattern_ops']),
+            models.Index(fields=['email'], name='patientsearch_email_idx',
+                         opclasses=['varchar_pattern_ops']),
+            models.Index(fields=['phone'], name='patientsearch_phone_idx',
+                         opclasses=['varchar_pattern_ops']),
+            models.Index(fields=['dob'], name='patientsearch_dob_idx'),
+            models.Index(fields=['dob_month', 'dob_day'], name='patientsearch_dob_md_idx'),
+        ]
+
+
+class PatientStats(models.Model):
+    """
+    Appointment statistics per patient, archived appointments included, kept in sync by api.signals
+    and rebuilt by rebuild_patient_stats. No-shows are past appointments still scheduled, counted when
+    the patient's appointments last changed; the rebuild refreshes them for everyone.
+    """
+    patient = models.OneToOneField(
+        Patient, on_delete=models.CASCADE, primary_key=True, related_name='stats')
+    appointment_count = models.PositiveIntegerField(default=0)
+    visit_count = models.PositiveIntegerField(default=0)
+    no_show_count = models.PositiveIntegerField(default=0)
+    # no_show_count / (visit_count + no_show_count), null until the patient has a past appointment
+    no_show_rate = models.FloatField(null=True, blank=True)
+    first_visit = models.DateTimeField(null=True, blank=True)
+    last_visit = models.DateTimeField(null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            # PatientList filters and ordering
+            models.Index(fields=['last_visit'], name='patientstats_last_visit_idx'),
+            models.Index(fields=['visit_count'], name='patientstats_visit_count_idx'),
+            models.Index(fields=['no_show_rate'], name='patientstats_no_show_rate_idx'),
+        ]
 
 
 class Appointment(models.Model):
@@ -40,24 +108,117 @@ class Appointment(models.Model):
         max_length=2, choices=StatusEnum.choices, default=StatusEnum.SCHEDULED)
     patient = models.ForeignKey(Patient, on_delete=models.CASCADE)
     created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    notes = models.TextField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # Keyset pagination on (start, id)
+            models.Index(fields=['start', 'id'], name='appointment_start_id_idx'),
+            # Calendar occupancy counts, grouped by period and status
+            models.Index(fields=['start', 'status'], name='appointment_start_status_idx'),
+            # Overlap checks scan a bounded start range and filter on end from the index
+            models.Index(fields=['start', 'end'], name='appointment_start_end_idx'),
+            # Change feed
+            models.Index(fields=['updated_at'], name='appointment_updated_at_idx'),
+        ]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Where the row was when loaded, so api.signals can tell when it moves out of a filtered range
+        if 'start' in field_names and 'patient_id' in field_names:
+            instance._loaded_position = (instance.start, instance.patient_id)
+        return instance
+
+
+class AppointmentTombstone(models.Model):
+    """
+    An appointment that was deleted, or moved to another start/patient, at removed_at.
+    start/patient_id are where it was, so range-filtered change feeds can tell clients to drop it.
+    """
+    appointment_id = models.BigIntegerField()
+    start = models.DateTimeField()
+    patient_id = models.BigIntegerField(null=True)
+    removed_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['removed_at'], name='tombstone_removed_at_idx'),
+        ]
+
+
+class ArchivedAppointment(models.Model):
+    """A completed Appointment moved out of the hot table by archive_appointments, same id and columns"""
+    id = models.BigIntegerField(primary_key=True)
+    start = models.DateTimeField()
+    end = models.DateTimeField()
+    status = models.CharField(max_length=2, choices=Appointment.StatusEnum.choices)
+    patient = models.ForeignKey(Patient, on_delete=models.CASCADE)
+    created_at = models.DateTimeField()
+    updated_at = models.DateTimeField()
+    notes = models.TextField(null=True, blank=True)
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['start'], name='archivedappt_start_idx'),
+            models.Index(fields=['patient', 'start'], name='archivedappt_patient_start_idx'),
+        ]
+
+
+class AppointmentHistory(models.Model):
+    """
+    Read-only view of Appointment UNION ALL ArchivedAppointment (migration 0009), for reads that
+    reach into the archive. Shaped like Appointment so AppointmentSerializer works on it.
+    """
+    StatusEnum = Appointment.StatusEnum
+
+    id = models.BigIntegerField(primary_key=True)
+    start = models.DateTimeField()
+    end = models.DateTimeField()
+    status = models.CharField(max_length=2, choices=Appointment.StatusEnum.choices)
+    patient = models.ForeignKey(Patient, on_delete=models.DO_NOTHING, db_constraint=False, related_name='+')
+    created_at = models.DateTimeField()
+    updated_at = models.DateTimeField()
     notes = models.TextField(null=True, blank=True)
 
+    class Meta:
+        managed = False
+        db_table = 'api_appointment_history'
+
 
 class Allergy(models.Model):
     name = models.CharField(max_length=30, unique=True)
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(Lower('name'), name='allergy_name_ci_uniq'),
+        ]
+
 
 class Medication(models.Model):
     name = models.CharField(max_length=30, unique=True)
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(Lower('name'), name='medication_name_ci_uniq'),
+        ]
+
 
 class Diagnosis(models.Model):
     name = models.CharField(max_length=30, unique=True)
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(Lower('name'), name='diagnosis_name_ci_uniq'),
+        ]
+
 
 class ProgressNote(models.Model):
     patient = models.ForeignKey(Patient, on_delete=models.CASCADE)
     created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
     weight = models.DecimalField(max_digits=6, decimal_places=2)
     height = models.DecimalField(max_digits=6, decimal_places=2)
     blood_pressure_sys = models.IntegerField()
@@ -69,3 +230,11 @@ class ProgressNote(models.Model):
     diagnoses = models.ManyToManyField(Diagnosis, blank=True)
     treatment = models.CharField(max_length=254, null=True, blank=True)
     doctors_orders = models.CharField(max_length=254, null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # Keyset pagination on id within a patient's notes
+            models.Index(fields=['patient', 'id'], name='progressnote_patient_id_idx'),
+            # Vitals time series by date range
+            models.Index(fields=['patient', 'created_at'], name='progressnote_patient_date_idx'),
+        ]
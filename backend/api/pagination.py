@@ -0,0 +1,44 @@
+from rest_framework.pagination import CursorPagination
+
+
+class KeysetPagination(CursorPagination):
+    page_size = 100
+    page_size_query_param = 'limit'
+    max_page_size = 1000
+
+    def get_ordering(self, request, queryset, view):
+        ordering = super().get_ordering(request, queryset, view)
+        # Always end on the primary key so rows sharing the same leading value page deterministically
+        if ordering[-1].lstrip('-') not in ('id', 'pk'):
+            direction = '-' if ordering[0].startswith('-') else ''
+            ordering = ordering + (direction + 'id',)
+        return ordering
+
+
+class AppointmentCursorPagination(KeysetPagination):
+    ordering = ('start', 'id')
+
+
+class ProgressNoteCursorPagination(KeysetPagination):
+    ordering = ('id',)
+
+
+class CursorPaginationMixin:
+    """
+    Opt-in keyset pagination, selected per request with `?pagination=cursor`.
+    Requests without it keep using the default (limit/offset) pagination.
+    """
+    cursor_pagination_class = None
+
+    def use_cursor_pagination(self):
+        request = getattr(self, 'request', None)
+        if self.cursor_pagination_class is None or request is None:
+            return False
+        params = request.query_params
+        return params.get('pagination') == 'cursor' or 'cursor' in params
+
+    @property
+    def paginator(self):
+        if not hasattr(self, '_paginator') and self.use_cursor_pagination():
+            self._paginator = self.cursor_pagination_class()
+        return super().paginator
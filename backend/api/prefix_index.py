@@ -0,0 +1,123 @@
+import threading
+from bisect import bisect_left
+
+from django.db import DEFAULT_DB_ALIAS, IntegrityError, transaction
+from rest_framework.exceptions import ValidationError
+from rest_framework.response import Response
+from rest_framework.validators import UniqueValidator
+
+from .cache import get_version
+
+
+def normalize_name(value):
+    return ' '.join(value.casefold().split())
+
+
+class PrefixIndex:
+    """
+    Sorted array of casefolded names for one vocabulary table. Every word start is
+    indexed, so "d" finds "Vitamin D", but whole-name prefixes rank first.
+    """
+
+    def __init__(self, rows, version):
+        self.version = version
+        self.names = {}
+        entries = []
+        for pk, name in rows:
+            key = normalize_name(name)
+            self.names[key] = pk
+            words = key.split(' ')
+            for i in range(len(words)):
+                entries.append((' '.join(words[i:]), i > 0, pk, name))
+        entries.sort()
+        self.keys = [entry[0] for entry in entries]
+        self.entries = entries
+
+    def __contains__(self, name):
+        return normalize_name(name) in self.names
+
+    def search(self, prefix, limit=10):
+        prefix = normalize_name(prefix)
+        best = {}
+        i = bisect_left(self.keys, prefix)
+        while i < len(self.keys) and self.keys[i].startswith(prefix):
+            key, is_word_match, pk, name = self.entries[i]
+            # exact name > whole-name prefix > word prefix, then shorter and alphabetical
+            rank = (is_word_match or key != prefix, is_word_match, len(name), key)
+            if pk not in best or rank < best[pk][0]:
+                best[pk] = (rank, {'id': pk, 'name': name})
+            i += 1
+        return [row for rank, row in sorted(best.values(), key=lambda item: item[0])[:limit]]
+
+
+_indexes = {}
+_lock = threading.Lock()
+
+
+def get_current_prefix_index(model):
+    """The built index if it's still at the table's version, None rather than rebuilding it"""
+    index = _indexes.get(model)
+    if index is not None and index.version == get_version(model):
+        return index
+    return None
+
+
+def get_prefix_index(model):
+    # Rebuilt whenever the table's cache version moves. Other workers' writes only move it when
+    # CACHE_URL is shared between them, which multi-worker deployments need: with the default
+    # per-process cache this index can miss names until this worker writes the table or restarts.
+    version = get_version(model)
+    index = _indexes.get(model)
+    if index is None or index.version != version:
+        with _lock:
+            index = _indexes.get(model)
+            if index is None or index.version != version:
+                # From default, a lagging replica would leave the fresh version with stale names
+                index = PrefixIndex(model.objects.using(DEFAULT_DB_ALIAS).values_list('id', 'name'), version)
+                _indexes[model] = index
+    return index
+
+
+class PrefixIndexUniqueValidator(UniqueValidator):
+    """
+    Case-insensitive uniqueness on create, without a query: names in the current prefix index are
+    rejected, the rest are accepted. A stale or unbuilt index isn't rebuilt here, the model's
+    case-insensitive unique constraint catches what it misses (see UniqueNameSerializerMixin).
+    Updates are checked against the table.
+    """
+
+    def __call__(self, value, serializer_field):
+        if getattr(serializer_field.parent, 'instance', None) is not None:
+            return super().__call__(value, serializer_field)
+        index = get_current_prefix_index(self.queryset.model)
+        if index is not None and value in index:
+            raise ValidationError(self.message, code='unique')
+
+
+class UniqueNameSerializerMixin:
+    """Reports a name taken since validation, caught by the unique constraint, as a 400 like the validator's"""
+
+    def create(self, validated_data):
+        try:
+            # Savepoint, so the request's transaction stays usable
+            with transaction.atomic():
+                return super().create(validated_data)
+        except IntegrityError:
+            raise ValidationError({'name': [UniqueValidator.message]}, code='unique')
+
+
+class PrefixSearchMixin:
+    """Ranked autocomplete with ?prefix=, served from the in-memory index"""
+    prefix_param = 'prefix'
+    prefix_limit = 10
+    max_prefix_limit = 100
+
+    def list(self, request, *args, **kwargs):
+        prefix = request.query_params.get(self.prefix_param)
+        if prefix is None:
+            return super().list(request, *args, **kwargs)
+        try:
+            limit = max(1, min(int(request.query_params['limit']), self.max_prefix_limit))
+        except (KeyError, ValueError):
+            limit = self.prefix_limit
+        return Response(get_prefix_index(self.queryset.model).search(prefix, limit))
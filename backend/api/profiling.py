@@ -0,0 +1,167 @@
+"""
+Opt-in request profiling (settings.API_PROFILING).
+
+Every request gets a Server-Timing header with total, DB, auth, serializer and render time,
+and requests slower than API_SLOW_REQUEST_MS are logged to 'api.profiling' as JSON with
+their most repeated SQL. When disabled the middleware removes itself and nothing is patched.
+"""
+import json
+import logging
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.db.backends.signals import connection_created
+from rest_framework.response import Response
+from rest_framework.serializers import BaseSerializer
+from rest_framework.views import APIView
+
+logger = logging.getLogger('api.profiling')
+
+current_profile = ContextVar('api_profile', default=None)
+
+
+class Profile:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.timings = defaultdict(float)
+        self.active = set()
+        self.queries = defaultdict(lambda: [0, 0.0])
+
+    def add_query(self, sql, duration):
+        self.timings['db'] += duration
+        entry = self.queries[sql]
+        entry[0] += 1
+        entry[1] += duration
+
+    @property
+    def query_count(self):
+        return sum(count for count, _ in self.queries.values())
+
+    def top_queries(self, limit=5):
+        repeated = sorted(((count, duration, sql) for sql, (count, duration) in self.queries.items() if count > 1),
+                          reverse=True)
+        return [{'sql': sql, 'count': count, 'ms': round(duration * 1000, 2)}
+                for count, duration, sql in repeated[:limit]]
+
+
+@contextmanager
+def measure(metric):
+    profile = current_profile.get()
+    # Nested calls (a serializer's .data inside another's) only count once
+    if profile is None or metric in profile.active:
+        yield
+        return
+    profile.active.add(metric)
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile.timings[metric] += time.perf_counter() - started
+        profile.active.discard(metric)
+
+
+def record_query(execute, sql, params, many, context):
+    profile = current_profile.get()
+    if profile is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        profile.add_query(sql, time.perf_counter() - started)
+
+
+def install_query_recorder(sender=None, connection=None, **kwargs):
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+def instrument(cls, name, metric):
+    """Time a method or property of cls under `metric` for the current profile"""
+    original = cls.__dict__[name]
+    function = original.fget if isinstance(original, property) else original
+    if getattr(function, 'profiled', False):
+        return
+
+    @wraps(function)
+    def timed(*args, **kwargs):
+        with measure(metric):
+            return function(*args, **kwargs)
+
+    timed.profiled = True
+    setattr(cls, name, property(timed) if isinstance(original, property) else timed)
+
+
+def install():
+    connection_created.connect(install_query_recorder, dispatch_uid='api.profiling')
+    for connection in connections.all(initialized_only=True):
+        install_query_recorder(connection=connection)
+    instrument(APIView, 'perform_authentication', 'auth')
+    instrument(BaseSerializer, 'data', 'serialize')
+    instrument(Response, 'rendered_content', 'render')
+
+
+class ProfilingMiddleware:
+    metrics = [('db', 'Database'), ('auth', 'Authentication'), ('serialize', 'Serializers'), ('render', 'Rendering')]
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not settings.API_PROFILING:
+            raise MiddlewareNotUsed()
+        install()
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        profile = Profile()
+        token = current_profile.set(profile)
+        try:
+            response = self.get_response(request)
+        finally:
+            current_profile.reset(token)
+        return self.report(request, response, profile)
+
+    async def __acall__(self, request):
+        # sync_to_async copies the context, so sync views under ASGI record into the same profile
+        profile = Profile()
+        token = current_profile.set(profile)
+        try:
+            response = await self.get_response(request)
+        finally:
+            current_profile.reset(token)
+        return self.report(request, response, profile)
+
+    def report(self, request, response, profile):
+        total = time.perf_counter() - profile.started
+
+        timings = ['total;dur=%.1f' % (total * 1000)]
+        for metric, description in self.metrics:
+            if metric == 'db':
+                description = '%s (%d queries)' % (description, profile.query_count)
+            timings.append('%s;dur=%.1f;desc="%s"' % (metric, profile.timings[metric] * 1000, description))
+        response['Server-Timing'] = ', '.join(timings)
+
+        if total * 1000 >= settings.API_SLOW_REQUEST_MS:
+            logger.warning(json.dumps({
+                'event': 'slow_request',
+                'method': request.method,
+                'path': request.get_full_path(),
+                'status': response.status_code,
+                'total_ms': round(total * 1000, 2),
+                'queries': profile.query_count,
+                **{metric + '_ms': round(profile.timings[metric] * 1000, 2) for metric, _ in self.metrics},
+                'top_queries': profile.top_queries(),
+            }))
+        return response
@@ -0,0 +1,28 @@
+import orjson
+from rest_framework.renderers import JSONRenderer
+from rest_framework.utils import encoders
+
+
+class FastJSONRenderer(JSONRenderer):
+    """
+    JSONRenderer on orjson. Anything orjson doesn't know natively (datetimes, Decimal, lazy strings, ...)
+    goes through DRF's JSONEncoder.default, so they keep DRF's representations. Serializer fields have
+    already formatted dates (%m/%d/%Y) and Decimals (strings) by the time data gets here.
+    Output matches JSONRenderer's except for floats: exponents are written 1e20 instead of 1e+20, and
+    NaN/Infinity become null where JSONRenderer raises. Models here store no such floats.
+    Pretty printing, ASCII-only output and anything orjson rejects fall back to JSONRenderer.
+    """
+    options = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        if self.ensure_ascii or not self.compact or \
+                self.get_indent(accepted_media_type, renderer_context or {}) is not None:
+            return super().render(data, accepted_media_type, renderer_context)
+        try:
+            ret = orjson.dumps(data, default=encoders.JSONEncoder().default, option=self.options)
+        except orjson.JSONEncodeError:
+            return super().render(data, accepted_media_type, renderer_context)
+        # Same escaping as JSONRenderer, keeps the output a strict JavaScript subset
+        return ret.replace(b'\xe2\x80\xa8', b'\\u2028').replace(b'\xe2\x80\xa9', b'\\u2029')
@@ -0,0 +1,123 @@
+"""
+Read replica routing (settings.DATABASE_REPLICAS).
+
+ReplicaRoutingMiddleware picks one replica per safe-method /api/ request, and ReplicaRouter sends
+that request's reads to it. Writes always go to default. After a successful write the client
+is pinned to default for REPLICA_PIN_SECONDS so it reads its own writes while the replicas catch up:
+with a signed cookie, which reaches whichever worker serves the next request, and in the cache by
+Authorization header or session cookie for clients that don't keep cookies.
+"""
+import hashlib
+import random
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from .cache import get_cache
+
+current_replica = ContextVar('api_replica', default=None)
+
+
+def pin_key(identity):
+    return 'api:pin:%s' % hashlib.sha256(identity.encode()).hexdigest()
+
+
+class ReplicaRouter:
+    # Fresh logins must not 401 on a lagging replica, token lookups are cached anyway
+    primary_models = {'authtoken.token'}
+
+    def db_for_read(self, model, **hints):
+        alias = current_replica.get()
+        if alias is None or model._meta.label_lower in self.primary_models:
+            return None
+        # Reads inside a transaction on default must see its uncommitted writes
+        if connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return None
+        return alias
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same rows as default
+        return True
+
+
+class ReplicaRoutingMiddleware:
+    safe_methods = ('GET', 'HEAD', 'OPTIONS')
+    pin_cookie = 'api_pin'
+    pin_salt = 'api.replicas.pin'
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not settings.DATABASE_REPLICAS:
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def get_identity(self, request):
+        return request.headers.get('Authorization') or request.COOKIES.get(settings.SESSION_COOKIE_NAME)
+
+    def routes_to_replica(self, request):
+        return request.method in self.safe_methods and request.path.startswith('/api/') and \
+            request.get_signed_cookie(self.pin_cookie, None, salt=self.pin_salt,
+                                      max_age=settings.REPLICA_PIN_SECONDS) is None
+
+    def pin_identity(self, request, response, identity):
+        """Who to pin to default after this response, if anyone"""
+        if request.method in self.safe_methods or response.status_code >= 400:
+            return None
+        # Login responses set the session cookie, later requests carry it
+        return identity or getattr(response.cookies.get(settings.SESSION_COOKIE_NAME), 'value', None)
+
+    def set_pin_cookie(self, request, response):
+        if request.method not in self.safe_methods and response.status_code < 400:
+            response.set_signed_cookie(self.pin_cookie, '1', salt=self.pin_salt, max_age=settings.REPLICA_PIN_SECONDS,
+                                       secure=settings.SESSION_COOKIE_SECURE, httponly=True, samesite='Lax')
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        identity = self.get_identity(request)
+        replica = None
+        if self.routes_to_replica(request):
+            if identity is None or not get_cache().get(pin_key(identity)):
+                replica = random.choice(settings.DATABASE_REPLICAS)
+
+        token = current_replica.set(replica)
+        try:
+            response = self.get_response(request)
+        finally:
+            current_replica.reset(token)
+
+        self.set_pin_cookie(request, response)
+        identity = self.pin_identity(request, response, identity)
+        if identity:
+            get_cache().set(pin_key(identity), True, timeout=settings.REPLICA_PIN_SECONDS)
+        return response
+
+    async def __acall__(self, request):
+        # The router reads current_replica from the context sync_to_async copies into the view's thread
+        identity = self.get_identity(request)
+        replica = None
+        if self.routes_to_replica(request):
+            if identity is None or not await get_cache().aget(pin_key(identity)):
+                replica = random.choice(settings.DATABASE_REPLICAS)
+
+        token = current_replica.set(replica)
+        try:
+            response = await self.get_response(request)
+        finally:
+            current_replica.reset(token)
+
+        self.set_pin_cookie(request, response)
+        identity = self.pin_identity(request, response, identity)
+        if identity:
+            await get_cache().aset(pin_key(identity), True, timeout=settings.REPLICA_PIN_SECONDS)
+        return response
@@ -0,0 +1,48 @@
+from datetime import timedelta
+
+from django.db import connections, router
+
+from .models import Appointment
+
+# Upper bound on an appointment's length. Overlap queries only have to scan
+# appointments starting within this window before the slot, which keeps them a
+# short range scan on the start index no matter how busy the day is.
+MAX_APPOINTMENT_DURATION = timedelta(hours=12)
+
+# Arbitrary, only has to be the same for every booking transaction
+SCHEDULE_LOCK_KEY = 0x6170695f736368
+
+
+def lock_schedule():
+    """
+    Hold the schedule lock until the current transaction ends, so a concurrent booking can't insert
+    into a slot between this one's overlap check and its save. PostgreSQL only, SQLite already
+    serializes write transactions.
+    """
+    connection = connections[router.db_for_write(Appointment)]
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT pg_advisory_xact_lock(%s)', [SCHEDULE_LOCK_KEY])
+
+
+def overlapping(start, end, exclude=None):
+    """Appointments sharing any time with [start, end)"""
+    queryset = Appointment.objects.filter(
+        start__gt=start - MAX_APPOINTMENT_DURATION, start__lt=end, end__gt=start)
+    if exclude is not None and exclude.pk is not None:
+        queryset = queryset.exclude(pk=exclude.pk)
+    return queryset
+
+
+def free_slots(start, end, min_duration=timedelta(minutes=1)):
+    """Gaps of at least min_duration between appointments in [start, end), in one indexed query"""
+    booked = overlapping(start, end).order_by('start').values_list('start', 'end')
+    slots = []
+    cursor = start
+    for booked_start, booked_end in booked:
+        if booked_start - cursor >= min_duration:
+            slots.append((cursor, booked_start))
+        cursor = max(cursor, booked_end)
+    if end - cursor >= min_duration:
+        slots.append((cursor, end))
+    return slots
@@ -0,0 +1,114 @@
+from drf_spectacular import openapi
+from drf_spectacular.extensions import OpenApiSerializerExtension
+from drf_spectacular.utils import OpenApiParameter
+from rest_framework import serializers
+
+from .serializers import PatientSerializer
+from .sparse import SparseFieldsViewMixin
+
+
+class AutoSchema(openapi.AutoSchema):
+    """Documents ?fields=/?expand= on views that support them"""
+
+    def get_override_parameters(self):
+        parameters = super().get_override_parameters()
+        if isinstance(self.view, SparseFieldsViewMixin) and self.method == 'GET':
+            parameters = parameters + [
+                OpenApiParameter('fields', str, description='Comma separated fields to return, defaults to all'),
+            ]
+            if self.view.expandable_relations:
+                parameters.append(OpenApiParameter(
+                    'expand', str,
+                    description='Comma separated relations to nest, the rest are returned as ids. '
+                                'Defaults to all of: %s' % ', '.join(self.view.expandable_relations)))
+        return parameters
+
+
+class SparseFieldsSerializerExtension(OpenApiSerializerExtension):
+    """
+    Response schemas for SparseFieldsMixin serializers: any field can be left out by ?fields=,
+    and relations are either an id or the nested object depending on ?expand=.
+    """
+    target_class = 'api.sparse.SparseFieldsMixin'
+    match_subclasses = True
+
+    def map_serializer(self, auto_schema, direction):
+        schema = auto_schema._map_serializer(self.target, direction, bypass_extensions=True)
+        if direction != 'response':
+            return schema
+
+        schema.pop('required', None)
+        read_fields = self.target.get_read_fields() if hasattr(self.target, 'get_read_fields') else {}
+        for name, serializer in read_fields.items():
+            nested = auto_schema.resolve_serializer(getattr(serializer, 'child', serializer), direction).ref
+            field = schema['properties'][name]
+            if field.get('type') == 'array':
+                field['items'] = {'oneOf': [field['items'], nested]}
+            else:
+                schema['properties'][name] = {'oneOf': [field, nested]}
+        return schema
+
+
+# Response shapes of the plain APIView endpoints, for @extend_schema only
+
+class OccupancyPeriodSerializer(serializers.Serializer):
+    period = serializers.DateTimeField()
+    total = serializers.IntegerField()
+    counts = serializers.DictField(child=serializers.IntegerField(), help_text='Appointments per status')
+
+
+class OccupancySerializer(serializers.Serializer):
+    interval = serializers.ChoiceField(choices=['day', 'hour'])
+    results = OccupancyPeriodSerializer(many=True)
+
+
+class FreeSlotSerializer(serializers.Serializer):
+    start = serializers.DateTimeField()
+    end = serializers.DateTimeField()
+
+
+class BulkImportErrorSerializer(serializers.Serializer):
+    row = serializers.IntegerField(help_text='Index in the posted list')
+    errors = serializers.DictField(help_text='Field errors, as a serializer reports them')
+
+
+class BulkImportReportSerializer(serializers.Serializer):
+    created = serializers.IntegerField()
+    errors = BulkImportErrorSerializer(many=True)
+
+
+class VitalsSeriesSerializer(serializers.Serializer):
+    patient = serializers.IntegerField()
+    bucket = serializers.ChoiceField(choices=['day', 'week', 'month', 'year'], allow_null=True)
+    timestamps = serializers.ListField(child=serializers.DateTimeField())
+    count = serializers.ListField(child=serializers.IntegerField(), required=False,
+                                  help_text='Notes per bucket, with ?bucket= only')
+    # One value per timestamp, or {min, mean, max} arrays with ?bucket=
+    weight = serializers.JSONField()
+    height = serializers.JSONField()
+    blood_pressure_sys = serializers.JSONField()
+    blood_pressure_dia = serializers.JSONField()
+    bmi = serializers.JSONField()
+
+
+class ChartVocabularySerializer(serializers.Serializer):
+    id = serializers.IntegerField()
+    name = serializers.CharField()
+    last_noted = serializers.DateTimeField()
+    notes = serializers.IntegerField()
+
+
+class ChartAppointmentsSerializer(serializers.Serializer):
+    total = serializers.IntegerField()
+    upcoming = serializers.IntegerField()
+    past = serializers.IntegerField()
+    next = serializers.DateTimeField(allow_null=True)
+
+
+class PatientChartSerializer(serializers.Serializer):
+    patient = PatientSerializer()
+    latest_vitals = serializers.DictField(allow_null=True, help_text='note, created_at and the vitals')
+    allergies = ChartVocabularySerializer(many=True)
+    medication = ChartVocabularySerializer(many=True)
+    diagnoses = ChartVocabularySerializer(many=True)
+    appointments = ChartAppointmentsSerializer()
@@ -0,0 +1,142 @@
+import re
+import unicodedata
+from datetime import datetime
+
+from django.db import transaction
+from django.db.models import Case, IntegerField, Q, Value, When
+from rest_framework.filters import SearchFilter
+
+from .models import Patient, PatientSearchIndex
+
+
+def normalize_text(value):
+    # Casefold and strip accents so "José" and "jose" share an index entry
+    if not value:
+        return ''
+    decomposed = unicodedata.normalize('NFKD', value)
+    return ''.join(c for c in decomposed if not unicodedata.combining(c)).casefold().strip()
+
+
+def normalize_phone(value):
+    return re.sub(r'\D', '', value or '')
+
+
+def build_index_entry(patient):
+    dob = patient.dob
+    return PatientSearchIndex(
+        patient_id=patient.pk,
+        first_name=normalize_text(patient.first_name),
+        last_name=normalize_text(patient.last_name),
+        email=normalize_text(patient.email),
+        phone=normalize_phone(patient.phone),
+        dob=dob,
+        dob_month=dob.month if dob else None,
+        dob_day=dob.day if dob else None,
+    )
+
+
+def index_patient(patient):
+    build_index_entry(patient).save()
+
+
+@transaction.atomic
+def index_patients(patients, batch_size=1000):
+    """Bulk (re)build index rows, for paths that skip Patient.save() signals"""
+    entries = [build_index_entry(p) for p in patients]
+    PatientSearchIndex.objects.filter(
+        patient_id__in=[e.patient_id for e in entries]).delete()
+    PatientSearchIndex.objects.bulk_create(entries, batch_size=batch_size)
+
+
+@transaction.atomic
+def rebuild_patient_search_index(batch_size=1000):
+    PatientSearchIndex.objects.all().delete()
+    batch = []
+    for patient in Patient.objects.all().iterator(chunk_size=batch_size):
+        batch.append(build_index_entry(patient))
+        if len(batch) >= batch_size:
+            PatientSearchIndex.objects.bulk_create(batch)
+            batch = []
+    PatientSearchIndex.objects.bulk_create(batch)
+
+
+# Date fragments sent by the frontend search box (see formatStringForDBDate)
+FULL_DATE_FORMATS = ['%Y-%m-%d', '%m/%d/%Y']
+MONTH_DAY_RE = re.compile(r'^(\d{1,2})[-/](\d{1,2})$')
+MONTH_RE = re.compile(r'^(\d{1,2})[-/]$')
+YEAR_RE = re.compile(r'^(19|20)\d{2}$')
+PHONE_RE = re.compile(r'^[\d()+\-. ]*\d[\d()+\-. ]*$')
+
+RANK_EXACT = 3
+RANK_PREFIX = 2
+RANK_CONTAINS = 1
+
+
+def parse_date_term(term):
+    """Return a Q over the indexed dob columns, or None if the term isn't a date fragment"""
+    for fmt in FULL_DATE_FORMATS:
+        try:
+            return Q(search_index__dob=datetime.strptime(term, fmt).date())
+        except ValueError:
+            pass
+    match = MONTH_DAY_RE.match(term)
+    if match:
+        return Q(search_index__dob_month=int(match.group(1)),
+                 search_index__dob_day=int(match.group(2)))
+    match = MONTH_RE.match(term)
+    if match:
+        return Q(search_index__dob_month=int(match.group(1)))
+    if YEAR_RE.match(term):
+        return Q(search_index__dob__year=int(term))
+    return None
+
+
+class PatientSearchFilter(SearchFilter):
+    """
+    Serves ?search= from PatientSearchIndex instead of regex/ICONTAINS scans on Patient.
+    Every term must match (like SearchFilter); results are ranked exact > prefix > substring.
+    Substring matches use the trigram indexes on PostgreSQL.
+    """
+    text_fields = ['first_name', 'last_name', 'email']
+
+    def term_filter(self, term):
+        date_filter = parse_date_term(term)
+        if date_filter is not None:
+            return date_filter, Value(RANK_EXACT)
+
+        text = normalize_text(term)
+        exact, prefix, contains = Q(), Q(), Q()
+        for field in self.text_fields:
+            lookup = 'search_index__%s' % field
+            exact |= Q(**{lookup: text})
+            prefix |= Q(**{lookup + '__startswith': text})
+            contains |= Q(**{lookup + '__contains': text})
+
+        if PHONE_RE.match(term):
+            digits = normalize_phone(term)
+            exact |= Q(search_index__phone=digits)
+            prefix |= Q(search_index__phone__startswith=digits)
+            contains |= Q(search_index__phone__startswith=digits)
+
+        rank = Case(
+            When(exact, then=Value(RANK_EXACT)),
+            When(prefix, then=Value(RANK_PREFIX)),
+            default=Value(RANK_CONTAINS),
+            output_field=IntegerField(),
+        )
+        return contains, rank
+
+    def filter_queryset(self, request, queryset, view):
+        terms = self.get_search_terms(request)
+        if not terms:
+            return queryset
+
+        ranks = []
+        for term in terms:
+            condition, rank = self.term_filter(term)
+            queryset = queryset.filter(condition)
+            ranks.append(rank)
+
+        search_rank = sum(ranks[1:], ranks[0])
+        return queryset.annotate(search_rank=search_rank).order_by(
+            '-search_rank', 'search_index__last_name', 'search_index__first_name', 'pk')
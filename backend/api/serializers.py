@@ -1,15 +1,48 @@
+from datetime import timedelta
+
 from rest_framework import serializers
-from .models import Appointment, Patient, InsuranceProvider, ProgressNote, Allergy, Medication, Diagnosis
+from .models import Appointment, Patient, PatientStats, InsuranceProvider, ProgressNote, Allergy, Medication, Diagnosis
 from django.db import models
-from rest_framework.validators import UniqueValidator
+from .prefix_index import PrefixIndexUniqueValidator, UniqueNameSerializerMixin
+from .scheduling import MAX_APPOINTMENT_DURATION, lock_schedule, overlapping
+from .sparse import SparseFieldsMixin
+
+
+class NestedOnReadMixin(SparseFieldsMixin):
+    """
+    Swap in nested serializers for output. They're bound once per serializer instance,
+    so a list response builds them once instead of once per row.
+    With an `expand` tree only the relations in it are nested, the rest stay primary keys.
+    """
+
+    def get_read_fields(self):
+        return {}
+
+    def get_expanded_fields(self):
+        expanded = {}
+        for name, serializer in self.get_read_fields().items():
+            if name not in self.fields:
+                continue
+            if self.expand is not None:
+                if name not in self.expand:
+                    continue
+                getattr(serializer, 'child', serializer).expand = self.expand[name]
+            expanded[name] = serializer
+        return expanded
+
+    def to_representation(self, instance):
+        if not getattr(self, '_read_fields_bound', False):
+            self.fields.update(self.get_expanded_fields())
+            self._read_fields_bound = True
+        return super().to_representation(instance)
 
 
-class InsuranceProviderSerializer(serializers.ModelSerializer):
+class InsuranceProviderSerializer(UniqueNameSerializerMixin, SparseFieldsMixin, serializers.ModelSerializer):
     name = serializers.CharField(
         max_length=50,
         validators=[
             # apply case-insensitive uniqueness, "Name" cannot be added if "name" exists
-            UniqueValidator(
+            PrefixIndexUniqueValidator(
                 queryset=InsuranceProvider.objects.all(), lookup='iexact')
         ]
     )
@@ -19,16 +52,14 @@ class InsuranceProviderSerializer(serializers.ModelSerializer):
         fields = ('__all__')
 
 
-class PatientSerializer(serializers.ModelSerializer):
+class PatientSerializer(NestedOnReadMixin, serializers.ModelSerializer):
 
     class Meta:
         model = Patient
         fields = ('__all__')
 
-    def to_representation(self, instance):
-        self.fields['insurance_provider'] = InsuranceProviderSerializer(
-            read_only=True)
-        return super(PatientSerializer, self).to_representation(instance)
+    def get_read_fields(self):
+        return {'insurance_provider': InsuranceProviderSerializer(read_only=True)}
 
     def validate_phone(self, value):
         # For unique fields (where empty strings are also checked), set blanks to null
@@ -38,40 +69,105 @@ class PatientSerializer(serializers.ModelSerializer):
         return value if value != '' else None
 
 
-class AppointmentSerializer(serializers.ModelSerializer):
+class PatientStatsSerializer(SparseFieldsMixin, serializers.ModelSerializer):
+    class Meta:
+        model = PatientStats
+        exclude = ('patient',)
+
+
+class PatientListSerializer(PatientSerializer):
+    """PatientSerializer plus the materialized appointment stats (read-only)"""
+    stats = serializers.PrimaryKeyRelatedField(read_only=True)
+
+    def get_read_fields(self):
+        return {**super().get_read_fields(), 'stats': PatientStatsSerializer(read_only=True)}
+
+
+class AppointmentSerializer(NestedOnReadMixin, serializers.ModelSerializer):
     status_text = serializers.CharField(
         source='get_status_display', read_only=True)
+    check_overlaps = True
 
     class Meta:
         model = Appointment
         fields = ('__all__')
 
+    def validate(self, attrs):
+        # On partial updates fall back to the stored times
+        start = attrs.get('start', getattr(self.instance, 'start', None))
+        end = attrs.get('end', getattr(self.instance, 'end', None))
+        if start is None or end is None:
+            return attrs
+        if end <= start:
+            raise serializers.ValidationError({'end': 'End must be after start.'})
+        if end - start > MAX_APPOINTMENT_DURATION:
+            hours = MAX_APPOINTMENT_DURATION.total_seconds() // 3600
+            raise serializers.ValidationError(
+                {'end': 'Appointments cannot be longer than %d hours.' % hours})
+        if self.check_overlaps and self.books_slot(attrs):
+            # The views save in the same transaction, so nothing can book the slot in between
+            lock_schedule()
+            conflicts = list(overlapping(start, end, exclude=self.instance).values_list('id', flat=True)[:5])
+            if conflicts:
+                raise serializers.ValidationError(
+                    'Overlaps existing appointment(s): %s.' % ', '.join('#%d' % pk for pk in conflicts))
+        return attrs
+
+    def books_slot(self, attrs):
+        """
+        Whether this write books the slot anew. Status changes (check-in, completion) on rows that
+        already overlap, e.g. from bulk imports or seed data, aren't held up by the overlap check.
+        """
+        if self.instance is None:
+            return True
+        return any(name in attrs and attrs[name] != getattr(self.instance, name)
+                   for name in ('start', 'end', 'patient'))
+
     # Show full patient details on GET
-    def to_representation(self, instance):
-        self.fields['patient'] = PatientSerializer(read_only=True)
-        return super(AppointmentSerializer, self).to_representation(instance)
+    def get_read_fields(self):
+        return {'patient': PatientSerializer(read_only=True)}
+
+
+class FreeSlotsQuerySerializer(serializers.Serializer):
+    start = serializers.DateTimeField()
+    end = serializers.DateTimeField()
+    duration = serializers.IntegerField(min_value=1, default=15, help_text='Minutes')
+
+    max_range = timedelta(days=31)
 
+    def validate(self, attrs):
+        if attrs['end'] <= attrs['start']:
+            raise serializers.ValidationError({'end': 'End must be after start.'})
+        if attrs['end'] - attrs['start'] > self.max_range:
+            raise serializers.ValidationError({'end': 'Range cannot be longer than %d days.' % self.max_range.days})
+        return attrs
 
-class ProgressNoteSerializer(serializers.ModelSerializer):
+
+class VitalsQuerySerializer(serializers.Serializer):
+    start = serializers.DateTimeField(required=False)
+    end = serializers.DateTimeField(required=False)
+    bucket = serializers.ChoiceField(choices=['day', 'week', 'month', 'year'], required=False)
+
+
+class ProgressNoteSerializer(NestedOnReadMixin, serializers.ModelSerializer):
     class Meta:
         model = ProgressNote
         fields = ('__all__')
 
-    # Show full patient details on GET
-    def to_representation(self, instance):
-        self.fields['allergies'] = AllergySerializer(read_only=True, many=True)
-        self.fields['medication'] = MedicationSerializer(
-            read_only=True, many=True)
-        self.fields['diagnoses'] = DiagnosisSerializer(
-            read_only=True, many=True)
-        return super(ProgressNoteSerializer, self).to_representation(instance)
+    # Show full vocabulary details on GET
+    def get_read_fields(self):
+        return {
+            'allergies': AllergySerializer(read_only=True, many=True),
+            'medication': MedicationSerializer(read_only=True, many=True),
+            'diagnoses': DiagnosisSerializer(read_only=True, many=True),
+        }
 
 
-class AllergySerializer(serializers.ModelSerializer):
+class AllergySerializer(UniqueNameSerializerMixin, SparseFieldsMixin, serializers.ModelSerializer):
     name = serializers.CharField(
         max_length=30,
         validators=[
-            UniqueValidator(queryset=Allergy.objects.all(), lookup='iexact')
+            PrefixIndexUniqueValidator(queryset=Allergy.objects.all(), lookup='iexact')
         ]
     )
 
@@ -80,11 +176,11 @@ class AllergySerializer(serializers.ModelSerializer):
         fields = ('__all__')
 
 
-class MedicationSerializer(serializers.ModelSerializer):
+class MedicationSerializer(UniqueNameSerializerMixin, SparseFieldsMixin, serializers.ModelSerializer):
     name = serializers.CharField(
         max_length=30,
         validators=[
-            UniqueValidator(queryset=Medication.objects.all(), lookup='iexact')
+            PrefixIndexUniqueValidator(queryset=Medication.objects.all(), lookup='iexact')
         ]
     )
 
@@ -93,11 +189,11 @@ class MedicationSerializer(serializers.ModelSerializer):
         fields = ('__all__')
 
 
-class DiagnosisSerializer(serializers.ModelSerializer):
+class DiagnosisSerializer(UniqueNameSerializerMixin, SparseFieldsMixin, serializers.ModelSerializer):
     name = serializers.CharField(
         max_length=30,
         validators=[
-            UniqueValidator(queryset=Diagnosis.objects.all(), lookup='iexact')
+            PrefixIndexUniqueValidator(queryset=Diagnosis.objects.all(), lookup='iexact')
         ]
     )
 
@@ -0,0 +1,117 @@
+from django.contrib.auth import get_user_model
+from django.contrib.auth.signals import user_logged_in
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+
+from .authentication import invalidate_token
+from .cache import bump_version
+from .chart import invalidate_chart
+from .events import publish_appointment
+from .models import (Allergy, Appointment, AppointmentTombstone, Diagnosis, InsuranceProvider, Medication, Patient,
+                     PatientStats, ProgressNote)
+from .search import index_patient
+from .stats import update_patient_stats
+
+VERSIONED_MODELS = [Allergy, Medication, Diagnosis, InsuranceProvider]
+
+
+@receiver(post_save, sender=Patient)
+def update_patient_search_index(sender, instance, raw=False, **kwargs):
+    if not raw:
+        index_patient(instance)
+
+
+@receiver(post_save, sender=Patient)
+def create_patient_stats(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        PatientStats.objects.create(patient=instance)
+
+
+@receiver(post_save, sender=Patient)
+@receiver(post_delete, sender=Patient)
+def invalidate_patient_chart(sender, instance, **kwargs):
+    invalidate_chart(instance.pk)
+
+
+@receiver(post_save, sender=ProgressNote)
+@receiver(post_delete, sender=ProgressNote)
+def invalidate_progress_note_chart(sender, instance, **kwargs):
+    invalidate_chart(instance.patient_id)
+
+
+@receiver(m2m_changed, sender=ProgressNote.allergies.through)
+@receiver(m2m_changed, sender=ProgressNote.medication.through)
+@receiver(m2m_changed, sender=ProgressNote.diagnoses.through)
+def invalidate_progress_note_vocabulary_chart(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        invalidate_chart(instance.patient_id)
+    elif pk_set:
+        # Changed from the vocabulary side, pk_set holds progress notes
+        for patient_id in set(ProgressNote.objects.filter(pk__in=pk_set).values_list('patient_id', flat=True)):
+            invalidate_chart(patient_id)
+
+
+@receiver(post_save)
+@receiver(post_delete)
+def bump_cache_version(sender, **kwargs):
+    if sender in VERSIONED_MODELS:
+        # Bump again on commit so other workers can't rebuild from pre-commit rows under the new version
+        bump_version(sender)
+        transaction.on_commit(lambda: bump_version(sender))
+
+
+@receiver(post_delete, sender=Appointment)
+def appointment_deleted(sender, instance, **kwargs):
+    AppointmentTombstone.objects.create(appointment_id=instance.pk, start=instance.start,
+                                        patient_id=instance.patient_id)
+    # After commit, so a patient deleted along with the appointment (and their stats row) has dropped out
+    # instead of getting a stats row upserted for it
+    patient_id = instance.patient_id
+    transaction.on_commit(lambda: update_patient_stats([patient_id]))
+    invalidate_chart(instance.patient_id)
+    publish_appointment('deleted', instance)
+
+
+@receiver(post_save, sender=Appointment)
+def appointment_saved(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    previous = getattr(instance, '_loaded_position', None)
+    if not created and previous is not None and previous != (instance.start, instance.patient_id):
+        # Change feeds filtered on the old start/patient have to drop the row
+        AppointmentTombstone.objects.create(appointment_id=instance.pk, start=previous[0],
+                                            patient_id=previous[1])
+    patient_ids = [instance.patient_id]
+    if previous is not None and previous[1] != instance.patient_id:
+        patient_ids.append(previous[1])
+    instance._loaded_position = (instance.start, instance.patient_id)
+    update_patient_stats(patient_ids)
+    for patient_id in patient_ids:
+        invalidate_chart(patient_id)
+    publish_appointment('created' if created else 'updated', instance, previous)
+
+
+@receiver(post_delete, sender=Token)
+def invalidate_deleted_token(sender, instance, **kwargs):
+    invalidate_token(instance.key)
+
+
+@receiver(post_save, sender=get_user_model())
+def invalidate_user_tokens(sender, instance, **kwargs):
+    # Picks up deactivation and other user changes without waiting for the cache to expire
+    for key in Token.objects.filter(user=instance).values_list('key', flat=True):
+        invalidate_token(key)
+
+
+@receiver(user_logged_in)
+def refresh_token_on_login(sender, user, **kwargs):
+    # Logging in hands back the existing token, restart its idle timer
+    tokens = Token.objects.filter(user=user)
+    for key in tokens.values_list('key', flat=True):
+        invalidate_token(key)
+    tokens.update(created=timezone.now())
@@ -0,0 +1,60 @@
+"""
+Materialized per-patient appointment stats (PatientStats), so PatientList can filter and order
+patients by them without counting appointments per request.
+
+Rows are recomputed from scratch for the patients an appointment write touches (see api.signals),
+not adjusted by deltas, so they can't drift. No-shows are past appointments still SCHEDULED, which
+also changes as time passes: rebuild_patient_stats refreshes every row and is meant to run nightly.
+"""
+from django.db import transaction
+from django.db.models import Count, Max, Min, Q
+from django.utils import timezone
+
+from .models import Appointment, AppointmentHistory, Patient, PatientStats
+
+STATS_FIELDS = ['appointment_count', 'visit_count', 'no_show_count', 'no_show_rate', 'first_visit', 'last_visit']
+
+
+def compute_stats(patient_ids, now=None):
+    """{patient_id: {field: value}} for every id, in one grouped query over hot and archived appointments"""
+    now = now or timezone.now()
+    done, scheduled = Appointment.StatusEnum.DONE, Appointment.StatusEnum.SCHEDULED
+    stats = {pk: {'appointment_count': 0, 'visit_count': 0, 'no_show_count': 0,
+                  'first_visit': None, 'last_visit': None} for pk in patient_ids}
+    rows = (AppointmentHistory.objects.filter(patient_id__in=patient_ids).order_by().values('patient_id')
+            .annotate(appointment_count=Count('id'),
+                      visit_count=Count('id', filter=Q(status=done)),
+                      no_show_count=Count('id', filter=Q(status=scheduled, end__lt=now)),
+                      first_visit=Min('start', filter=Q(status=done)),
+                      last_visit=Max('start', filter=Q(status=done))))
+    for row in rows:
+        stats[row.pop('patient_id')].update(row)
+    for entry in stats.values():
+        past = entry['visit_count'] + entry['no_show_count']
+        entry['no_show_rate'] = entry['no_show_count'] / past if past else None
+    return stats
+
+
+@transaction.atomic
+def update_patient_stats(patient_ids, batch_size=1000):
+    """Recompute and upsert stats rows, for appointment writes and paths that skip their signals"""
+    patient_ids = sorted(set(patient_ids))
+    for i in range(0, len(patient_ids), batch_size):
+        # Locking the patients serializes concurrent writers, so the last upsert saw every committed change.
+        # Deleted patients drop out here.
+        batch = list(Patient.objects.select_for_update().filter(pk__in=patient_ids[i:i + batch_size])
+                     .order_by('pk').values_list('pk', flat=True))
+        PatientStats.objects.bulk_create(
+            [PatientStats(patient_id=pk, **values) for pk, values in compute_stats(batch).items()],
+            update_conflicts=True, unique_fields=['patient'], update_fields=STATS_FIELDS + ['updated_at'])
+
+
+def rebuild_patient_stats(batch_size=1000):
+    """Recompute every patient's stats, one transaction per batch so writers aren't held up for long"""
+    last = 0
+    while True:
+        batch = list(Patient.objects.filter(pk__gt=last).order_by('pk').values_list('pk', flat=True)[:batch_size])
+        if not batch:
+            return
+        update_patient_stats(batch, batch_size=batch_size)
+        last = batch[-1]
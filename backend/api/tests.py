@@ -1,3 +1,1401 @@
-from django.test import TestCase
+import asyncio
+import csv
+import gzip
+import json
+import os
+import tempfile
+from datetime import date, datetime, timedelta, timezone as dt_timezone
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import iscoroutinefunction, sync_to_async
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection, connections, transaction
+from django.http import HttpResponse
+from django.test import Client, RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient
+
+from .authentication import check_token_settings, token_cache_key
+from .changes import RETENTION, encode_cursor, prune_tombstones
+from .compression import CompressionMiddleware, choose_coding
+from .events import APPOINTMENTS, LocalBroker
+from .export import ProgressNoteExporter
+from .profiling import Profile, ProfilingMiddleware
+from .replicas import pin_key
+from .renderers import FastJSONRenderer
+from .models import Allergy, Appointment, AppointmentTombstone, ArchivedAppointment, PatientStats, Diagnosis, InsuranceProvider, Medication, Patient, PatientSearchIndex, ProgressNote
+
+
+class APITestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('tester', password='tester')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.provider = InsuranceProvider.objects.create(name='Acme')
+        self.allergy = Allergy.objects.create(name='Peanuts')
+        self.medication = Medication.objects.create(name='Ibuprofen')
+        self.diagnosis = Diagnosis.objects.create(name='Flu')
+        self._seq = 0
+
+    def make_patient(self, **kwargs):
+        self._seq += 1
+        fields = {
+            'first_name': 'First%d' % self._seq,
+            'last_name': 'Last%d' % self._seq,
+            'insurance_provider': self.provider,
+        }
+        fields.update(kwargs)
+        return Patient.objects.create(**fields)
+
+    def make_appointment(self, patient=None, **kwargs):
+        start = timezone.now() + timedelta(hours=Appointment.objects.count())
+        fields = {
+            'patient': patient or self.make_patient(),
+            'start': start,
+            'end': start + timedelta(minutes=30),
+        }
+        fields.update(kwargs)
+        return Appointment.objects.create(**fields)
+
+    def make_progress_note(self, patient=None, **kwargs):
+        fields = {
+            'patient': patient or self.make_patient(),
+            'weight': '150.00',
+            'height': '68.00',
+            'blood_pressure_sys': 120,
+            'blood_pressure_dia': 80,
+        }
+        fields.update(kwargs)
+        note = ProgressNote.objects.create(**fields)
+        note.allergies.add(self.allergy)
+        note.medication.add(self.medication)
+        note.diagnoses.add(self.diagnosis)
+        return note
+
+
+class QueryBudgetTests(APITestCase):
+    """Fail when an endpoint's query count grows with the number of rows returned."""
+
+    def count_queries(self, url):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200, response.content)
+        return len(ctx.captured_queries)
+
+    def assertConstantQueries(self, url, make_row, small=2, large=20):
+        for _ in range(small):
+            make_row()
+        baseline = self.count_queries(url)
+        for _ in range(large - small):
+            make_row()
+        self.assertEqual(self.count_queries(url), baseline,
+                         '%s query count grows with page size' % url)
+
+    def test_patient_list(self):
+        self.assertConstantQueries('/api/patients', self.make_patient)
+
+    def test_appointment_list(self):
+        self.assertConstantQueries('/api/appointments', self.make_appointment)
+
+    def test_progress_note_list(self):
+        self.assertConstantQueries(
+            '/api/progress_notes', self.make_progress_note)
+
+    def test_vocabulary_lists(self):
+        for url, model in [('/api/allergies', Allergy), ('/api/medication', Medication),
+                           ('/api/diagnoses', Diagnosis), ('/api/insurance_providers', InsuranceProvider)]:
+            def make_row(model=model):
+                model.objects.create(name='%s %d' % (model.__name__, model.objects.count()))
+            self.assertConstantQueries(url, make_row)
+
+    def test_detail_views(self):
+        appointment = self.make_appointment()
+        note = self.make_progress_note(patient=appointment.patient)
+        # One updated_at lookup for the conditional GET validators, then the object itself
+        budgets = [
+            ('/api/patients/%d' % appointment.patient.pk, 2),
+            ('/api/appointments/%d' % appointment.pk, 2),
+            ('/api/progress_notes/%d' % note.pk, 5),
+        ]
+        for url, budget in budgets:
+            self.assertLessEqual(self.count_queries(url), budget, url)
+
+
+class CursorPaginationTests(APITestCase):
+    def walk(self, url):
+        ids = []
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200, response.content)
+            self.assertNotIn('count', response.data)
+            ids += [row['id'] for row in response.data['results']]
+            url = response.data['next']
+        return ids
+
+    def test_appointments_page_on_start_then_id(self):
+        patient = self.make_patient()
+        start = timezone.now()
+        appointments = [
+            self.make_appointment(patient, start=start + timedelta(hours=i // 3),
+                                  end=start + timedelta(hours=i // 3, minutes=30))
+            for i in range(10)
+        ]
+        expected = [a.id for a in sorted(appointments, key=lambda a: (a.start, a.id))]
+        self.assertEqual(
+            self.walk('/api/appointments?pagination=cursor&ordering=start&limit=4'), expected)
+        self.assertEqual(
+            self.walk('/api/appointments?pagination=cursor&ordering=-start&limit=4'), expected[::-1])
+
+    def test_progress_notes_page_on_id(self):
+        patient = self.make_patient()
+        notes = [self.make_progress_note(patient) for _ in range(5)]
+        self.make_progress_note()
+        self.assertEqual(
+            self.walk('/api/progress_notes?pagination=cursor&patient=%d&limit=2' % patient.pk),
+            [n.id for n in notes])
+
+    def test_limit_offset_is_default(self):
+        self.make_appointment()
+        response = self.client.get('/api/appointments?limit=1')
+        self.assertEqual(response.data['count'], 1)
+
+
+class PatientSearchTests(APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.jose = self.make_patient(first_name='José', last_name='Alvarez', email='jalvarez@example.com',
+                                      phone='(555) 123-4567', dob=date(1980, 5, 17))
+        self.joseph = self.make_patient(first_name='Joseph', last_name='Smith', email='jsmith@example.com',
+                                        dob=date(1975, 5, 2))
+        self.maria = self.make_patient(first_name='Maria', last_name='Dejoseph', dob=date(1990, 12, 17))
+
+    def search(self, text):
+        response = self.client.get('/api/patients', {'search': text})
+        self.assertEqual(response.status_code, 200)
+        return [row['id'] for row in response.data]
+
+    def test_index_follows_saves(self):
+        self.assertEqual(self.jose.search_index.first_name, 'jose')
+        self.assertEqual(self.jose.search_index.phone, '5551234567')
+        self.jose.last_name = 'Ortiz'
+        self.jose.save()
+        self.assertEqual(self.search('ortiz'), [self.jose.id])
+        self.assertEqual(PatientSearchIndex.objects.get(patient=self.jose).last_name, 'ortiz')
+
+    def test_ranks_exact_then_prefix_then_substring(self):
+        self.assertEqual(self.search('jose'), [self.jose.id, self.joseph.id, self.maria.id])
+
+    def test_all_terms_must_match(self):
+        self.assertEqual(self.search('jos smith'), [self.joseph.id])
+
+    def test_dob_fragments(self):
+        self.assertEqual(self.search('1980-05-17'), [self.jose.id])
+        self.assertEqual(self.search('05/17/1980'), [self.jose.id])
+        self.assertEqual(self.search('05-'), [self.jose.id, self.joseph.id])
+        self.assertEqual(self.search('12-17'), [self.maria.id])
+
+    def test_phone_and_email(self):
+        self.assertEqual(self.search('555-123'), [self.jose.id])
+        self.assertEqual(self.search('jsmith@'), [self.joseph.id])
+
+    def test_response_shape(self):
+        response = self.client.get('/api/patients', {'search': 'maria'})
+        self.assertEqual(response.data[0]['insurance_provider'], {'id': self.provider.id, 'name': 'Acme'})
+        self.assertEqual(response.data[0]['dob'], '12/17/1990')
+
+
+class SerializerOutputTests(APITestCase):
+    def test_matches_per_row_nested_serializers(self):
+        from .management.commands.benchmark_serializers import BENCHMARKS
+        patient = self.make_patient(dob=date(1980, 5, 17), email='a@example.com')
+        self.make_patient(insurance_provider=None)
+        self.make_appointment(patient)
+        self.make_appointment(patient, notes='Follow-up')
+        self.make_progress_note(patient)
+        self.make_progress_note(patient, chief_complaint='Cough')
+        for name, legacy_class, serializer_class, queryset in BENCHMARKS:
+            rows = list(queryset())
+            self.assertEqual(JSONRenderer().render(legacy_class(rows, many=True).data),
+                             JSONRenderer().render(serializer_class(rows, many=True).data), name)
+
+
+class VocabularyCacheTests(APITestCase):
+    def test_serves_cached_list_until_create(self):
+        self.assertEqual(len(self.client.get('/api/allergies').data), 1)
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get('/api/allergies')
+        self.assertEqual(len(ctx.captured_queries), 0)
+        self.assertEqual([a['name'] for a in response.data], ['Peanuts'])
+
+        self.client.post('/api/allergies', {'name': 'Latex'})
+        self.assertEqual(len(self.client.get('/api/allergies').data), 2)
+
+    def test_etag_revalidation(self):
+        etag = self.client.get('/api/medication?search=ibu')['ETag']
+        response = self.client.get('/api/medication?search=ibu', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+        self.assertNotEqual(self.client.get('/api/medication')['ETag'], etag)
+
+        Medication.objects.create(name='Aspirin')
+        response = self.client.get('/api/medication?search=ibu', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+
+class PrefixIndexTests(APITestCase):
+    def test_ranked_prefix_search(self):
+        for name in ['Vitamin D', 'Diphenhydramine', 'D', 'Doxycycline Hyclate']:
+            Medication.objects.create(name=name)
+        response = self.client.get('/api/medication', {'prefix': 'd'})
+        self.assertEqual([m['name'] for m in response.data],
+                         ['D', 'Diphenhydramine', 'Doxycycline Hyclate', 'Vitamin D'])
+        response = self.client.get('/api/medication', {'prefix': 'HYC', 'limit': 1})
+        self.assertEqual(response.data, [{'id': Medication.objects.get(name='Doxycycline Hyclate').id,
+                                          'name': 'Doxycycline Hyclate'}])
+
+    def test_uniqueness_check_uses_index(self):
+        self.client.get('/api/diagnoses', {'prefix': ''})
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.post('/api/diagnoses', {'name': 'FLU'})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(len(ctx.captured_queries), 0)
+        response = self.client.post('/api/diagnoses', {'name': 'Strep'})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(self.client.post('/api/diagnoses', {'name': 'strep'}).status_code, 400)
+
+    def test_uniqueness_check_with_stale_index(self):
+        # Like a write from another worker that this process' index hasn't seen
+        self.client.get('/api/diagnoses', {'prefix': ''})
+        Diagnosis.objects.bulk_create([Diagnosis(name='Measles')])
+        response = self.client.post('/api/diagnoses', {'name': 'measles'})
+        # The unique constraint caught it
+        self.assertEqual((response.status_code, response.data['name'][0].code), (400, 'unique'))
+        self.assertEqual(Diagnosis.objects.filter(name__iexact='measles').count(), 1)
+
+    def test_create_doesnt_rebuild_index(self):
+        self.client.get('/api/diagnoses', {'prefix': ''})
+        self.assertEqual(self.client.post('/api/diagnoses', {'name': 'Strep'}).status_code, 201)
+        # The index is stale now, the next create doesn't rebuild it from the table
+        with CaptureQueriesContext(connection) as ctx:
+            self.assertEqual(self.client.post('/api/diagnoses', {'name': 'Mumps'}).status_code, 201)
+        self.assertFalse([q for q in ctx.captured_queries if q['sql'].startswith('SELECT')])
+
+    def test_rebuilds_when_version_moves(self):
+        self.assertEqual(self.client.get('/api/insurance_providers', {'prefix': 'b'}).data, [])
+        provider = InsuranceProvider.objects.create(name='Blue Shield')
+        self.assertEqual(self.client.get('/api/insurance_providers', {'prefix': 'b'}).data,
+                         [{'id': provider.id, 'name': 'Blue Shield'}])
+
+
+class BulkImportTests(APITestCase):
+    def test_appointments_all_or_nothing(self):
+        patient = self.make_patient()
+        rows = [
+            {'patient': patient.id, 'start': '2021-01-04T09:00:00Z', 'end': '2021-01-04T09:30:00Z', 'status': 'DO'},
+            {'patient': 999999, 'start': '2021-01-04T10:00:00Z', 'end': '2021-01-04T10:30:00Z'},
+            {'patient': patient.id, 'start': 'not a date', 'end': '2021-01-04T10:30:00Z'},
+        ]
+        response = self.client.post('/api/appointments/bulk', rows, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual([e['row'] for e in response.data['errors']], [1, 2])
+        self.assertIn('patient', response.data['errors'][0]['errors'])
+        self.assertEqual(Appointment.objects.count(), 0)
+
+        response = self.client.post('/api/appointments/bulk', rows[:1], format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(Appointment.objects.get().status, 'DO')
+
+    def test_progress_notes_with_vocabularies(self):
+        patient = self.make_patient()
+        rows = [{'patient': patient.id, 'weight': '150.5', 'height': '68', 'blood_pressure_sys': 120,
+                 'blood_pressure_dia': 80, 'allergies': [self.allergy.id], 'diagnoses': [self.diagnosis.id] * 2,
+                 'created_at': '2019-03-01T12:00:00Z'} for _ in range(5)]
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.post('/api/progress_notes/bulk', rows, format='json')
+        self.assertEqual(response.status_code, 201, response.data)
+        self.assertEqual(response.data['created'], 5)
+        self.assertLess(len(ctx.captured_queries), 15)
+        note = ProgressNote.objects.first()
+        self.assertEqual(list(note.diagnoses.all()), [self.diagnosis])
+        self.assertEqual(note.created_at.year, 2019)
+
+    def test_command_keeps_valid_rows(self):
+        patient = self.make_patient()
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'notes.csv')
+            with open(path, 'w') as f:
+                f.write('patient,weight,height,blood_pressure_sys,blood_pressure_dia,medication\n')
+                f.write('%d,150,68,120,80,%d\n' % (patient.id, self.medication.id))
+                f.write('%d,heavy,68,120,80,\n' % patient.id)
+            call_command('import_records', 'progress_notes', path, stdout=StringIO(), stderr=StringIO())
+        self.assertEqual(list(ProgressNote.objects.values_list('medication', flat=True)), [self.medication.id])
+
+
+class OccupancyTests(APITestCase):
+    def test_counts_per_day_by_status(self):
+        patient = self.make_patient()
+        day = datetime(2021, 3, 1, 9, tzinfo=dt_timezone.utc)
+        for offset, status in [(0, 'SC'), (1, 'DO'), (2, 'DO'), (24, 'CI'), (24 * 10, 'SC')]:
+            start = day + timedelta(hours=offset)
+            self.make_appointment(patient, start=start, end=start + timedelta(minutes=30), status=status)
+
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get('/api/appointments/occupancy',
+                                       {'start_after': '2021-03-01', 'start_before': '2021-03-05'})
+        self.assertEqual(len(ctx.captured_queries), 1)
+        self.assertEqual(response.data['results'], [
+            {'period': '2021-03-01T00:00:00+00:00', 'total': 3, 'counts': {'SC': 1, 'CI': 0, 'DO': 2}},
+            {'period': '2021-03-02T00:00:00+00:00', 'total': 1, 'counts': {'SC': 0, 'CI': 1, 'DO': 0}},
+        ])
+
+        response = self.client.get('/api/appointments/occupancy', {
+            'start_after': '2021-03-01', 'start_before': '2021-03-01', 'interval': 'hour'})
+        self.assertEqual([r['total'] for r in response.data['results']], [1, 1, 1])
+
+    def test_requires_range(self):
+        self.assertEqual(self.client.get('/api/appointments/occupancy').status_code, 400)
+        response = self.client.get('/api/appointments/occupancy', {
+            'start_after': '2021-03-01', 'start_before': '2021-03-01', 'interval': 'week'})
+        self.assertEqual(response.status_code, 400)
+
+
+class AppointmentChangesTests(APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.day = datetime(2021, 3, 1, 9, tzinfo=dt_timezone.utc)
+        self.patient = self.make_patient()
+        self.first = self.make_appointment(self.patient, start=self.day, end=self.day + timedelta(minutes=30))
+        self.second = self.make_appointment(start=self.day + timedelta(hours=1), end=self.day + timedelta(hours=2))
+        self.range = {'start_after': '2021-03-01', 'start_before': '2021-03-01'}
+
+    def sync(self):
+        response = self.client.get('/api/appointments/changes', self.range)
+        self.assertEqual(response.status_code, 200)
+        # Everything so far happened well before the next poll's overlap window
+        hour_ago = timezone.now() - timedelta(hours=1)
+        Appointment.objects.update(updated_at=hour_ago)
+        Patient.objects.update(updated_at=hour_ago)
+        return response
+
+    def poll(self, cursor, **params):
+        return self.client.get('/api/appointments/changes', {**self.range, 'since': cursor, **params})
+
+    def test_full_sync_then_quiet_poll(self):
+        response = self.sync()
+        self.assertEqual([row['id'] for row in response.data['updated']], [self.first.pk, self.second.pk])
+        self.assertEqual(response.data['removed'], [])
+
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.poll(response.data['cursor'])
+        self.assertEqual(len(ctx.captured_queries), 2)
+        self.assertEqual((response.data['updated'], response.data['removed']), ([], []))
+
+    def test_updates_and_patient_edits(self):
+        cursor = self.sync().data['cursor']
+        self.client.patch('/api/appointments/%d' % self.second.pk, {'notes': 'Late'}, format='json')
+        Patient.objects.get(pk=self.patient.pk).save()
+
+        response = self.poll(cursor, fields='id,notes')
+        self.assertEqual(response.data['updated'], [{'id': self.first.pk, 'notes': None},
+                                                    {'id': self.second.pk, 'notes': 'Late'}])
+        self.assertGreater(int(response.data['cursor']), int(cursor))
+
+    def test_deleted_and_moved_away(self):
+        cursor = self.sync().data['cursor']
+        self.assertEqual(self.client.delete('/api/appointments/%d' % self.first.pk).status_code, 204)
+        moved = self.day + timedelta(days=3)
+        self.client.patch('/api/appointments/%d' % self.second.pk,
+                          {'start': moved.isoformat(), 'end': (moved + timedelta(hours=1)).isoformat()}, format='json')
+
+        response = self.poll(cursor)
+        self.assertEqual(response.data['removed'], sorted([self.first.pk, self.second.pk]))
+        self.assertEqual(response.data['updated'], [])
+
+        # The day it moved to sees it as an update, not a removal
+        response = self.poll(cursor, start_after='2021-03-04', start_before='2021-03-04')
+        self.assertEqual(response.data['removed'], [])
+        self.assertEqual([row['id'] for row in response.data['updated']], [self.second.pk])
+
+    def test_invalid_and_expired_cursors(self):
+        self.assertEqual(self.client.get('/api/appointments/changes').status_code, 400)
+        self.assertEqual(self.poll('yesterday').status_code, 400)
+        old = encode_cursor(timezone.now() - RETENTION - timedelta(hours=1))
+        self.assertEqual(self.poll(old).status_code, 410)
+
+    def test_prune_tombstones(self):
+        self.first.delete()
+        AppointmentTombstone.objects.update(removed_at=timezone.now() - RETENTION - timedelta(hours=1))
+        pk = self.second.pk
+        self.second.delete()
+        self.assertEqual(prune_tombstones(), 1)
+        self.assertEqual(list(AppointmentTombstone.objects.values_list('appointment_id', flat=True)), [pk])
+
+
+class ArchiveTests(APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.patient = self.make_patient()
+        self.old_day = datetime(2020, 1, 6, 9, tzinfo=dt_timezone.utc)
+        self.old = [self.make_appointment(self.patient, start=self.old_day + timedelta(hours=i),
+                                          end=self.old_day + timedelta(hours=i, minutes=30), status='DO')
+                    for i in range(3)]
+        self.old_open = self.make_appointment(self.patient, start=self.old_day + timedelta(hours=5),
+                                              end=self.old_day + timedelta(hours=6))
+        self.recent = self.make_appointment(self.patient, status='DO')
+        self.old_range = {'start_after': '2020-01-06', 'start_before': '2020-01-06'}
+
+    def archive(self):
+        call_command('archive_appointments', batch_size=2, stdout=StringIO())
+
+    def test_moves_old_done_appointments_in_batches(self):
+        before = self.client.get('/api/appointments', {**self.old_range, 'ordering': 'start'}).data
+        self.archive()
+        self.assertEqual(sorted(ArchivedAppointment.objects.values_list('id', flat=True)), [a.pk for a in self.old])
+        self.assertEqual(sorted(Appointment.objects.values_list('id', flat=True)), [self.old_open.pk, self.recent.pk])
+        self.assertFalse(AppointmentTombstone.objects.exists())
+
+        # Historical ranges read through to the archive, same rows and shape
+        with CaptureQueriesContext(connection) as ctx:
+            after = self.client.get('/api/appointments', {**self.old_range, 'ordering': 'start'}).data
+        self.assertEqual(json.loads(json.dumps(after, default=str)), json.loads(json.dumps(before, default=str)))
+        self.assertIn('api_appointment_history', ctx.captured_queries[-1]['sql'])
+
+        response = self.client.get('/api/appointments', {**self.old_range, 'pagination': 'cursor'})
+        self.assertEqual([row['id'] for row in response.data['results']], [a.pk for a in self.old] + [self.old_open.pk])
+        response = self.client.get('/api/appointments/occupancy', self.old_range)
+        self.assertEqual(response.data['results'][0]['total'], 4)
+
+        # A patient's whole history includes archived visits
+        response = self.client.get('/api/appointments', {'patient': self.patient.pk, 'ordering': '-start'})
+        self.assertEqual(len(response.data), 5)
+
+    def test_archived_detail_and_change_feed(self):
+        url = '/api/appointments/%d' % self.old[0].pk
+        Appointment.objects.update(updated_at=self.old_day)
+        Patient.objects.update(updated_at=self.old_day)
+        before = self.client.get(url)
+        self.archive()
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((response.data, response['ETag']), (before.data, before['ETag']))
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=before['ETag']).status_code, 304)
+        self.assertEqual(self.client.patch(url, {'status': 'SC'}).status_code, 404)
+        self.assertEqual(self.client.delete(url).status_code, 404)
+
+        response = self.client.get('/api/appointments/changes', self.old_range)
+        self.assertEqual([row['id'] for row in response.data['updated']],
+                         [a.pk for a in self.old] + [self.old_open.pk])
+        # Archiving isn't a change
+        since = encode_cursor(timezone.now() - timedelta(minutes=1))
+        response = self.client.get('/api/appointments/changes', {**self.old_range, 'since': since})
+        self.assertEqual((response.data['updated'], response.data['removed']), ([], []))
+
+    def test_invalidates_charts_and_resyncs_streams(self):
+        chart = self.client.get('/api/patients/%d/chart' % self.patient.pk)
+        with mock.patch('api.archive.publish_resync') as publish_resync:
+            self.archive()
+        # Two batches of two and one
+        self.assertEqual(publish_resync.call_count, 2)
+        self.assertFalse(AppointmentTombstone.objects.filter(appointment_id__in=[a.pk for a in self.old]).exists())
+        response = self.client.get('/api/patients/%d/chart' % self.patient.pk, HTTP_IF_NONE_MATCH=chart['ETag'])
+        self.assertEqual(response.status_code, 200)
+
+    def test_current_reads_stay_on_hot_table(self):
+        self.archive()
+        today = timezone.now().date().isoformat()
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get('/api/appointments', {'start_after': today, 'start_before': today})
+        self.assertEqual([row['id'] for row in response.data], [self.recent.pk])
+        self.assertNotIn('api_appointment_history', ' '.join(q['sql'] for q in ctx.captured_queries))
+        self.assertEqual(len(self.client.get('/api/appointments').data), 2)
+
+    def test_dry_run_and_export(self):
+        out = StringIO()
+        call_command('archive_appointments', dry_run=True, stdout=out)
+        self.assertIn('3 appointments would be archived', out.getvalue())
+        self.assertFalse(ArchivedAppointment.objects.exists())
+        self.archive()
+        self.user.is_staff = True
+        self.user.save()
+        response = self.client.get('/api/export/appointments.ndjson')
+        self.assertEqual(len(b''.join(response.streaming_content).splitlines()), 5)
+
+
+class PatientStatsTests(APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.patient = self.make_patient()
+        self.day = timezone.now().replace(microsecond=0) - timedelta(days=400)
+
+    def visit(self, patient, days, status='DO'):
+        start = self.day + timedelta(days=days)
+        return self.make_appointment(patient, start=start, end=start + timedelta(minutes=30), status=status)
+
+    def stats(self, patient=None):
+        return PatientStats.objects.get(patient=patient or self.patient)
+
+    def test_updated_on_appointment_writes(self):
+        self.assertEqual(self.stats().appointment_count, 0)
+        first = self.visit(self.patient, 0)
+        missed = self.visit(self.patient, 10, status='SC')
+        self.visit(self.patient, 20)
+        stats = self.stats()
+        self.assertEqual((stats.appointment_count, stats.visit_count, stats.no_show_count), (3, 2, 1))
+        self.assertAlmostEqual(stats.no_show_rate, 1 / 3)
+        self.assertEqual((stats.first_visit, stats.last_visit), (first.start, self.day + timedelta(days=20)))
+
+        # Status transitions through the API
+        self.client.patch('/api/appointments/%d' % missed.pk, {'status': 'DO'}, format='json')
+        stats = self.stats()
+        self.assertEqual((stats.visit_count, stats.no_show_count, stats.no_show_rate), (3, 0, 0.0))
+
+        other = self.make_patient()
+        self.client.patch('/api/appointments/%d' % missed.pk, {'patient': other.pk}, format='json')
+        self.assertEqual((self.stats().visit_count, self.stats(other).visit_count), (2, 1))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.delete('/api/appointments/%d' % first.pk)
+        self.assertEqual(self.stats().first_visit, self.day + timedelta(days=20))
+
+        # Archived visits still count, and deleting a patient takes their appointments and stats along
+        call_command('archive_appointments', stdout=StringIO())
+        self.visit(self.patient, 30)
+        self.assertEqual(self.stats().visit_count, 2)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.patient.delete()
+        self.assertFalse(PatientStats.objects.filter(patient_id=self.patient.pk).exists())
+
+    def test_patient_queryset_delete(self):
+        # The admin's "delete selected" path: the appointments' stats updates mustn't recreate the patient's row
+        self.visit(self.patient, 0)
+        self.visit(self.patient, 10)
+        kept = self.make_patient()
+        self.visit(kept, 0)
+        with self.captureOnCommitCallbacks(execute=True):
+            Patient.objects.filter(pk=self.patient.pk).delete()
+        self.assertFalse(PatientStats.objects.filter(patient_id=self.patient.pk).exists())
+        self.assertEqual(self.stats(kept).visit_count, 1)
+        connection.check_constraints()
+
+    def test_rebuild(self):
+        self.visit(self.patient, 0)
+        PatientStats.objects.all().delete()
+        call_command('rebuild_patient_stats', batch_size=1, stdout=StringIO())
+        self.assertEqual(self.stats().visit_count, 1)
+
+    def test_patient_list_filters_and_ordering(self):
+        recent, never = self.make_patient(), self.make_patient()
+        self.visit(self.patient, 0)
+        self.visit(recent, 390)
+        self.visit(recent, 391, status='SC')
+
+        year_ago = (timezone.now() - timedelta(days=365)).date().isoformat()
+        response = self.client.get('/api/patients', {'last_visit_before': year_ago})
+        self.assertEqual([row['id'] for row in response.data], [self.patient.pk])
+        self.assertEqual(response.data[0]['stats']['visit_count'], 1)
+
+        response = self.client.get('/api/patients', {'ordering': '-last_visit,id', 'visit_count_min': 1})
+        self.assertEqual([row['id'] for row in response.data], [recent.pk, self.patient.pk])
+        response = self.client.get('/api/patients', {'no_show_rate_min': '0.5'})
+        self.assertEqual([row['id'] for row in response.data], [recent.pk])
+        response = self.client.get('/api/patients', {'visit_count_max': 0})
+        self.assertEqual([row['id'] for row in response.data], [never.pk])
+
+
+class OverlapTests(APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.patient = self.make_patient()
+        self.day = datetime(2021, 3, 1, tzinfo=dt_timezone.utc)
+        self.booked = self.make_appointment(self.patient, start=self.day.replace(hour=9),
+                                            end=self.day.replace(hour=10))
+
+    def post(self, start_hour, end_hour):
+        return self.client.post('/api/appointments', {
+            'patient': self.patient.id,
+            'start': self.day.replace(hour=start_hour).isoformat(),
+            'end': self.day.replace(hour=end_hour).isoformat(),
+        })
+
+    def test_rejects_overlapping_create(self):
+        response = self.post(8, 10)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('#%d' % self.booked.id, response.data['non_field_errors'][0])
+        self.assertEqual(self.post(10, 11).status_code, 201)
+        self.assertEqual(self.post(11, 11).status_code, 400)
+
+    def test_update_ignores_itself(self):
+        url = '/api/appointments/%d' % self.booked.id
+        self.assertEqual(self.client.patch(url, {'end': self.day.replace(hour=11).isoformat()}).status_code, 200)
+        self.post(12, 13)
+        self.assertEqual(self.client.patch(url, {'end': self.day.replace(hour=13).isoformat()}).status_code, 400)
+
+    def test_check_holds_schedule_lock(self):
+        with mock.patch('api.serializers.lock_schedule') as lock_schedule:
+            self.assertEqual(self.post(10, 11).status_code, 201)
+            self.assertEqual(lock_schedule.call_count, 1)
+            self.client.patch('/api/appointments/%d' % self.booked.id, {'status': 'CI'})
+            self.assertEqual(lock_schedule.call_count, 1)
+
+    def test_status_change_skips_check(self):
+        # Imported rows can already overlap, checking in and completing them still works
+        double = self.make_appointment(self.patient, start=self.day.replace(hour=9, minute=30),
+                                       end=self.day.replace(hour=10, minute=30))
+        url = '/api/appointments/%d' % double.id
+        self.assertEqual(self.client.patch(url, {'status': 'CI'}).status_code, 200)
+        self.assertEqual(self.client.put(url, {
+            'patient': self.patient.id, 'start': double.start.isoformat(), 'end': double.end.isoformat(),
+            'status': 'DO'}).status_code, 200)
+        moved = self.day.replace(hour=9, minute=45).isoformat()
+        self.assertEqual(self.client.patch(url, {'start': moved}).status_code, 400)
+
+    def test_free_slots(self):
+        self.make_appointment(self.patient, start=self.day.replace(hour=10, minute=15),
+                              end=self.day.replace(hour=11))
+        response = self.client.get('/api/appointments/free_slots', {
+            'start': self.day.replace(hour=8).isoformat(), 'end': self.day.replace(hour=12).isoformat(),
+            'duration': 30})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, [
+            {'start': '2021-03-01T08:00:00Z', 'end': '2021-03-01T09:00:00Z'},
+            {'start': '2021-03-01T11:00:00Z', 'end': '2021-03-01T12:00:00Z'},
+        ])
+
+
+class ConditionalDetailTests(APITestCase):
+    def test_etag_and_last_modified(self):
+        appointment = self.make_appointment()
+        url = '/api/appointments/%d' % appointment.id
+        response = self.client.get(url)
+        etag, last_modified = response['ETag'], response['Last-Modified']
+
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(len(ctx.captured_queries), 1)
+        self.assertEqual(self.client.get(url, HTTP_IF_MODIFIED_SINCE=last_modified).status_code, 304)
+
+        # Changes to the nested patient invalidate the appointment too
+        self.client.patch('/api/patients/%d' % appointment.patient.id, {'first_name': 'Renamed'})
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['patient']['first_name'], 'Renamed')
+
+    def test_if_match_prevents_lost_updates(self):
+        patient = self.make_patient()
+        url = '/api/patients/%d' % patient.id
+        etag = self.client.get(url)['ETag']
+        response = self.client.patch(url, {'first_name': 'A'}, HTTP_IF_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        response = self.client.patch(url, {'first_name': 'B'}, HTTP_IF_MATCH=etag)
+        self.assertEqual(response.status_code, 412)
+        self.assertEqual(Patient.objects.get(pk=patient.pk).first_name, 'A')
+
+    def test_etag_varies_with_fields(self):
+        patient = self.make_patient()
+        url = '/api/patients/%d' % patient.id
+        full = self.client.get(url)['ETag']
+        sparse = self.client.get(url, {'fields': 'id,first_name'})['ETag']
+        self.assertNotEqual(full, sparse)
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=sparse).status_code, 200)
+        self.assertEqual(self.client.get(url + '?fields=id,first_name', HTTP_IF_NONE_MATCH=sparse).status_code, 304)
+        # If-Match is checked against the representation of the URL written to
+        response = self.client.patch(url + '?fields=id,first_name', {'first_name': 'A'}, HTTP_IF_MATCH=sparse)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['ETag'], self.client.get(url)['ETag'])
+
+    def test_missing_object(self):
+        self.assertEqual(self.client.get('/api/progress_notes/999', HTTP_IF_NONE_MATCH='*').status_code, 404)
+
+
+class CachedTokenAuthenticationTests(APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.token = Token.objects.create(user=self.user)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + self.token.key)
+
+    def test_caches_token_lookup(self):
+        self.assertEqual(self.client.get('/api/allergies').status_code, 200)
+        with CaptureQueriesContext(connection) as ctx:
+            self.assertEqual(self.client.get('/api/allergies').status_code, 200)
+        self.assertEqual(len(ctx.captured_queries), 0)
+
+    def test_caches_only_auth_fields(self):
+        self.user.is_staff = True
+        self.user.save()
+        self.client.get('/api/allergies')
+        entry = cache.get(token_cache_key(self.token.key))
+        self.assertEqual(set(entry), {'user_id', 'created', 'is_active', 'is_staff', 'is_superuser'})
+
+        # Served from the cached entry, the rest of the user loads when used and saves don't clobber it
+        self.assertEqual(self.client.get('/api/export/appointments.csv').status_code, 200)
+        response = self.client.patch('/api/auth/users/me/', {'email': 'new@example.com'})
+        self.assertEqual((response.status_code, response.data['username']), (200, self.user.username))
+        user = User.objects.get(pk=self.user.pk)
+        self.assertEqual((user.email, user.password, user.is_staff), ('new@example.com', self.user.password, True))
+
+    def test_logout_invalidates_immediately(self):
+        self.assertEqual(self.client.get('/api/allergies').status_code, 200)
+        self.assertEqual(self.client.post('/api/auth/token/logout/').status_code, 204)
+        self.assertEqual(self.client.get('/api/allergies').status_code, 401)
+
+    @override_settings(TOKEN_IDLE_TIMEOUT=3600, TOKEN_REFRESH_INTERVAL=60)
+    def test_sliding_expiry(self):
+        Token.objects.filter(pk=self.token.pk).update(created=timezone.now() - timedelta(minutes=30))
+        self.assertEqual(self.client.get('/api/allergies').status_code, 200)
+        self.assertGreater(Token.objects.get(pk=self.token.pk).created, timezone.now() - timedelta(minutes=1))
+
+        cache.clear()
+        Token.objects.filter(pk=self.token.pk).update(created=timezone.now() - timedelta(hours=2))
+        self.assertEqual(self.client.get('/api/allergies').status_code, 401)
+        self.assertFalse(Token.objects.filter(pk=self.token.pk).exists())
+
+    @override_settings(TOKEN_IDLE_TIMEOUT=60, TOKEN_REFRESH_INTERVAL=300)
+    def test_idle_timeout_shorter_than_refresh(self):
+        self.assertEqual([e.id for e in check_token_settings(None)], ['api.E001'])
+        # The async path checks expiry on cache hits too
+        self.assertEqual(self.client.get('/api/allergies').status_code, 200)
+        entry = cache.get(token_cache_key(self.token.key))
+        cache.set(token_cache_key(self.token.key), dict(entry, created=timezone.now() - timedelta(minutes=2)))
+        response = Client().get('/api/async/patients', HTTP_AUTHORIZATION='Token ' + self.token.key)
+        self.assertEqual(response.status_code, 401)
+        self.assertFalse(Token.objects.filter(pk=self.token.pk).exists())
+
+
+class ExportTests(APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.user.is_staff = True
+        self.user.save()
+        patient = self.make_patient(dob=date(1980, 5, 17))
+        self.make_progress_note(patient)
+        self.make_progress_note(patient, weight='151.50')
+        self.make_appointment(patient)
+
+    def test_csv(self):
+        response = self.client.get('/api/export/progress_notes.csv')
+        self.assertEqual(response.status_code, 200)
+        rows = list(csv.DictReader(StringIO(b''.join(response.streaming_content).decode())))
+        self.assertEqual(len(rows), 2)
+        self.assertEqual(rows[1]['weight'], '151.50')
+        self.assertEqual(rows[1]['patient_dob'], '05/17/1980')
+        self.assertEqual(rows[1]['patient_insurance_provider_name'], 'Acme')
+        self.assertEqual(rows[1]['allergies'], 'Peanuts')
+
+    def test_gzipped_ndjson(self):
+        response = self.client.get('/api/export/appointments.ndjson', {'gzip': '1'})
+        self.assertEqual(response['Content-Type'], 'application/gzip')
+        rows = [json.loads(line) for line in gzip.decompress(b''.join(response.streaming_content)).splitlines()]
+        self.assertEqual(rows[0]['patient_first_name'], 'First1')
+        self.assertEqual(rows[0]['status'], 'SC')
+
+    async def test_streams_asynchronously_under_asgi(self):
+        # A sync iterator would be buffered whole by the ASGI handler
+        token = await sync_to_async(Token.objects.create)(user=self.user)
+        response = await self.async_client.get('/api/export/progress_notes.ndjson',
+                                               headers={'Authorization': 'Token ' + token.key})
+        self.assertTrue(response.is_async)
+        lines = [line async for line in response.streaming_content]
+        self.assertEqual([json.loads(line)['weight'] for line in lines], ['150.00', '151.50'])
+
+    def test_queries_do_not_grow_with_rows(self):
+        def run():
+            with CaptureQueriesContext(connection) as ctx:
+                list(ProgressNoteExporter(chunk_size=100).rows())
+            return len(ctx.captured_queries)
+        baseline = run()
+        for _ in range(20):
+            self.make_progress_note()
+        self.assertEqual(run(), baseline)
+
+    def test_staff_only(self):
+        self.user.is_staff = False
+        self.user.save()
+        self.assertEqual(self.client.get('/api/export/patients.csv').status_code, 403)
+
+
+class AsyncViewTests(APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.token = Token.objects.create(user=self.user)
+        self.auth = {'HTTP_AUTHORIZATION': 'Token ' + self.token.key}
+        self.patient = self.make_patient(first_name='Async')
+        for _ in range(3):
+            self.make_appointment(self.patient)
+
+    def assertSameAsSync(self, url, params=None):
+        response = self.client.get(url.replace('/async', ''), params)
+        async_response = Client().get(url, params, **self.auth)
+        self.assertEqual(async_response.status_code, response.status_code)
+        # Same body apart from the path in next/previous links
+        self.assertEqual(async_response.content.replace(b'/api/async/', b'/api/'), response.content)
+
+    def test_matches_sync_views(self):
+        self.assertSameAsSync('/api/async/appointments')
+        self.assertSameAsSync('/api/async/appointments', {'ordering': '-start', 'limit': 2, 'offset': 1})
+        self.assertSameAsSync('/api/async/appointments', {'patient': self.patient.id, 'pagination': 'cursor'})
+        self.assertSameAsSync('/api/async/patients', {'search': 'asy'})
+        self.assertSameAsSync('/api/async/patients/%d' % self.patient.id)
+
+    def test_errors(self):
+        self.assertEqual(Client().get('/api/async/patients').status_code, 401)
+        self.assertEqual(Client().get('/api/async/patients/999', **self.auth).status_code, 404)
+        self.assertEqual(Client().post('/api/async/patients', **self.auth).status_code, 405)
+
+
+class EventStreamTests(APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.token = Token.objects.create(user=self.user)
+        self.patient = self.make_patient()
+        self.day = datetime(2021, 3, 1, 9, tzinfo=dt_timezone.utc)
+
+    async def open_stream(self, **params):
+        response = await self.async_client.get('/api/appointments/events', params,
+                                               headers={'Authorization': 'Token ' + self.token.key})
+        self.assertEqual(response.status_code, 200)
+        stream = response.streaming_content.__aiter__()
+        self.assertIn(b'event: ready', await stream.__anext__())
+        return stream
+
+    async def next_event(self, stream):
+        chunk = await asyncio.wait_for(stream.__anext__(), 5)
+        lines = dict(line.split(': ', 1) for line in chunk.decode().strip().split('\n'))
+        return lines['event'], json.loads(lines['data'])
+
+    def committed(self, func, *args, **kwargs):
+        with self.captureOnCommitCallbacks(execute=True):
+            return func(*args, **kwargs)
+
+    async def test_pushes_changes_in_range(self):
+        stream = await self.open_stream(start_after='2021-03-01', start_before='2021-03-01')
+        other_day = self.day + timedelta(days=5)
+        await sync_to_async(self.committed)(self.make_appointment, self.patient, start=other_day,
+                                            end=other_day + timedelta(minutes=30))
+        appointment = await sync_to_async(self.committed)(
+            self.make_appointment, self.patient, start=self.day, end=self.day + timedelta(minutes=30))
+
+        # The other day's appointment was filtered out
+        event, data = await self.next_event(stream)
+        self.assertEqual((event, data['action'], data['id']), ('appointment', 'created', appointment.pk))
+        self.assertEqual(data['appointment']['patient']['id'], self.patient.pk)
+
+        moved = self.day + timedelta(days=1)
+        await sync_to_async(self.committed)(self.client.patch, '/api/appointments/%d' % appointment.pk, {
+            'start': moved.isoformat(), 'end': (moved + timedelta(minutes=30)).isoformat()}, format='json')
+        event, data = await self.next_event(stream)
+        self.assertEqual((data['action'], data['previous']['start']), ('updated', self.day.isoformat().replace('+00:00', 'Z')))
+
+        await sync_to_async(self.committed)(self.client.delete, '/api/appointments/%d' % appointment.pk)
+        await sync_to_async(self.committed)(self.client.post, '/api/appointments/bulk', [{
+            'patient': self.patient.pk, 'start': '2021-03-10T09:00:00Z', 'end': '2021-03-10T09:30:00Z'}],
+            format='json')
+        # Moved out of range already, so its delete isn't sent
+        event, data = await self.next_event(stream)
+        self.assertEqual((event, data['action']), ('resync', 'resync'))
+        await stream.aclose()
+
+    async def test_rejects_bad_filters(self):
+        response = await self.async_client.get('/api/appointments/events', {'start_after': 'soon'},
+                                               headers={'Authorization': 'Token ' + self.token.key})
+        self.assertEqual(response.status_code, 400)
+        response = await self.async_client.get('/api/appointments/events')
+        self.assertEqual(response.status_code, 401)
+
+    def test_publish_without_subscribers_or_broker(self):
+        with mock.patch('api.events.AppointmentSerializer') as serializer:
+            self.committed(self.make_appointment, self.patient)
+        serializer.assert_not_called()
+
+        class DownBroker(LocalBroker):
+            def has_subscribers(self, channel):
+                return True
+
+            def publish(self, channel, message):
+                raise ConnectionError('broker down')
+        with mock.patch('api.events.get_broker', return_value=DownBroker()):
+            with self.assertLogs(level='ERROR'):
+                response = self.committed(self.client.post, '/api/appointments', {
+                    'patient': self.patient.pk, 'start': '2021-03-02T09:00:00Z', 'end': '2021-03-02T09:30:00Z'})
+        self.assertEqual(response.status_code, 201)
+
+    async def test_slow_subscriber_resyncs(self):
+        broker = LocalBroker()
+        broker.max_pending = 2
+        subscription = broker.subscribe(APPOINTMENTS)
+        for message in [b'1', b'2', b'3', b'4']:
+            broker.publish(APPOINTMENTS, message)
+        await asyncio.sleep(0)
+        self.assertEqual([await subscription.get() for _ in range(3)], [b'1', b'2', None])
+        self.assertTrue(subscription.queue.empty())
+        subscription.close()
+        self.assertEqual(broker.subscriptions[APPOINTMENTS], set())
+
+
+class VitalsTests(APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.patient = self.make_patient()
+        readings = [(datetime(2020, 1, 5, tzinfo=dt_timezone.utc), '150.00', '180.00', 120),
+                    (datetime(2020, 1, 20, tzinfo=dt_timezone.utc), '160.00', '180.00', 130),
+                    (datetime(2020, 3, 1, tzinfo=dt_timezone.utc), '155.00', '180.00', 110)]
+        for created_at, weight, height, sys in readings:
+            note = self.make_progress_note(self.patient, weight=weight, height=height, blood_pressure_sys=sys)
+            ProgressNote.objects.filter(pk=note.pk).update(created_at=created_at)
+        self.make_progress_note()
+
+    def test_columnar_series(self):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get('/api/patients/%d/vitals' % self.patient.id)
+        self.assertEqual(len(ctx.captured_queries), 2)
+        self.assertEqual(response.data['weight'], [150.0, 160.0, 155.0])
+        self.assertEqual(response.data['blood_pressure_sys'], [120, 130, 110])
+        # 150 lb at 180 cm
+        self.assertEqual(response.data['bmi'][0], 21.0)
+        self.assertEqual(len(response.data['timestamps']), 3)
+
+    def test_downsampled(self):
+        response = self.client.get('/api/patients/%d/vitals' % self.patient.id,
+                                   {'bucket': 'month', 'start': '2020-01-01T00:00:00Z'})
+        self.assertEqual(response.data['count'], [2, 1])
+        self.assertEqual(response.data['weight'], {'min': [150.0, 155.0], 'mean': [155.0, 155.0],
+                                                   'max': [160.0, 155.0]})
+        self.assertEqual(response.data['timestamps'][1], datetime(2020, 3, 1, tzinfo=dt_timezone.utc))
+
+    def test_errors(self):
+        self.assertEqual(self.client.get('/api/patients/999/vitals').status_code, 404)
+        response = self.client.get('/api/patients/%d/vitals' % self.patient.id, {'bucket': 'hour'})
+        self.assertEqual(response.status_code, 400)
+
+
+class PatientChartTests(APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.patient = self.make_patient()
+        now = timezone.now()
+        self.past = self.make_appointment(self.patient, start=now - timedelta(days=3),
+                                          end=now - timedelta(days=3) + timedelta(minutes=30))
+        self.upcoming = self.make_appointment(self.patient, start=now + timedelta(days=3),
+                                              end=now + timedelta(days=3) + timedelta(minutes=30))
+        self.url = '/api/patients/%d/chart' % self.patient.pk
+
+    def test_summary_in_fixed_queries(self):
+        for _ in range(2):
+            self.make_progress_note(self.patient)
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(self.url)
+        queries = len(ctx.captured_queries)
+
+        # More history costs no extra queries
+        cache.clear()
+        for _ in range(5):
+            self.make_progress_note(self.patient).allergies.add(Allergy.objects.create(name='Extra%d' % _))
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(self.url)
+        self.assertEqual(len(ctx.captured_queries), queries)
+        self.assertLessEqual(queries, 7)
+
+        data = response.data
+        self.assertEqual(data['patient']['insurance_provider']['name'], 'Acme')
+        self.assertEqual(data['latest_vitals']['blood_pressure_sys'], 120)
+        allergies = {a['name']: a['notes'] for a in data['allergies']}
+        self.assertEqual(len(allergies), 6)
+        self.assertEqual(allergies['Peanuts'], 7)
+        self.assertEqual(data['appointments']['total'], 2)
+        self.assertEqual(data['appointments']['upcoming'], 1)
+        self.assertEqual(data['appointments']['past'], 1)
+        self.assertEqual(data['appointments']['next'], self.upcoming.start)
+
+    def test_cached_and_invalidated(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.data['latest_vitals'], None)
+        with CaptureQueriesContext(connection) as ctx:
+            cached = self.client.get(self.url)
+        self.assertEqual(len(ctx.captured_queries), 0)
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=cached['ETag']).status_code, 304)
+
+        note = self.make_progress_note(self.patient)
+        response = self.client.get(self.url)
+        self.assertEqual(response.data['latest_vitals']['note'], note.pk)
+        self.assertEqual([d['name'] for d in response.data['diagnoses']], ['Flu'])
+
+        note.diagnoses.remove(self.diagnosis)
+        self.assertEqual(self.client.get(self.url).data['diagnoses'], [])
+
+        self.client.delete('/api/appointments/%d' % self.upcoming.pk)
+        self.assertEqual(self.client.get(self.url).data['appointments']['total'], 1)
+
+        # Renames go through the vocabulary's cache version
+        self.allergy.name = 'Tree nuts'
+        self.allergy.save()
+        self.assertEqual(self.client.get(self.url).data['allergies'][0]['name'], 'Tree nuts')
+
+        self.assertEqual(self.client.get('/api/patients/999/chart').status_code, 404)
+
+
+class SparseFieldsTests(APITestCase):
+    def get(self, url, params):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url, params)
+        self.assertEqual(response.status_code, 200, response.content)
+        return response, [q['sql'] for q in ctx.captured_queries]
+
+    def test_fields_skip_unrequested_relations(self):
+        self.make_appointment()
+        response, queries = self.get('/api/appointments', {'fields': 'id,start,status'})
+        self.assertEqual(list(response.data[0]), ['id', 'start', 'status'])
+        self.assertFalse(any('"api_patient"' in sql for sql in queries))
+
+    def test_expand(self):
+        appointment = self.make_appointment()
+        response, queries = self.get('/api/appointments/%d' % appointment.pk, {'expand': 'patient'})
+        self.assertEqual(response.data['patient']['id'], appointment.patient_id)
+        self.assertEqual(response.data['patient']['insurance_provider'], self.provider.pk)
+        self.assertFalse(any('"api_insuranceprovider"' in sql for sql in queries))
+
+        response, _ = self.get('/api/appointments', {'expand': 'patient.insurance_provider'})
+        self.assertEqual(response.data[0]['patient']['insurance_provider']['name'], 'Acme')
+        response, _ = self.get('/api/appointments', {'expand': ''})
+        self.assertEqual(response.data[0]['patient'], appointment.patient_id)
+        # Defaults are unchanged
+        response, _ = self.get('/api/appointments', {})
+        self.assertEqual(response.data[0]['patient']['insurance_provider']['name'], 'Acme')
+
+    def test_progress_note_prefetches(self):
+        note = self.make_progress_note()
+        _, full = self.get('/api/progress_notes', {})
+        response, sparse = self.get('/api/progress_notes', {'fields': 'id,allergies', 'expand': ''})
+        self.assertEqual(response.data, [{'id': note.pk, 'allergies': [self.allergy.pk]}])
+        self.assertEqual(len(full) - len(sparse), 2)
+
+    def test_invalid_and_writes(self):
+        self.assertEqual(self.client.get('/api/patients', {'fields': 'id,nope'}).status_code, 400)
+        self.assertEqual(self.client.get('/api/patients', {'expand': 'patient'}).status_code, 400)
+        # Detail responses have no stats to expand
+        patient = self.make_patient()
+        self.assertEqual(self.client.get('/api/patients', {'expand': 'stats'}).status_code, 200)
+        self.assertEqual(self.client.get('/api/patients/%d' % patient.pk, {'expand': 'stats'}).status_code, 400)
+        response = self.client.post('/api/allergies?fields=id', {'name': 'Latex'})
+        self.assertEqual(response.data['name'], 'Latex')
+        self.assertEqual(list(self.client.get('/api/allergies', {'fields': 'name'}).data[0]), ['name'])
+
+
+class SchemaTests(TestCase):
+    def test_documents_every_api_view(self):
+        # drf-spectacular leaves out views it can't find a serializer for
+        from drf_spectacular.generators import SchemaGenerator
+        paths = SchemaGenerator().get_schema(public=True)['paths']
+        for path in ['/api/appointments/occupancy', '/api/appointments/free_slots', '/api/appointments/bulk',
+                     '/api/progress_notes/bulk', '/api/export/{kind}.{fmt}', '/api/patients/{id}/vitals',
+                     '/api/patients/{id}/chart', '/api/ping']:
+            self.assertIn('get' if 'bulk' not in path else 'post', paths.get(path, {}), path)
+        content = paths['/api/patients/{id}/chart']['get']['responses']['200']['content']
+        self.assertEqual(content['application/json']['schema'], {'$ref': '#/components/schemas/PatientChart'})
+
+
+class ProfilingTests(APITestCase):
+    def test_disabled_by_default(self):
+        self.assertNotIn('Server-Timing', self.client.get('/api/patients'))
+
+    @override_settings(API_PROFILING=True, API_SLOW_REQUEST_MS=0)
+    def test_server_timing_and_slow_log(self):
+        self.make_appointment()
+        with self.assertLogs('api.profiling', 'WARNING') as logs:
+            with CaptureQueriesContext(connection) as ctx:
+                response = self.client.get('/api/appointments')
+        timing = response['Server-Timing']
+        for metric in ('total', 'db', 'auth', 'serialize', 'render'):
+            self.assertIn('%s;dur=' % metric, timing)
+        record = json.loads(logs.records[0].getMessage())
+        self.assertEqual(record['path'], '/api/appointments')
+        self.assertEqual(record['queries'], len(ctx.captured_queries))
+        self.assertIn('(%d queries)' % record['queries'], timing)
+
+    @override_settings(API_PROFILING=True, API_SLOW_REQUEST_MS=10000)
+    async def test_async_mode(self):
+        async def get_response(request):
+            return HttpResponse()
+        middleware = ProfilingMiddleware(get_response)
+        self.assertTrue(iscoroutinefunction(middleware))
+        response = await middleware(RequestFactory().get('/api/patients'))
+        self.assertIn('total;dur=', response['Server-Timing'])
+
+    def test_top_repeated_queries(self):
+        profile = Profile()
+        for sql in ['SELECT 1', 'SELECT 2', 'SELECT 2', 'SELECT 3', 'SELECT 3', 'SELECT 3']:
+            profile.add_query(sql, 0.001)
+        self.assertEqual(profile.query_count, 6)
+        self.assertEqual([(q['sql'], q['count']) for q in profile.top_queries()], [('SELECT 3', 3), ('SELECT 2', 2)])
+
+
+class SeedAndBenchmarkTests(TestCase):
+    def test_seed_data(self):
+        call_command('seed_data', patients=30, providers=3, appointments=200, progress_notes=50, vocabulary=5,
+                     skew=1.5, status_mix='DO=1', days_back=10, days_ahead=5, seed=1, stdout=StringIO())
+        self.assertEqual(Patient.objects.count(), 30)
+        self.assertEqual(PatientSearchIndex.objects.count(), 30)
+        self.assertEqual(Appointment.objects.count(), 200)
+        past = Appointment.objects.filter(start__lt=timezone.now())
+        self.assertEqual(set(past.values_list('status', flat=True)), {'DO'})
+        self.assertFalse(Appointment.objects.filter(start__gte=timezone.now()).exclude(status='SC').exists())
+        self.assertEqual(ProgressNote.objects.count(), 50)
+
+    def test_benchmark_covers_every_route(self):
+        from .management.commands.benchmark_api import SCENARIOS, uncovered_routes
+        self.assertEqual(uncovered_routes(SCENARIOS), [])
+
+        call_command('seed_data', patients=20, providers=2, appointments=40, progress_notes=20, vocabulary=3,
+                     days_back=5, days_ahead=5, seed=1, stdout=StringIO())
+        with tempfile.TemporaryDirectory() as directory:
+            output = os.path.join(directory, 'results.json')
+            call_command('benchmark_api', iterations=1, warmup=0, output=output, stdout=StringIO(), stderr=StringIO())
+            with open(output) as f:
+                results = json.load(f)
+        self.assertEqual(set(results['results']), {s.name for s in SCENARIOS})
+        self.assertEqual(results['rows']['patient'], 20)
+        self.assertEqual(results['results']['appointment_create']['status'], [201])
+        # Benchmark writes are rolled back
+        self.assertEqual(Patient.objects.count(), 20)
+
+
+@override_settings(DATABASE_REPLICAS=['replica'], REPLICA_PIN_SECONDS=60)
+class ReplicaRoutingTests(TransactionTestCase):
+    """A second SQLite database stands in for a lagging replica"""
+    # Resolved when the class is set up, after the replica alias is added
+    databases = '__all__'
+
+    @classmethod
+    def setUpClass(cls):
+        cls.replica_path = os.path.join(tempfile.mkdtemp(), 'replica.sqlite3')
+        connections.settings['replica'] = dict(connections.settings['default'], NAME=cls.replica_path)
+        super().setUpClass()
+        call_command('migrate', database='replica', verbosity=0)
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        connections['replica'].close()
+        del connections['replica']
+        del connections.settings['replica']
+        os.remove(cls.replica_path)
+
+    def setUp(self):
+        cache.clear()
+        Patient.objects.create(first_name='Primary', last_name='Only')
+        # bulk_create skips the search index signal, which would write to default
+        Patient.objects.using('replica').bulk_create([Patient(first_name='Replica', last_name='Copy')])
+
+    def client_for(self, username):
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION='Token ' + Token.objects.create(
+            user=User.objects.create_user(username)).key)
+        return client
+
+    def names(self, client):
+        return [p['first_name'] for p in client.get('/api/patients').data]
+
+    def test_reads_from_replica_until_write(self):
+        client, other = self.client_for('writer'), self.client_for('reader')
+        self.assertEqual(self.names(client), ['Replica'])
+        self.assertEqual(client.post('/api/patients', {'first_name': 'New', 'last_name': 'Patient'}).status_code, 201)
+        # Read-your-writes for the client that wrote, everyone else stays on the replica
+        self.assertEqual(self.names(client), ['Primary', 'New'])
+        self.assertEqual(self.names(other), ['Replica'])
+        # Pinned by the cookie on another worker, by the cache for clients that drop cookies
+        self.assertTrue(cache.get(pin_key(client._credentials['HTTP_AUTHORIZATION'])))
+        cache.clear()
+        self.assertEqual(self.names(client), ['Primary', 'New'])
+        client.cookies.clear()
+        self.assertEqual(self.names(client), ['Replica'])
+
+    def test_cache_rebuilds_read_from_default(self):
+        # The replica hasn't caught up with these yet
+        provider = InsuranceProvider.objects.create(name='Fresh Provider')
+        primary = Patient.objects.get(first_name='Primary')
+        client = self.client_for('reader')
+        self.assertEqual([p['name'] for p in client.get('/api/insurance_providers').data], ['Fresh Provider'])
+        self.assertEqual(client.get('/api/insurance_providers', {'prefix': 'fre'}).data,
+                         [{'id': provider.id, 'name': 'Fresh Provider'}])
+        response = client.get('/api/patients/%d/chart' % primary.id)
+        self.assertEqual((response.status_code, response.data['patient']['first_name']), (200, 'Primary'))
+        # Uncached reads still go to the replica
+        self.assertEqual(self.names(client), ['Replica'])
+
+    async def test_async_mode(self):
+        from .replicas import ReplicaRoutingMiddleware, current_replica
+
+        async def get_response(request):
+            routed.append(current_replica.get())
+            return HttpResponse(status=201)
+        routed = []
+        middleware = ReplicaRoutingMiddleware(get_response)
+        self.assertTrue(iscoroutinefunction(middleware))
+        factory = RequestFactory(HTTP_AUTHORIZATION='Token abc')
+        await middleware(factory.get('/api/patients'))
+        await middleware(factory.post('/api/patients'))
+        await middleware(factory.get('/api/patients'))
+        self.assertEqual(routed, ['replica', None, None])
+
+    def test_changes_read_from_default(self):
+        # Not on the replica yet, a poll there would move the client's cursor past it
+        primary = Patient.objects.get(first_name='Primary')
+        since = encode_cursor(timezone.now() - timedelta(minutes=1))
+        appointment = Appointment.objects.create(patient=primary, start=timezone.now(),
+                                                 end=timezone.now() + timedelta(minutes=30))
+        response = self.client_for('reader').get('/api/appointments/changes', {'patient': primary.id, 'since': since})
+        self.assertEqual([a['id'] for a in response.data['updated']], [appointment.id])
+
+    def test_transactions_read_from_default(self):
+        from .replicas import ReplicaRouter, current_replica
+        token = current_replica.set('replica')
+        try:
+            self.assertEqual(ReplicaRouter().db_for_read(Patient), 'replica')
+            self.assertIsNone(ReplicaRouter().db_for_read(Token))
+            with transaction.atomic():
+                self.assertIsNone(ReplicaRouter().db_for_read(Patient))
+        finally:
+            current_replica.reset(token)
+
+
+class RendererTests(APITestCase):
+    def test_matches_json_renderer(self):
+        from decimal import Decimal
+        from django.utils.translation import gettext_lazy
+        data = {
+            'decimal': Decimal('150.25'), 'date': date(2021, 3, 1), 'text': gettext_lazy('Done'),
+            'datetime': datetime(2021, 3, 1, 9, 30, 15, 123456, tzinfo=dt_timezone.utc),
+            'timedelta': timedelta(minutes=90), 1: 'int key', 'unicode': 'caf\u00e9 \u2028', 'nested': [None, 1.5, True],
+        }
+        self.assertEqual(FastJSONRenderer().render(data), JSONRenderer().render(data))
+        self.assertEqual(FastJSONRenderer().render(data, 'application/json; indent=2'),
+                         JSONRenderer().render(data, 'application/json; indent=2'))
+
+    def test_float_differences(self):
+        data = {'big': 1e20, 'small': 1.5e-7, 'plain': 0.1}
+        self.assertEqual(FastJSONRenderer().render(data), b'{"big":1e20,"small":1.5e-7,"plain":0.1}')
+        self.assertEqual(JSONRenderer().render(data), b'{"big":1e+20,"small":1.5e-07,"plain":0.1}')
+        self.assertEqual(FastJSONRenderer().render({'nan': float('nan')}), b'{"nan":null}')
+        with self.assertRaises(ValueError):
+            JSONRenderer().render({'nan': float('nan')})
+
+    def test_api_output_unchanged(self):
+        self.make_progress_note(self.make_patient(dob=date(1980, 5, 17)))
+        response = self.client.get('/api/progress_notes')
+        self.assertEqual(response.content, JSONRenderer().render(response.data))
+        self.assertIn(b'"dob":"05/17/1980"', self.client.get('/api/patients').content)
+
+
+@override_settings(API_COMPRESS_MIN_SIZE=200)
+class CompressionTests(APITestCase):
+    def setUp(self):
+        super().setUp()
+        for _ in range(5):
+            self.make_appointment()
+
+    def test_negotiation(self):
+        self.assertEqual(choose_coding('gzip, deflate, br', {'gzip': None, 'br': None}), 'br')
+        self.assertEqual(choose_coding('br;q=0.5, gzip', {'gzip': None, 'br': None}), 'gzip')
+        self.assertEqual(choose_coding('br', {'gzip': None}), None)
+        self.assertEqual(choose_coding('*', {'gzip': None}), 'gzip')
+        self.assertEqual(choose_coding('gzip;q=0', {'gzip': None}), None)
+
+    def test_compresses_large_api_responses(self):
+        plain = self.client.get('/api/appointments')
+        self.assertNotIn('Content-Encoding', plain)
+        response = self.client.get('/api/appointments', HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response['Vary'])
+        self.assertEqual(gzip.decompress(response.content), plain.content)
+        self.assertEqual(int(response['Content-Length']), len(response.content))
+
+    def test_etag_per_encoding(self):
+        url = '/api/insurance_providers'
+        InsuranceProvider.objects.bulk_create([InsuranceProvider(name='Provider %d' % i) for i in range(20)])
+        etag = self.client.get(url)['ETag']
+        response = self.client.get(url, HTTP_ACCEPT_ENCODING='br')
+        self.assertEqual((response['Content-Encoding'], response['ETag']), ('br', etag[:-1] + '-br"'))
+        # Revalidating the encoded copy
+        response = self.client.get(url, HTTP_ACCEPT_ENCODING='br', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual((response.status_code, response['ETag']), (304, etag[:-1] + '-br"'))
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+    def test_if_match_with_encoded_etag(self):
+        appointment = Appointment.objects.first()
+        url = '/api/appointments/%d' % appointment.id
+        self.client.patch(url, {'notes': 'x' * 300})
+        etag = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip')['ETag']
+        self.assertTrue(etag.endswith('-gzip"'))
+        self.assertEqual(self.client.patch(url, {'notes': 'y' * 300}, HTTP_IF_MATCH=etag).status_code, 200)
+
+    async def test_async_mode(self):
+        async def get_response(request):
+            self.assertEqual(request.headers['If-None-Match'], '"v1"')
+            response = HttpResponse(b'{"id": 1}' * 100, content_type='application/json')
+            response['ETag'] = '"v2"'
+            return response
+        middleware = CompressionMiddleware(get_response)
+        self.assertTrue(iscoroutinefunction(middleware))
+        response = await middleware(RequestFactory().get('/api/patients', HTTP_ACCEPT_ENCODING='gzip',
+                                                         HTTP_IF_NONE_MATCH='"v1-gzip"'))
+        self.assertEqual((response['Content-Encoding'], response['ETag']), ('gzip', '"v2-gzip"'))
+        self.assertEqual(gzip.decompress(response.content), b'{"id": 1}' * 100)
+
+    def test_skips_small_and_streaming(self):
+        self.assertNotIn('Content-Encoding', self.client.get('/api/ping', HTTP_ACCEPT_ENCODING='gzip'))
+        self.user.is_staff = True
+        self.user.save()
+        response = self.client.get('/api/export/appointments.csv', HTTP_ACCEPT_ENCODING='gzip')
+        self.assertNotIn('Content-Encoding', response)
+        self.assertEqual(len(b''.join(response.streaming_content).splitlines()), 6)
+
+
+class IndexPageTests(TestCase):
+    def setUp(self):
+        self.build = tempfile.mkdtemp()
+        self.path = os.path.join(self.build, 'index.html')
+        self.write('<!DOCTYPE html><html><body><div id="root"></div>%s</body></html>' % ('<script></script>' * 50))
+        self.settings = override_settings(WHITENOISE_ROOT=self.build)
+        self.settings.enable()
+        self.addCleanup(self.settings.disable)
+
+    def write(self, html, mtime=None):
+        with open(self.path, 'w') as f:
+            f.write(html)
+        if mtime is not None:
+            os.utime(self.path, (mtime, mtime))
+
+    def test_serves_precompressed_with_etag(self):
+        response = self.client.get('/patients/12')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.content.startswith(b'<!DOCTYPE html>'))
+        etag = response['ETag']
+
+        response = self.client.get('/patients/12', HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertTrue(gzip.decompress(response.content).startswith(b'<!DOCTYPE html>'))
+        gzip_etag = response['ETag']
+        self.assertEqual(gzip_etag, etag[:-1] + '-gzip"')
+
+        response = self.client.get('/appointments', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        response = self.client.get('/appointments', HTTP_ACCEPT_ENCODING='gzip', HTTP_IF_NONE_MATCH=gzip_etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(self.client.get('/appointments', HTTP_IF_NONE_MATCH=gzip_etag).status_code, 200)
+
+    def test_reloads_on_mtime_change(self):
+        self.write('<html>v1</html>', mtime=1000000000)
+        self.assertEqual(self.client.get('/').content, b'<html>v1</html>')
+        self.write('<html>v2</html>', mtime=1000000000)
+        # Same mtime, still the cached copy
+        self.assertEqual(self.client.get('/').content, b'<html>v1</html>')
+        self.write('<html>v2</html>', mtime=1000000100)
+        self.assertEqual(self.client.get('/').content, b'<html>v2</html>')
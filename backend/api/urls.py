@@ -1,18 +1,31 @@
-from django.urls import path, include
-from .views import AppointmentList, AppointmentDetail, InsuranceProviderList, PatientList, PatientDetail, PingView, ProgressNoteList, ProgressNoteDetail, AllergyList, MedicationList, DiagnosisList
+from django.urls import path, include, re_path
+from . import async_views
+from .views import AppointmentList, AppointmentBulkImport, AppointmentChanges, AppointmentOccupancy, AppointmentFreeSlots, AppointmentDetail, InsuranceProviderList, PatientList, PatientChart, PatientDetail, PatientVitals, PingView, ProgressNoteList, ProgressNoteBulkImport, ProgressNoteDetail, AllergyList, MedicationList, DiagnosisList, ExportView
 
 urlpatterns = [
     path('ping', PingView.as_view()),
     path('auth/', include('djoser.urls')),
     path('auth/', include('djoser.urls.authtoken')),
     path('appointments', AppointmentList.as_view()),
+    path('appointments/bulk', AppointmentBulkImport.as_view()),
+    path('appointments/changes', AppointmentChanges.as_view()),
+    path('appointments/events', async_views.appointment_events),
+    path('appointments/occupancy', AppointmentOccupancy.as_view()),
+    path('appointments/free_slots', AppointmentFreeSlots.as_view()),
     path('appointments/<int:pk>', AppointmentDetail.as_view()),
     path('patients', PatientList.as_view()),
     path('patients/<int:pk>', PatientDetail.as_view()),
+    path('patients/<int:pk>/vitals', PatientVitals.as_view()),
+    path('patients/<int:pk>/chart', PatientChart.as_view()),
     path('insurance_providers', InsuranceProviderList.as_view()),
     path('progress_notes', ProgressNoteList.as_view()),
+    path('progress_notes/bulk', ProgressNoteBulkImport.as_view()),
     path('progress_notes/<int:pk>', ProgressNoteDetail.as_view()),
     path('allergies', AllergyList.as_view()),
     path('medication', MedicationList.as_view()),
     path('diagnoses', DiagnosisList.as_view()),
+    path('async/appointments', async_views.appointment_list),
+    path('async/patients', async_views.patient_list),
+    path('async/patients/<int:pk>', async_views.patient_detail),
+    re_path(r'^export/(?P<kind>patients|appointments|progress_notes)\.(?P<fmt>csv|ndjson)$', ExportView.as_view()),
 ]
@@ -1,22 +1,52 @@
+from datetime import timedelta
+
+from django.core.handlers.asgi import ASGIRequest
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.http import StreamingHttpResponse
+from django.db.models import Count
+from django.utils import timezone
+from django.utils.cache import patch_cache_control
+from django.utils.http import parse_etags
+from django.db.models.functions import TruncDay, TruncHour
 from django_filters import rest_framework as filters
+from drf_spectacular.types import OpenApiTypes
+from drf_spectacular.utils import OpenApiParameter, OpenApiResponse, extend_schema, inline_serializer
 from rest_framework.filters import OrderingFilter, SearchFilter
-from rest_framework import generics, permissions
-from .serializers import AppointmentSerializer, InsuranceProviderSerializer, PatientSerializer, ProgressNoteSerializer, AllergySerializer, MedicationSerializer, DiagnosisSerializer
-from .models import Appointment, InsuranceProvider, Patient, ProgressNote, Allergy, Medication, Diagnosis
-from rest_framework.renderers import JSONRenderer
+from rest_framework import generics, permissions, serializers, status
+from .serializers import FreeSlotsQuerySerializer, PatientListSerializer, VitalsQuerySerializer, AppointmentSerializer, InsuranceProviderSerializer, PatientSerializer, ProgressNoteSerializer, AllergySerializer, MedicationSerializer, DiagnosisSerializer
+from .models import Appointment, AppointmentHistory, AppointmentTombstone, InsuranceProvider, Patient, ProgressNote, Allergy, Medication, Diagnosis
+from rest_framework.exceptions import NotFound
+from rest_framework.permissions import SAFE_METHODS
 from rest_framework.response import Response
 from rest_framework.views import APIView
+from .archive import ArchiveReadMixin
+from .bulk import AppointmentImporter, AppointmentImportSerializer, ProgressNoteImporter, ProgressNoteImportSerializer
+from .cache import VersionedListCacheMixin
+from .chart import chart_summary
+from .changes import changed_since, decode_cursor, encode_cursor, is_expired, removed_since
+from .conditional import ConditionalDetailMixin
+from .export import EXPORTERS, FORMATS, aiterate, gzip_stream
+from .prefix_index import PrefixSearchMixin
+from .schema import (BulkImportReportSerializer, FreeSlotSerializer, OccupancySerializer, PatientChartSerializer,
+                     VitalsSeriesSerializer)
+from .renderers import FastJSONRenderer
+from .scheduling import free_slots
+from .search import PatientSearchFilter
+from .sparse import SparseFieldsViewMixin
+from .vitals import vitals_series
+from .pagination import AppointmentCursorPagination, CursorPaginationMixin, ProgressNoteCursorPagination
 
 
 # Create your views here.
+@extend_schema(responses=inline_serializer('Pong', {'message': serializers.CharField()}))
 class PingView(APIView):
-    renderer_classes = [JSONRenderer]
+    renderer_classes = [FastJSONRenderer]
 
     def get(self, request, format=None):
         return Response({'message': 'pong'})
 
 
-class InsuranceProviderList(generics.ListCreateAPIView):
+class InsuranceProviderList(VersionedListCacheMixin, PrefixSearchMixin, SparseFieldsViewMixin, generics.ListCreateAPIView):
     queryset = InsuranceProvider.objects.all()
     permission_classes = [permissions.IsAuthenticated]
     serializer_class = InsuranceProviderSerializer
@@ -24,18 +54,77 @@ class InsuranceProviderList(generics.ListCreateAPIView):
     search_fields = ['name']
 
 
-class PatientList(generics.ListCreateAPIView):
-    queryset = Patient.objects.all()
+class PatientFilter(filters.FilterSet):
+    """
+    Filters and ordering on PatientStats, ex: patients not seen in a year with
+    ?last_visit_before=<a year ago>&ordering=last_visit
+    """
+    last_visit = filters.DateFromToRangeFilter(field_name='stats__last_visit')
+    visit_count = filters.RangeFilter(field_name='stats__visit_count')
+    no_show_rate = filters.RangeFilter(field_name='stats__no_show_rate')
+    ordering = filters.OrderingFilter(fields=(
+        ('stats__last_visit', 'last_visit'),
+        ('stats__visit_count', 'visit_count'),
+        ('stats__no_show_rate', 'no_show_rate'),
+        ('last_name', 'last_name'),
+        ('id', 'id'),
+    ))
+
+    class Meta:
+        model = Patient
+        fields = []
+
+
+class PatientList(SparseFieldsViewMixin, generics.ListCreateAPIView):
+    queryset = Patient.objects.select_related('insurance_provider', 'stats')
     permission_classes = [permissions.IsAuthenticated]
-    serializer_class = PatientSerializer
-    filter_backends = [SearchFilter]
-    search_fields = ['$dob', 'first_name', 'last_name', 'email']
+    serializer_class = PatientListSerializer
+    expandable_relations = {'insurance_provider': 'insurance_provider', 'stats': 'stats'}
+    filter_backends = [PatientSearchFilter, filters.DjangoFilterBackend]
+    filterset_class = PatientFilter
 
 
-class PatientDetail(generics.RetrieveUpdateAPIView):
-    queryset = Patient.objects.all()
+class PatientDetail(ConditionalDetailMixin, SparseFieldsViewMixin, generics.RetrieveUpdateAPIView):
+    queryset = Patient.objects.select_related('insurance_provider')
     permission_classes = [permissions.IsAuthenticated]
     serializer_class = PatientSerializer
+    expandable_relations = {'insurance_provider': 'insurance_provider'}
+    version_models = [InsuranceProvider]
+
+
+@extend_schema(parameters=[VitalsQuerySerializer], responses=VitalsSeriesSerializer)
+class PatientVitals(APIView):
+    """
+    Columnar vitals (plus BMI) from a patient's progress notes, optionally within ?start=/?end=.
+    ?bucket=day|week|month|year returns min/mean/max per bucket instead of every note.
+    """
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request, pk, format=None):
+        query = VitalsQuerySerializer(data=request.query_params)
+        query.is_valid(raise_exception=True)
+        if not Patient.objects.filter(pk=pk).exists():
+            raise NotFound()
+        return Response({'patient': pk, **vitals_series(pk, **query.validated_data)})
+
+
+@extend_schema(responses={200: PatientChartSerializer, 304: None})
+class PatientChart(APIView):
+    """
+    Everything a patient chart opens with in one response, see api.chart.
+    Allergies/medication/diagnoses come from all of the patient's progress notes, each listed once.
+    """
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request, pk, format=None):
+        chart, etag = chart_summary(pk)
+        if chart is None:
+            raise NotFound()
+        if_none_match = parse_etags(request.headers.get('If-None-Match', ''))
+        response = Response(status=status.HTTP_304_NOT_MODIFIED) if etag in if_none_match else Response(chart)
+        response['ETag'] = etag
+        patch_cache_control(response, private=True, no_cache=True)
+        return response
 
 
 class AppointmentFilter(filters.FilterSet):
@@ -46,37 +135,234 @@ class AppointmentFilter(filters.FilterSet):
         fields = ['id', 'start', 'patient']
 
 
-class AppointmentList(generics.ListCreateAPIView):
-    queryset = Appointment.objects.all()
+class AppointmentHistoryFilter(AppointmentFilter):
+    class Meta(AppointmentFilter.Meta):
+        model = AppointmentHistory
+
+
+class AppointmentList(ArchiveReadMixin, CursorPaginationMixin, SparseFieldsViewMixin, generics.ListCreateAPIView):
+    queryset = Appointment.objects.select_related(
+        'patient__insurance_provider')
     permission_classes = [permissions.IsAuthenticated]
     serializer_class = AppointmentSerializer
+    expandable_relations = {'patient': 'patient', 'patient.insurance_provider': 'patient__insurance_provider'}
     filter_backends = [filters.DjangoFilterBackend, OrderingFilter]
     filterset_class = AppointmentFilter
+    history_filterset_class = AppointmentHistoryFilter
     ordering_fields = ['start']
+    cursor_pagination_class = AppointmentCursorPagination
+
+    def create(self, request, *args, **kwargs):
+        # The overlap check's lock_schedule() holds until the insert commits
+        with transaction.atomic():
+            return super().create(request, *args, **kwargs)
+
+
+class AppointmentTombstoneFilter(filters.FilterSet):
+    """AppointmentFilter's start/patient filters, over where removed appointments were"""
+    start = filters.DateFromToRangeFilter()
+    patient = filters.NumberFilter(field_name='patient_id')
+
+    class Meta:
+        model = AppointmentTombstone
+        fields = ['start', 'patient']
+
+
+class AppointmentChanges(ArchiveReadMixin, SparseFieldsViewMixin, generics.GenericAPIView):
+    """
+    Delta sync for screens that keep a filtered set of appointments up to date, see api.changes.
+    Takes AppointmentList's filters plus ?since=<cursor>, a start range or patient is required.
+    Without since every matching row is returned, archived ones included when the range reaches back
+    past the archive horizon (archiving a row isn't a change or a removal).
+    Clients drop the removed ids, then upsert the updated rows, and send the returned cursor next time.
+    A cursor older than the tombstone retention gets 410, start over without since.
+    """
+    queryset = Appointment.objects.select_related(
+        'patient__insurance_provider')
+    permission_classes = [permissions.IsAuthenticated]
+    serializer_class = AppointmentSerializer
+    expandable_relations = AppointmentList.expandable_relations
+    filter_backends = [filters.DjangoFilterBackend]
+    filterset_class = AppointmentFilter
+    history_filterset_class = AppointmentHistoryFilter
+    pagination_class = None
+
+    def get_queryset(self):
+        # A replica lagging by more than changes.OVERLAP would hand out a cursor past rows it hasn't seen yet
+        return super().get_queryset().using(DEFAULT_DB_ALIAS)
 
+    def get(self, request, format=None):
+        # Taken before reading so rows committed while this runs are picked up next time
+        now = timezone.now()
+        since = request.query_params.get('since')
+        if since is not None:
+            try:
+                since = decode_cursor(since)
+            except ValueError:
+                return Response({'since': ['Invalid cursor.']}, status=status.HTTP_400_BAD_REQUEST)
+            if is_expired(since, now):
+                return Response({'detail': 'Cursor expired, sync again without since.'}, status=status.HTTP_410_GONE)
+        params = request.query_params
+        if not ('start_after' in params and 'start_before' in params or 'patient' in params):
+            return Response({'detail': 'start_after and start_before, or patient, are required.'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        queryset = self.filter_queryset(self.get_queryset())
+        removed = []
+        if since is not None:
+            queryset = changed_since(queryset, since)
+            tombstones = AppointmentTombstoneFilter(
+                request.query_params, AppointmentTombstone.objects.using(DEFAULT_DB_ALIAS), request=request).qs
+            removed = removed_since(tombstones, since)
+        return Response({
+            'cursor': encode_cursor(now),
+            'removed': removed,
+            'updated': self.get_serializer(queryset.order_by('start', 'id'), many=True).data,
+        })
 
-class AppointmentDetail(generics.RetrieveUpdateDestroyAPIView):
+
+@extend_schema(
+    parameters=[
+        OpenApiParameter('start_after', OpenApiTypes.DATE, required=True),
+        OpenApiParameter('start_before', OpenApiTypes.DATE, required=True),
+        OpenApiParameter('interval', str, enum=['day', 'hour'], default='day'),
+    ],
+    responses=OccupancySerializer)
+class AppointmentOccupancy(ArchiveReadMixin, generics.GenericAPIView):
+    """
+    Appointment counts per day or hour, broken down by status, for calendar views.
+    Takes the same start_after/start_before filters as AppointmentList plus ?interval=day|hour.
+    """
     queryset = Appointment.objects.all()
     permission_classes = [permissions.IsAuthenticated]
+    filter_backends = [filters.DjangoFilterBackend]
+    filterset_class = AppointmentFilter
+    history_filterset_class = AppointmentHistoryFilter
+    pagination_class = None
+    intervals = {'day': TruncDay, 'hour': TruncHour}
+
+    def get(self, request, format=None):
+        interval = request.query_params.get('interval', 'day')
+        if interval not in self.intervals:
+            return Response({'interval': ['Must be one of: %s.' % ', '.join(self.intervals)]},
+                            status=status.HTTP_400_BAD_REQUEST)
+        if not ('start_after' in request.query_params and 'start_before' in request.query_params):
+            return Response({'detail': 'start_after and start_before are required.'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        rows = (self.filter_queryset(self.get_queryset())
+                .annotate(period=self.intervals[interval]('start'))
+                .values('period', 'status')
+                .annotate(count=Count('id'))
+                .order_by('period', 'status'))
+
+        periods = {}
+        for row in rows:
+            period = periods.setdefault(row['period'], {
+                'period': row['period'].isoformat(),
+                'total': 0,
+                'counts': {value: 0 for value in Appointment.StatusEnum.values},
+            })
+            period['counts'][row['status']] = row['count']
+            period['total'] += row['count']
+        return Response({'interval': interval, 'results': list(periods.values())})
+
+
+@extend_schema(parameters=[FreeSlotsQuerySerializer], responses=FreeSlotSerializer(many=True))
+class AppointmentFreeSlots(APIView):
+    """Open gaps of at least ?duration= minutes between appointments in [start, end)"""
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request, format=None):
+        query = FreeSlotsQuerySerializer(data=request.query_params)
+        query.is_valid(raise_exception=True)
+        slots = free_slots(query.validated_data['start'], query.validated_data['end'],
+                           timedelta(minutes=query.validated_data['duration']))
+        field = serializers.DateTimeField()
+        return Response([{'start': field.to_representation(start), 'end': field.to_representation(end)}
+                         for start, end in slots])
+
+
+class BulkImportView(APIView):
+    """
+    POST a JSON list of rows. Rows are validated in batches and inserted with bulk_create,
+    all or nothing: any invalid row rolls the request back and is reported by index.
+    """
+    permission_classes = [permissions.IsAuthenticated]
+    importer_class = None
+    max_rows = 10000
+
+    def post(self, request, format=None):
+        rows = request.data
+        if not isinstance(rows, list):
+            return Response({'detail': 'Expected a list of rows.'}, status=status.HTTP_400_BAD_REQUEST)
+        if len(rows) > self.max_rows:
+            return Response({'detail': 'At most %d rows per request.' % self.max_rows},
+                            status=status.HTTP_400_BAD_REQUEST)
+        dry_run = request.query_params.get('dry_run') in ('1', 'true')
+        report = self.importer_class().run(rows, atomic=True, dry_run=dry_run)
+        if report['errors']:
+            return Response(report, status=status.HTTP_400_BAD_REQUEST)
+        return Response(report, status=status.HTTP_200_OK if dry_run else status.HTTP_201_CREATED)
+
+
+BULK_IMPORT_PARAMETERS = [OpenApiParameter('dry_run', bool, description='Validate only, nothing is inserted')]
+BULK_IMPORT_RESPONSES = {201: BulkImportReportSerializer, 200: BulkImportReportSerializer,
+                         400: BulkImportReportSerializer}
+
+
+@extend_schema(request=AppointmentImportSerializer(many=True), parameters=BULK_IMPORT_PARAMETERS,
+               responses=BULK_IMPORT_RESPONSES)
+class AppointmentBulkImport(BulkImportView):
+    importer_class = AppointmentImporter
+
+
+class AppointmentDetail(ArchiveReadMixin, ConditionalDetailMixin, SparseFieldsViewMixin,
+                        generics.RetrieveUpdateDestroyAPIView):
+    """Archived appointments are read from AppointmentHistory like current ones, but can't be changed (404)"""
+    queryset = Appointment.objects.select_related(
+        'patient__insurance_provider')
+    permission_classes = [permissions.IsAuthenticated]
     serializer_class = AppointmentSerializer
+    expandable_relations = AppointmentList.expandable_relations
+    modified_fields = ('updated_at', 'patient__updated_at')
+    version_models = [InsuranceProvider]
+
+    def reads_archive(self):
+        # Whether the id was archived isn't known without a query, the view serves both in one lookup
+        return self.request.method in SAFE_METHODS
 
 
-class ProgressNoteList(generics.ListCreateAPIView):
-    queryset = ProgressNote.objects.all()
+class ProgressNoteList(CursorPaginationMixin, SparseFieldsViewMixin, generics.ListCreateAPIView):
+    queryset = ProgressNote.objects.prefetch_related(
+        'allergies', 'medication', 'diagnoses')
     permission_classes = [permissions.IsAuthenticated]
     serializer_class = ProgressNoteSerializer
+    expandable_relations = {'allergies': None, 'medication': None, 'diagnoses': None}
+    prefetch_fields = {'allergies': 'allergies', 'medication': 'medication', 'diagnoses': 'diagnoses'}
     filter_backends = [filters.DjangoFilterBackend, OrderingFilter]
     filterset_fields = ['patient']
     ordering_fields = ['id']
+    cursor_pagination_class = ProgressNoteCursorPagination
+
+
+@extend_schema(request=ProgressNoteImportSerializer(many=True), parameters=BULK_IMPORT_PARAMETERS,
+               responses=BULK_IMPORT_RESPONSES)
+class ProgressNoteBulkImport(BulkImportView):
+    importer_class = ProgressNoteImporter
 
 
-class ProgressNoteDetail(generics.RetrieveUpdateAPIView):
-    queryset = ProgressNote.objects.all()
+class ProgressNoteDetail(ConditionalDetailMixin, SparseFieldsViewMixin, generics.RetrieveUpdateAPIView):
+    queryset = ProgressNote.objects.prefetch_related(
+        'allergies', 'medication', 'diagnoses')
     permission_classes = [permissions.IsAuthenticated]
     serializer_class = ProgressNoteSerializer
+    expandable_relations = ProgressNoteList.expandable_relations
+    prefetch_fields = ProgressNoteList.prefetch_fields
+    version_models = [Allergy, Medication, Diagnosis]
 
 
-class AllergyList(generics.ListCreateAPIView):
+class AllergyList(VersionedListCacheMixin, PrefixSearchMixin, SparseFieldsViewMixin, generics.ListCreateAPIView):
     queryset = Allergy.objects.all()
     permission_classes = [permissions.IsAuthenticated]
     serializer_class = AllergySerializer
@@ -84,7 +370,7 @@ class AllergyList(generics.ListCreateAPIView):
     search_fields = ['name']
 
 
-class MedicationList(generics.ListCreateAPIView):
+class MedicationList(VersionedListCacheMixin, PrefixSearchMixin, SparseFieldsViewMixin, generics.ListCreateAPIView):
     queryset = Medication.objects.all()
     permission_classes = [permissions.IsAuthenticated]
     serializer_class = MedicationSerializer
@@ -92,9 +378,33 @@ class MedicationList(generics.ListCreateAPIView):
     search_fields = ['name']
 
 
-class DiagnosisList(generics.ListCreateAPIView):
+class DiagnosisList(VersionedListCacheMixin, PrefixSearchMixin, SparseFieldsViewMixin, generics.ListCreateAPIView):
     queryset = Diagnosis.objects.all()
     permission_classes = [permissions.IsAuthenticated]
     serializer_class = DiagnosisSerializer
     filter_backends = [SearchFilter]
     search_fields = ['name']
+
+
+@extend_schema(
+    parameters=[OpenApiParameter('gzip', bool, description='Compress the stream')],
+    responses={(200, content_type): OpenApiResponse(OpenApiTypes.BINARY)
+               for content_type in ['text/csv', 'application/x-ndjson', 'application/gzip']})
+class ExportView(APIView):
+    """
+    Stream every row of patients, appointments or progress notes as CSV or NDJSON,
+    with nested patient/insurance provider data and M2M names flattened. ?gzip=1 compresses on the fly.
+    """
+    permission_classes = [permissions.IsAdminUser]
+
+    def get(self, request, kind, fmt):
+        lines, content_type = FORMATS[fmt]
+        stream = lines(EXPORTERS[kind]())
+        filename = '%s.%s' % (kind, fmt)
+        if request.query_params.get('gzip') in ('1', 'true'):
+            stream, content_type, filename = gzip_stream(stream), 'application/gzip', filename + '.gz'
+        if isinstance(request._request, ASGIRequest):
+            stream = aiterate(stream)
+        response = StreamingHttpResponse(stream, content_type=content_type)
+        response['Content-Disposition'] = 'attachment; filename="%s"' % filename
+        return response
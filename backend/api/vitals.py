@@ -0,0 +1,61 @@
+from django.conf import settings
+from django.db.models import Avg, Count, F, FloatField, Max, Min
+from django.db.models.functions import Cast, NullIf, Trunc
+
+from .models import ProgressNote
+
+VITALS = ['weight', 'height', 'blood_pressure_sys', 'blood_pressure_dia', 'bmi']
+BUCKETS = ['day', 'week', 'month', 'year']
+
+# Height is stored in cm (the progress note form converts ft/in), weight in VITALS_WEIGHT_UNIT
+KG_PER_WEIGHT_UNIT = {'kg': 1.0, 'lb': 0.45359237}
+
+
+def bmi_expression():
+    weight_kg = Cast('weight', FloatField()) * KG_PER_WEIGHT_UNIT[settings.VITALS_WEIGHT_UNIT]
+    height_m = Cast(NullIf('height', 0), FloatField()) / 100
+    return weight_kg / (height_m * height_m)
+
+
+def rounded(values):
+    return [None if v is None else round(float(v), 2) for v in values]
+
+
+def vitals_series(patient_id, start=None, end=None, bucket=None):
+    """
+    Columnar vitals for one patient, one query either way. With a bucket, every
+    vital becomes {'min', 'mean', 'max'} arrays aggregated per bucket by the database.
+    """
+    queryset = ProgressNote.objects.filter(patient_id=patient_id)
+    if start is not None:
+        queryset = queryset.filter(created_at__gte=start)
+    if end is not None:
+        queryset = queryset.filter(created_at__lt=end)
+
+    if bucket is None:
+        rows = list(queryset.annotate(bmi=bmi_expression())
+                    .order_by('created_at', 'id').values_list('created_at', *VITALS))
+        columns = list(zip(*rows)) or [[]] * (len(VITALS) + 1)
+        series = {'bucket': None, 'timestamps': list(columns[0])}
+        series.update({name: rounded(column) for name, column in zip(VITALS, columns[1:])})
+        return series
+
+    aggregates = {'count': Count('id')}
+    for name in VITALS:
+        source = F(name) if name != 'bmi' else bmi_expression()
+        aggregates.update({
+            name + '_min': Min(source),
+            name + '_mean': Avg(source, output_field=FloatField()),
+            name + '_max': Max(source),
+        })
+    rows = list(queryset.annotate(period=Trunc('created_at', bucket)).order_by()
+                .values('period').annotate(**aggregates).order_by('period'))
+    series = {
+        'bucket': bucket,
+        'timestamps': [row['period'] for row in rows],
+        'count': [row['count'] for row in rows],
+    }
+    for name in VITALS:
+        series[name] = {stat: rounded(row['%s_%s' % (name, stat)] for row in rows)
+                        for stat in ('min', 'mean', 'max')}
+    return series
@@ -1,5 +1,68 @@
-from django.shortcuts import render
+import gzip
+import hashlib
+import os
+import threading
+
+import brotli
+from django.conf import settings
+from django.http import Http404, HttpResponse, HttpResponseNotModified
+from django.utils.cache import patch_vary_headers
+from django.utils.http import parse_etags
+
+from api.compression import choose_coding, encoded_etag
+
+
+class IndexPage:
+    """
+    The React build's index.html held in memory with precompressed copies, reloaded when its mtime changes.
+    It has no template tags, so there's nothing for the template engine to do.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (path, mtime, {coding: bytes}, etag), swapped in one assignment
+        self.state = (None, None, {}, None)
+
+    def load(self, path, mtime):
+        with open(path, 'rb') as f:
+            content = f.read()
+        variants = {'gzip': gzip.compress(content, compresslevel=9, mtime=0), 'br': brotli.compress(content)}
+        variants = {coding: data for coding, data in variants.items() if len(data) < len(content)}
+        variants[None] = content
+        return (path, mtime, variants, '"%s"' % hashlib.md5(content).hexdigest())
+
+    def get(self):
+        path = os.path.join(settings.WHITENOISE_ROOT, 'index.html')
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            raise Http404('Frontend build not found, run npm run build')
+        state = self.state
+        if state[:2] != (path, mtime):
+            with self.lock:
+                state = self.state
+                if state[:2] != (path, mtime):
+                    state = self.state = self.load(path, mtime)
+        return state[2], state[3]
+
+
+index_page = IndexPage()
 
 
 def index(request):
-    return render(request, "index.html")
+    variants, etag = index_page.get()
+    coding = choose_coding(request.headers.get('Accept-Encoding', ''), [c for c in variants if c])
+    etag = encoded_etag(etag, coding)
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match and (etag in parse_etags(if_none_match) or '*' in parse_etags(if_none_match)):
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(variants[coding], content_type='text/html; charset=utf-8')
+        if coding:
+            response['Content-Encoding'] = coding
+        response['Content-Length'] = str(len(variants[coding]))
+    response['ETag'] = etag
+    # Always revalidate, the page points at the current build's hashed assets
+    response['Cache-Control'] = 'no-cache'
+    patch_vary_headers(response, ('Accept-Encoding',))
+    return response